@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark parsing the schedule with and without the fast path for UTC
+timestamps.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/ical_timestamps.py
+'''
+
+from pyca import schedule
+import dateutil.parser
+import time
+
+EVENTS = 5000
+
+
+def calendar(events):
+    '''Create a calendar with three date-time properties per event.
+    '''
+    vevents = ''.join(
+        'BEGIN:VEVENT\r\n'
+        f'UID:{i}\r\n'
+        'DTSTAMP:20240101T080000Z\r\n'
+        f'DTSTART:20240102T{i // 3600 % 24:02d}{i // 60 % 60:02d}00Z\r\n'
+        f'DTEND:20240102T{i // 3600 % 24:02d}{i // 60 % 60:02d}30Z\r\n'
+        'SUMMARY:Benchmark\r\n'
+        'END:VEVENT\r\n'
+        for i in range(events))
+    return 'BEGIN:VCALENDAR\r\n' + vevents + 'END:VCALENDAR'
+
+
+def measure(function, *args):
+    '''Get the best of three runs in seconds.
+    '''
+    durations = []
+    for _ in range(3):
+        start = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def main():
+    vcal = calendar(EVENTS)
+    timestamps = [line.split(':', 1)[1] for line in vcal.split('\r\n')
+                  if line.startswith('DT')]
+
+    def dateutil_timestamp(value):
+        return int(dateutil.parser.parse(value).timestamp())
+
+    def convert(parse):
+        for value in timestamps:
+            parse(value)
+
+    fast = measure(schedule.parse_ical, vcal)
+    fast_timestamps = measure(convert, schedule.parse_timestamp)
+    parse_timestamp = schedule.parse_timestamp
+    schedule.parse_timestamp = dateutil_timestamp
+    try:
+        slow = measure(schedule.parse_ical, vcal)
+    finally:
+        schedule.parse_timestamp = parse_timestamp
+    slow_timestamps = measure(convert, dateutil_timestamp)
+
+    print(f'{EVENTS} events, {len(timestamps)} timestamps')
+    print(f'parse_ical      dateutil {slow:.2f} s   fast path {fast:.2f} s')
+    print(f'timestamps only dateutil {slow_timestamps:.2f} s   '
+          f'fast path {fast_timestamps:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark uploading a track with a separate pass to hash it followed by a
+form upload against streaming it from a memory mapped file while hashing
+it. The file is evicted from the page cache before each run. The bytes
+read from disk and copied through read() are taken from /proc/self/io, so
+this runs on Linux only. Reads through the memory map show up as major
+page faults and bytes read from disk, but not as bytes copied.
+
+Tracks fitting into the page cache are read from disk once either way.
+Pass a size in GiB larger than the memory to see the second disk pass.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/streaming_upload.py [size in GiB]
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pyca import config, db, ingest
+from tests.tools import MEDIAPACKAGE
+import hashlib
+import multiprocessing
+import os
+import os.path
+import resource
+import sys
+import tempfile
+import time
+
+TRACK_SIZE = 1024 ** 3
+BLOCK_SIZE = 1024 * 1024
+
+RESULT = MEDIAPACKAGE.replace('<media>', '<media><track id="track-1"/>')
+
+
+class Sink(BaseHTTPRequestHandler):
+    '''Discard uploaded data and respond with a mediapackage.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        while length:
+            length -= len(self.rfile.read(min(length, BLOCK_SIZE)))
+        body = RESULT.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(server):
+    server.serve_forever()
+
+
+def io_counters():
+    '''Get the number of bytes this process has read from disk and through
+    read() and the number of major page faults.
+    '''
+    with open('/proc/self/io') as f:
+        io = dict(line.split(': ') for line in f)
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt
+    return int(io['read_bytes']), int(io['rchar']), faults
+
+
+def evict(path):
+    '''Drop a file from the page cache.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    os.fsync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    os.close(fd)
+
+
+def hash_and_upload(service_url, track):
+    checksum = hashlib.md5()  # nosec B324
+    with open(track, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            checksum.update(block)
+    ingest.add_track(service_url, MEDIAPACKAGE, 'presenter/source', track)
+
+
+def stream(service_url, track):
+    ingest.stream_track(service_url, MEDIAPACKAGE, 'presenter/source', track)
+
+
+def measure(function, service_url, track):
+    '''Get the duration in seconds and the differences of the I/O counters.
+    '''
+    evict(track)
+    before = io_counters()
+    start = time.perf_counter()
+    function(service_url, track)
+    duration = time.perf_counter() - start
+    return (duration,) + tuple(after - value for after, value
+                               in zip(io_counters(), before))
+
+
+def main(size):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Sink)
+    service_url = 'http://127.0.0.1:%i/ingest' % server.server_address[1]
+    # Serve from another process to not count the received data as read
+    process = multiprocessing.Process(target=serve, args=(server,),
+                                      daemon=True)
+    process.start()
+    server.server_close()
+    with tempfile.TemporaryDirectory() as directory:
+        config.config('agent')['database'] = \
+            'sqlite:///' + os.path.join(directory, 'pyca.db')
+        config.config('ingest')['checksum'] = 'md5'
+        db.init()
+        track = os.path.join(directory, 'track.mp4')
+        block = os.urandom(BLOCK_SIZE)
+        with open(track, 'wb') as f:
+            for _ in range(size // BLOCK_SIZE):
+                f.write(block)
+
+        print(f'{size / 1024 ** 3:.0f} GiB track, page cache dropped')
+        for name, function in (('hash + FORM_FILE', hash_and_upload),
+                               ('streaming', stream)):
+            duration, disk, copied, faults = \
+                measure(function, service_url, track)
+            print(f'{name:16}  {duration:5.1f} s  '
+                  f'{disk / 1e6:6.0f} MB from disk  '
+                  f'{copied / 1e6:6.0f} MB via read()  '
+                  f'{faults:6} major faults')
+    process.terminate()
+
+
+if __name__ == '__main__':
+    main(int(float(sys.argv[1]) * 1024 ** 3) if len(sys.argv) > 1
+         else TRACK_SIZE)
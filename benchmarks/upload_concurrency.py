@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark uploading the tracks of a recording one after another and in
+parallel to a local stand-in for Opencast which limits the rate of each
+connection.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/upload_concurrency.py
+'''
+
+from pyca import config, db, ingest
+from tests.tools import MEDIAPACKAGE, OpencastMock
+import os.path
+import tempfile
+import time
+
+TRACKS = 2
+TRACK_SIZE = 8000000
+RATE = 4000000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        config.config('agent')['database'] = \
+            'sqlite:///' + os.path.join(directory, 'pyca.db')
+        db.init()
+        tracks = []
+        for i in range(TRACKS):
+            track = os.path.join(directory, f'track-{i}.mp4')
+            with open(track, 'wb') as f:
+                f.write(os.urandom(TRACK_SIZE))
+            tracks.append((f'presenter{i}/source', track))
+
+        opencast = OpencastMock()
+        opencast.rate = RATE
+        try:
+            print(f'{TRACKS} tracks of {TRACK_SIZE / 1e6:.0f} MB, '
+                  f'{RATE / 1e6:.0f} MB/s per connection')
+            for concurrency in (1, TRACKS):
+                config.config('ingest')['upload_concurrency'] = concurrency
+                start = time.perf_counter()
+                ingest.add_tracks(opencast.url + '/ingest', MEDIAPACKAGE,
+                                  tracks)
+                duration = time.perf_counter() - start
+                print(f'upload_concurrency = {concurrency}  '
+                      f'{duration:.2f} s')
+        finally:
+            opencast.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ import multiprocessing
 import signal
 import sys
 from pyca import capture, config, schedule, ingest, ui, agentstate, utils
+from pyca import retention
 from pyca.db import get_session
 
 USAGE = '''
@@ -24,6 +25,7 @@ COMMANDS:
   ingest     --  Start pyCA ingest service
   schedule   --  Start pyCA schedule service
   agentstate --  Start pyCA agentstate service
+  retention  --  Start pyCA retention service
   ui         --  Start web based user interface
 
 OPTIONS:
@@ -105,7 +107,7 @@ def main():
     if cmd == 'run':
         # ensure database is created first
         get_session().close()
-        run_all(schedule, capture, ingest, agentstate)
+        run_all(schedule, capture, ingest, agentstate, retention)
     elif cmd == 'all':
         get_session().close()
         signal.signal(signal.SIGINT, signal.default_int_handler)
@@ -113,7 +115,7 @@ def main():
                 target=ui.app.run,
                 kwargs={'threaded': False}
             ).start()
-        run_all(schedule, capture, ingest, agentstate)
+        run_all(schedule, capture, ingest, agentstate, retention)
     elif cmd == 'schedule':
         schedule.run()
     elif cmd == 'capture':
@@ -122,6 +124,8 @@ def main():
         ingest.run()
     elif cmd == 'agentstate':
         agentstate.run()
+    elif cmd == 'retention':
+        retention.run()
     elif cmd == 'ui':
         signal.signal(signal.SIGINT, signal.default_int_handler)
         ui.app.run(threaded=False)
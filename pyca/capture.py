@@ -12,8 +12,13 @@ from pyca.utils import set_service_status, set_service_status_immediate
 from pyca.utils import recording_state, update_event_status
 from pyca.config import config
 from pyca.db import get_session, RecordedEvent, UpcomingEvent, Status, \
-                    Service, ServiceStatus, with_session
+                    Service, ServiceStatus, UpstreamState, Statistic, \
+                    with_session, LATENCY_BUCKETS
+from pyca import retention
+import calendar
 import glob
+import hashlib
+import json
 import logging
 import os
 import os.path
@@ -22,12 +27,21 @@ import shlex
 import signal
 import subprocess
 import sys
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 notify = sdnotify.SystemdNotifier()
 captureproc = None
 
+# Seconds between two checks for finished segments in segmented mode
+SEGMENT_INTERVAL = 5
+
+# Seconds to wait before restarting a recording which failed or ended before
+# its scheduled end. The delay doubles with every restart up to the maximum.
+RESTART_DELAY = 1
+RESTART_DELAY_MAX = 60
+
 
 def sigterm_handler(signum, frame):
     '''Intercept sigterm and terminate all processes.
@@ -50,6 +64,7 @@ def start_capture(db, upcoming_event):
               .filter(RecordedEvent.uid == upcoming_event.uid)\
               .filter(RecordedEvent.start == upcoming_event.start)\
               .first()
+    restarted = bool(event)
     if not event:
         event = RecordedEvent(upcoming_event)
         db.add(event)
@@ -58,16 +73,30 @@ def start_capture(db, upcoming_event):
     try_mkdir(config('capture', 'directory'))
     try_mkdir(event.directory())
 
+    # Make sure there is enough disk space for the recording
+    check_disk_space(db, event)
+    db.commit()
+
     # Set state
     update_event_status(event, Status.RECORDING)
     recording_state(event.uid, 'capturing')
     set_service_status_immediate(Service.CAPTURE, ServiceStatus.BUSY)
 
     # Recording
-    files = recording_command(event)
+    event.start_latency = event.data_latency = event.exit_latency = None
+    try:
+        files = recording_command(event)
+    finally:
+        # Store capture latencies even if the recording failed
+        db.commit()
+        record_latencies(event, restarted)
     # [(flavor,path),…]
-    event.set_tracks(list(zip(config('capture', 'flavors'), files)))
+    if config('capture', 'segmented'):
+        event.set_tracks(finished_segments(files, True))
+    else:
+        event.set_tracks(list(zip(config('capture', 'flavors'), files)))
     db.commit()
+    record_bitrate(event)
 
     # Set status
     # If part files exist, its an partial recording
@@ -104,8 +133,146 @@ def safe_start_capture(event):
             logger.exception('Could not update recording status')
 
 
+def record_latencies(event, restarted=False):
+    '''Add the capture latencies of a recording to the latency histograms.
+    The start latency of a restarted recording says nothing about the delay
+    of starting a recording and is counted as restart instead.
+
+    :param event: Recording to get the latencies from
+    :param restarted: If the recording has been started before
+    '''
+    latencies = {'capture_start_latency': event.start_latency,
+                 'capture_data_latency': event.data_latency,
+                 'capture_exit_latency': event.exit_latency}
+    if restarted:
+        del latencies['capture_start_latency']
+        Statistic.increase({'capture_restarts': 1})
+    for name, latency in latencies.items():
+        if latency is not None:
+            Statistic.observe(name, latency, LATENCY_BUCKETS)
+
+
+def command_label():
+    '''Get a label identifying the configured capture command in the
+    bitrate statistics.
+    '''
+    command = config('capture', 'command').encode('utf-8')
+    return hashlib.sha256(command).hexdigest()[:16]
+
+
+def record_bitrate(event):
+    '''Add the size and duration of a finished recording to the bitrate
+    statistics of the capture command.
+    '''
+    size = event.track_size()
+    duration = event.end + (event.exit_latency or 0) \
+        - event.start - (event.start_latency or 0)
+    if size and duration > 0:
+        Statistic.increase({'capture_bytes': size,
+                            'capture_seconds': duration},
+                           label=command_label())
+
+
+def observed_bitrate(db):
+    '''Get the average bitrate of previous recordings using the configured
+    capture command.
+
+    :return: Bytes per second or None if nothing has been recorded yet
+    '''
+    statistics = {s.name: s.value for s in db.query(Statistic)
+                  .filter(Statistic.label == command_label())}
+    if not statistics.get('capture_seconds'):
+        return None
+    return statistics.get('capture_bytes', 0) / statistics['capture_seconds']
+
+
+def reserved_space(db, event, bitrate):
+    '''Estimate the disk space still needed by other recordings which are
+    running or will start before the given recording ends.
+
+    :param event: Recording to exclude
+    :param bitrate: Estimated bytes per second of a recording
+    :return: Number of bytes
+    '''
+    now = timestamp()
+    running = db.query(RecordedEvent)\
+                .filter(RecordedEvent.status == Status.RECORDING)
+    pending = db.query(UpcomingEvent)\
+                .filter(UpcomingEvent.start < event.end)\
+                .filter(UpcomingEvent.end > now)
+    return sum(bitrate * other.remaining_duration(now)
+               for other in list(running) + list(pending)
+               if (other.uid, other.start) != (event.uid, event.start))
+
+
+def check_disk_space(db, event):
+    '''Estimate the size of a recording from its duration and the bitrate
+    of previous recordings and check if there is enough disk space left,
+    taking other running and pending recordings into account. The estimate
+    and the available space are stored with the recording.
+
+    :param event: Recording to check
+    :return: If there is enough disk space
+    '''
+    bitrate = observed_bitrate(db)
+    if not bitrate:
+        logger.info('No bitrate known yet. Skipping disk space check.')
+        return True
+    bitrate *= 1 + config('capture', 'space_margin') / 100
+    required = int(bitrate * event.remaining_duration(timestamp()))
+    reserved = int(reserved_space(db, event, bitrate))
+    available = retention.disk_usage()[2] - reserved
+    event.estimated_size = required
+    event.space_available = available
+    if available < required:
+        logger.warning('Recording needs about %i bytes but only %i bytes are '
+                       'available. Removing uploaded recordings once the '
+                       'recording started.', required, available)
+        return False
+    return True
+
+
+def free_disk_space(uid, start, missing):
+    '''Remove uploaded recordings to make room for a running recording and
+    update the disk space available to it.
+
+    :param uid: Identifier of the recording
+    :param start: Start of the recording
+    :param missing: Number of bytes to free in addition to the free space
+    '''
+    freed = retention.evict(retention.disk_usage()[2] + missing)
+    session = get_session()
+    event = session.query(RecordedEvent)\
+                   .filter(RecordedEvent.uid == uid)\
+                   .filter(RecordedEvent.start == start)\
+                   .first()
+    if event:
+        event.space_available += freed
+        session.commit()
+        if event.space_available < event.estimated_size:
+            logger.error('INSUFFICIENT DISK SPACE: Recording %s needs about '
+                         '%i bytes but only %i bytes are available. The '
+                         'recording will likely fail.', uid,
+                         event.estimated_size, event.space_available)
+    session.close()
+
+
+def safe_free_disk_space(uid, start, missing):
+    '''Free disk space but make sure to catch any errors, log them but
+    otherwise ignore them.
+    '''
+    try:
+        free_disk_space(uid, start, missing)
+    except Exception:
+        logger.exception('Could not free disk space')
+
+
 def recording_command(event):
     '''Run the actual command to record the a/v material.
+
+    The delays between scheduled start and spawning the capture process,
+    spawning the process and the first data being written as well as the
+    scheduled end and the process exiting are stored in the event.
     '''
     conf = config('capture')
     # Prepare command line
@@ -120,7 +287,9 @@ def recording_command(event):
     files = [f.replace('{{name}}', event.name()) for f in files]
 
     # Move existing files from previous failed recordings
-    for f in files:
+    segmented = conf['segmented']
+    existing = [glob.glob(f) if segmented else [f] for f in files]
+    for f in sum(existing, []):
         if not os.path.exists(f):
             continue
         # New filename
@@ -147,14 +316,33 @@ def recording_command(event):
     args = shlex.split(cmd)
     DEVNULL = getattr(subprocess, 'DEVNULL', os.open(os.devnull, os.O_RDWR))
     captureproc = subprocess.Popen(args, stdin=DEVNULL)
+    spawned = time.time()
+    event.start_latency = spawned - event.start
+    event.data_latency = None
     hasattr(subprocess, 'DEVNULL') or os.close(DEVNULL)
 
+    # Make room for the recording without delaying its start
+    missing = (event.estimated_size or 0) - (event.space_available or 0)
+    if missing > 0:
+        threading.Thread(target=safe_free_disk_space,
+                         args=(event.uid, event.start, missing),
+                         daemon=True).start()
+
     # Set systemd status
     notify.notify('STATUS=Capturing')
 
     # Check process
+    segments, segments_checked = [], spawned
     while captureproc.poll() is None:
         notify.notify('WATCHDOG=1')
+        if event.data_latency is None and data_written(files):
+            event.data_latency = time.time() - spawned
+        if segmented and time.time() - segments_checked > SEGMENT_INTERVAL:
+            segments_checked = time.time()
+            finished = finished_segments(files)
+            if finished != segments:
+                segments = finished
+                store_segments(event, segments)
         if sigcustom_time and timestamp() > sigcustom_time:
             logger.info("Sending custom signal to capture process")
             captureproc.send_signal(conf['sigcustom'])
@@ -168,6 +356,10 @@ def recording_command(event):
             captureproc.kill()
             sigkill_time = 0  # send only once
         time.sleep(0.1)
+    exited = time.time()
+    event.exit_latency = exited - event.end
+    if event.data_latency is None and data_written(files):
+        event.data_latency = exited - spawned
 
     # Remove preview files:
     for preview in conf['preview']:
@@ -188,25 +380,118 @@ def recording_command(event):
     return files
 
 
+def data_written(files):
+    '''Check if any data has been written to the given files.
+    '''
+    if config('capture', 'segmented'):
+        files = sum((glob.glob(f) for f in files), [])
+    return any(os.path.isfile(f) and os.path.getsize(f) > 0 for f in files)
+
+
+def finished_segments(files, finished=False):
+    '''Get the segments of a segmented recording which have been written
+    completely. Segments of a track are ordered by name. All but the last
+    segment of a track are finished while the capture process is running.
+
+    :param files: List of glob patterns matching the segments of each track
+    :param finished: If the capture process has exited
+    :return: List of flavor and segment path tuples
+    '''
+    tracks = []
+    for flavor, pattern in zip(config('capture', 'flavors'), files):
+        segments = sorted(glob.glob(pattern))
+        if not finished:
+            segments = segments[:-1]
+        tracks += [(flavor, segment) for segment in segments]
+    return tracks
+
+
+def store_segments(event, tracks):
+    '''Store the finished segments of a running recording to let the ingest
+    service upload them while the recording continues.
+
+    :param event: Recording to store the segments for
+    :param tracks: List of flavor and segment path tuples
+    '''
+    logger.info('Found %i finished segments', len(tracks))
+    session = get_session()
+    session.query(RecordedEvent)\
+           .filter(RecordedEvent.uid == event.uid)\
+           .filter(RecordedEvent.start == event.start)\
+           .update({'tracks': json.dumps(tracks).encode('utf-8')},
+                   synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+def next_schedule_check(db):
+    '''Get the time when the schedule service will have updated the schedule
+    next. If an update is overdue, check again after a delay growing with the
+    time it is overdue.
+    '''
+    now = time.time()
+    frequency = config('agent', 'update_frequency')
+    state = db.query(UpstreamState)\
+              .filter(UpstreamState.url == config('server', 'url'))\
+              .first()
+    if not state or not state.last_synced:
+        return now + frequency
+    last_synced = calendar.timegm(state.last_synced.utctimetuple())
+    # Allow some time for processing the schedule
+    next_sync = last_synced + frequency + 1
+    if next_sync > now:
+        return next_sync
+    return now + max(1, min(frequency, now - next_sync))
+
+
+def wait_until(wakeup):
+    '''Sleep until the given time or until the service is terminated.
+    '''
+    last_notification = 0
+    while not terminate() and time.time() < wakeup:
+        if time.time() - last_notification >= 10:
+            notify.notify('WATCHDOG=1')
+            last_notification = time.time()
+        time.sleep(min(0.1, max(0, wakeup - time.time())))
+
+
 def control_loop():
     '''Main loop of the capture agent, retrieving and checking the schedule as
     well as starting the capture process if necessry.
+
+    Instead of polling the database, the service sleeps until the next
+    recording is due or until the schedule service may have updated the
+    schedule.
     '''
     set_service_status_immediate(Service.CAPTURE, ServiceStatus.IDLE)
     notify.notify('READY=1')
     notify.notify('STATUS=Waiting')
+    last_started, restarts = None, 0
     while not terminate():
         notify.notify('WATCHDOG=1')
         # Get next recording
         session = get_session()
         event = session.query(UpcomingEvent)\
-                       .filter(UpcomingEvent.start <= timestamp())\
                        .filter(UpcomingEvent.end > timestamp())\
+                       .order_by(UpcomingEvent.start)\
                        .first()
-        if event:
+        if event and event.start <= time.time():
+            key, end = (event.uid, event.start), event.end
+            restarts = restarts + 1 if key == last_started else 0
+            last_started = key
+            logger.info('Starting recording %.3f seconds after its scheduled '
+                        'start', time.time() - event.start)
             safe_start_capture(event)
+            session.close()
+            # Do not restart a recording which ended early right away
+            delay = min(RESTART_DELAY * 2 ** restarts, RESTART_DELAY_MAX)
+            wait_until(min(time.time() + delay, end))
+            continue
+        wakeup = next_schedule_check(session)
         session.close()
-        time.sleep(1.0)
+        if event:
+            wakeup = min(wakeup, event.start)
+        wait_until(wakeup)
     logger.info('Shutting down capture service')
     set_service_status(Service.CAPTURE, ServiceStatus.STOPPED)
 
@@ -17,6 +17,7 @@ __CFG = '''
 [agent]
 name             = string(default='')
 update_frequency = integer(min=5, default=60)
+state_keepalive  = integer(min=0, default=300)
 cal_lookahead    = integer(min=0, default=14)
 backup_mode      = boolean(default=false)
 database         = string(default='sqlite:///pyca.db')
@@ -33,6 +34,8 @@ sigcustom_time   = integer(min=-1, default=-1)
 sigterm_time     = integer(min=-1, default=-1)
 sigkill_time     = integer(min=-1, default=120)
 exit_code        = integer(min=0, max=255, default=0)
+segmented        = boolean(default=false)
+space_margin     = integer(min=0, default=20)
 
 [ingest]
 delay_max        = integer(min=0, default=0)
@@ -40,6 +43,25 @@ delay_min        = integer(min=0, default=0)
 delete_after_upload = boolean(default=false)
 upload_catalogs  = boolean(default=false)
 upload_rate      = string(default='0')
+upload_rate_schedule = force_list(default=list())
+adaptive_rate    = boolean(default=false)
+chunk_size       = string(default='0')
+upload_concurrency = integer(min=1, default=1)
+streaming_upload = boolean(default=false)
+single_request   = boolean(default=false)
+segment_workflow = string(default='')
+checksum         = option('md5', 'sha256', default='md5')
+workers          = integer(min=1, default=1)
+priority         = option('oldest', 'newest', 'smallest', default='oldest')
+max_attempts     = integer(min=1, default=10)
+retry_delay      = integer(min=1, default=60)
+node_selection   = option('random', 'fastest', 'sticky', default='random')
+
+[retention]
+high_watermark   = integer(min=0, max=100, default=0)
+low_watermark    = integer(min=0, max=100, default=80)
+order            = option('oldest', 'lru', default='oldest')
+interval         = integer(min=1, default=60)
 
 [server]
 url              = string(default='https://develop.opencast.org')
@@ -49,6 +71,7 @@ password         = string(default='opencast')
 insecure         = boolean(default=False)
 certificate      = string(default='')
 cookiefile       = string(default='')
+service_ttl      = integer(min=0, default=3600)
 [[service_overrides]]
 
 [ui]
@@ -68,8 +91,10 @@ format           = string(default='[%(name)s:%(lineno)s:%(funcName)s()] [%(level
 [http]
 timeout          = integer(min=0, default=300)
 connection_timeout = integer(min=0, default=180)
+pool_size        = integer(min=0, default=4)
+http2            = boolean(default=False)
+compression      = boolean(default=True)
 
-[services]
 '''  # noqa
 
 cfgspec = __CFG.split('\n')
@@ -104,6 +129,9 @@ def update_configuration(cfgfile=None):
         raise ValueError('Invalid configuration: %s' % val)
     if len(cfg['capture']['files']) != len(cfg['capture']['flavors']):
         raise ValueError('List of files and flavors do not match')
+    if cfg['capture']['segmented'] and not cfg['ingest']['segment_workflow']:
+        raise ValueError('Segmented recordings require a segment workflow '
+                         'concatenating the segments')
     if not cfg['agent']['name']:
         cfg['agent']['name'] = 'pyca@' + socket.gethostname()
     globals()['__config'] = cfg
@@ -112,19 +140,52 @@ def update_configuration(cfgfile=None):
         logger.warning('Base URL ends with /. This is most likely a '
                        'configuration error. The URL should contain nothing '
                        'of the service paths.')
-    if cfg['ingest'].get('upload_rate'):
-        # Limit upload rate in bytes per second
-        upload_rate = cfg['ingest'].get('upload_rate').lower()
-        if upload_rate.endswith('m'):
-            upload_rate = upload_rate[0:-1] + '000000'
-        elif upload_rate.endswith('k'):
-            upload_rate = upload_rate[0:-1] + '000'
-        cfg['ingest']['upload_rate'] = int(upload_rate)
+    # Limit upload rate in bytes per second
+    cfg['ingest']['upload_rate'] = parse_size(cfg['ingest']['upload_rate'])
+    cfg['ingest']['chunk_size'] = parse_size(cfg['ingest']['chunk_size'])
+    cfg['ingest']['upload_rate_schedule'] = parse_rate_schedule(
+        cfg['ingest']['upload_rate_schedule'])
     logger.info('Configuration loaded from %s', cfgfile)
     check()
     return cfg
 
 
+def parse_size(value):
+    '''Parse a number of bytes which may have the suffix m for megabyte or k
+    for kilobyte.
+
+    :param value: String to parse
+    :return: Number of bytes
+    '''
+    value = str(value).lower()
+    if value.endswith('m'):
+        value = value[0:-1] + '000000'
+    elif value.endswith('k'):
+        value = value[0:-1] + '000'
+    return int(value or 0)
+
+
+def parse_rate_schedule(schedule):
+    '''Parse a list of time windows with upload rates like
+    `08:00-18:00 2m`. Windows may span midnight.
+
+    :param schedule: List of strings to parse
+    :return: List of tuples of the start and end of each window in minutes
+             after midnight and the upload rate in bytes per second
+    '''
+    result = []
+    for entry in schedule:
+        try:
+            window, rate = entry.split()
+            start, end = [int(hour) * 60 + int(minute)
+                          for hour, minute in (time.split(':')
+                                               for time in window.split('-'))]
+            result.append((start, end, parse_size(rate)))
+        except ValueError:
+            raise ValueError('Invalid upload rate schedule entry: %s' % entry)
+    return result
+
+
 def check():
     '''Check configuration for sanity.
     '''
@@ -7,16 +7,20 @@
 '''
 
 import json
+import logging
 import os.path
 import string
+from base64 import b64decode
 from pyca.config import config
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, Text, LargeBinary, DateTime, \
-    create_engine
+    Float, create_engine, inspect, or_, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
 Base = declarative_base()
+logger = logging.getLogger(__name__)
 
 
 def init():
@@ -26,6 +30,24 @@ def init():
     global engine
     engine = create_engine(config('agent', 'database'))
     Base.metadata.create_all(engine)
+    migrate()
+
+
+def migrate():
+    '''Add columns missing in tables created by older versions of pyCA.
+    Columns added after the initial table definition must be nullable.
+    '''
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = [c['name'] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    quote(table.name), quote(column.name), column_type)))
 
 
 def get_session():
@@ -107,6 +129,7 @@ class Service(Constants):
     CAPTURE = 2
     INGEST = 3
     SCHEDULE = 4
+    RETENTION = 5
 
 
 # Database Schema Definition
@@ -123,17 +146,47 @@ class BaseEvent():
     status = Column('status', Integer(), nullable=False,
                     default=Status.UPCOMING)
     tracks = Column('tracks', LargeBinary(), nullable=True)
+    # Space separated hashes of the attachments stored separately
+    attachment_hashes = Column('attachment_hashes', Text(), nullable=True)
 
     def get_data(self):
         '''Load JSON data from event.
         '''
         return json.loads(self.data.decode('utf-8'))
 
+    def get_attachments(self):
+        '''Load the attachments of this event including their decoded data.
+        Attachments stored separately are loaded from the attachment table.
+        '''
+        attachments = self.get_data().get('attach', [])
+        hashes = [a['hash'] for a in attachments if 'hash' in a]
+        stored = {}
+        if hashes:
+            s = get_session()
+            try:
+                stored = s.query(Attachment)\
+                          .filter(Attachment.hash.in_(hashes))
+                stored = {a.hash: a.decode() for a in stored}
+            finally:
+                s.close()
+        result = []
+        for attachment in attachments:
+            if 'hash' in attachment:
+                attachment_hash = attachment.pop('hash')
+                if attachment_hash not in stored:
+                    logger.warning('Attachment %s of %s is missing',
+                                   attachment.get('x-apple-filename'), self)
+                    continue
+                attachment['data'] = stored[attachment_hash]
+            result.append(attachment)
+        return result
+
     def set_data(self, data):
         '''Store data as JSON.
         '''
         # Python 3 wants bytes
         self.data = json.dumps(data).encode('utf-8')
+        self.attachment_hashes = attachment_hashes(data)
 
     def name(self):
         '''Returns the filesystem name of this event.
@@ -167,6 +220,12 @@ class BaseEvent():
         '''
         self.tracks = json.dumps(tracks).encode('utf-8')
 
+    def track_size(self):
+        '''Returns the total size of the existing track files in bytes.
+        '''
+        return sum(os.path.getsize(track) for _, track in self.get_tracks()
+                   if os.path.isfile(track))
+
     def __repr__(self):
         '''Return a string representation of an artist object.
 
@@ -174,11 +233,15 @@ class BaseEvent():
         '''
         return '<Event(start=%i, uid="%s")>' % (self.start, self.uid)
 
-    def serialize(self):
+    def serialize(self, attachments=False):
         '''Serialize this object as dictionary usable for conversion to JSON.
 
+        :param attachments: Include the decoded data of all attachments
         :return: Dictionary representing this object.
         '''
+        data = self.get_data()
+        if attachments:
+            data['attach'] = self.get_attachments()
         return {
             'type': 'event',
             'id': self.uid,
@@ -187,12 +250,24 @@ class BaseEvent():
                 'end': self.end,
                 'uid': self.uid,
                 'title': self.title,
-                'data': self.get_data(),
+                'data': data,
                 'status': Status.str(self.status)
             }
         }
 
 
+def attachment_hashes(data):
+    '''Get the hashes of the attachments of event data which are stored in
+    the attachment table.
+
+    :param data: Event data
+    :return: Space separated list of hashes
+    '''
+    if not isinstance(data, dict):
+        return ''
+    return ' '.join(a['hash'] for a in data.get('attach', []) if 'hash' in a)
+
+
 class UpcomingEvent(Base, BaseEvent):
     '''List of upcoming events'''
 
@@ -204,6 +279,24 @@ class RecordedEvent(Base, BaseEvent):
 
     __tablename__ = 'recorded_event'
 
+    # Seconds from scheduled start to spawning the capture process
+    start_latency = Column('start_latency', Float(), nullable=True)
+    # Seconds from spawning the capture process to the first bytes written
+    data_latency = Column('data_latency', Float(), nullable=True)
+    # Seconds from scheduled end to the capture process exiting
+    exit_latency = Column('exit_latency', Float(), nullable=True)
+    # Time until which an ingest worker has exclusive access to the recording
+    lease = Column('lease', DateTime(), nullable=True)
+    # Number of failed upload attempts and when to try again
+    attempts = Column('attempts', Integer(), nullable=True)
+    next_retry = Column('next_retry', DateTime(), nullable=True)
+    # JSON list describing the upload progress of each track
+    upload_progress = Column('upload_progress', Text(), nullable=True)
+    # Estimated size of the recording and disk space available for it
+    # before the capture started
+    estimated_size = Column('estimated_size', Integer(), nullable=True)
+    space_available = Column('space_available', Integer(), nullable=True)
+
     def __init__(self, event=None):
         if event:
             self.uid = event.uid
@@ -211,8 +304,61 @@ class RecordedEvent(Base, BaseEvent):
             self.end = event.end
             self.title = event.title
             self.data = event.data
+            self.attachment_hashes = event.attachment_hashes
             self.status = event.status
 
+    def get_upload_progress(self):
+        '''Load the upload progress of the tracks of this recording.
+        '''
+        if not self.upload_progress:
+            return []
+        return json.loads(self.upload_progress)
+
+    def serialize(self, attachments=False):
+        '''Serialize this object as dictionary usable for conversion to JSON.
+        The upload progress is included for recordings which have been
+        uploaded.
+
+        :param attachments: Include the decoded data of all attachments
+        :return: Dictionary representing this object.
+        '''
+        result = BaseEvent.serialize(self, attachments)
+        if self.upload_progress:
+            result['attributes']['upload_progress'] = \
+                self.get_upload_progress()
+        return result
+
+
+class Attachment(Base):
+    '''Attachments of scheduled events. Identical attachments shared by
+    several events are stored only once. The data is kept base64 encoded as
+    received from Opencast.'''
+
+    __tablename__ = 'attachment'
+
+    hash = Column('hash', Text(), primary_key=True)
+    data = Column('data', LargeBinary(), nullable=False)
+
+    def decode(self):
+        '''Return the decoded attachment data.
+        '''
+        return b64decode(self.data).decode('utf-8')
+
+
+class TrackUpload(Base):
+    '''Progress of chunked track uploads used to resume interrupted
+    uploads.'''
+
+    __tablename__ = 'track_upload'
+
+    path = Column('path', Text(), primary_key=True)
+    size = Column('size', Integer(), nullable=False)
+    chunk_size = Column('chunk_size', Integer(), nullable=False)
+    # URL of the upload job in Opencast
+    job = Column('job', Text(), nullable=False)
+    # Number of chunks confirmed by Opencast
+    chunks = Column('chunks', Integer(), nullable=False, default=0)
+
 
 class ServiceStates(Base):
     '''List of internal service states.'''
@@ -234,6 +380,13 @@ class UpstreamState(Base):
     __tablename__ = 'upstream_state'
     url = Column('url', Text(), primary_key=True)
     last_synced = Column('last_synced', DateTime())
+    calendar_etag = Column('calendar_etag', Text(), nullable=True)
+    calendar_last_modified = Column('calendar_last_modified', Text(),
+                                    nullable=True)
+    calendar_hash = Column('calendar_hash', Text(), nullable=True)
+    agent_state = Column('agent_state', Text(), nullable=True)
+    agent_state_sent = Column('agent_state_sent', DateTime(), nullable=True)
+    lease = Column('lease', DateTime(), nullable=True)
 
     @staticmethod
     def update_sync_time(url):
@@ -241,3 +394,156 @@ class UpstreamState(Base):
         s.merge(UpstreamState(url=url, last_synced=datetime.utcnow()))
         s.commit()
         s.close()
+
+    @staticmethod
+    def acquire_lease(url, duration):
+        '''Try to get the exclusive right to update the state of an upstream
+        resource. This makes sure that only one pyCA process at a time
+        requests the resource. Leases expire after a given time in case the
+        holding process dies.
+
+        :param url: URL of the resource
+        :param duration: Number of seconds after which the lease expires
+        :return: True if the lease has been acquired
+        '''
+        now = datetime.utcnow()
+        s = get_session()
+        try:
+            acquired = s.query(UpstreamState)\
+                        .filter(UpstreamState.url == url)\
+                        .filter(or_(UpstreamState.lease.is_(None),
+                                    UpstreamState.lease < now))\
+                        .update({'lease': now + timedelta(seconds=duration)},
+                                synchronize_session=False)
+            if not acquired \
+                    and not s.query(UpstreamState).filter(
+                        UpstreamState.url == url).count():
+                s.add(UpstreamState(
+                    url=url,
+                    lease=now + timedelta(seconds=duration)))
+                acquired = True
+            s.commit()
+        except IntegrityError:
+            # State was created concurrently by another process
+            s.rollback()
+            acquired = False
+        finally:
+            s.close()
+        return bool(acquired)
+
+    @staticmethod
+    def release_lease(url):
+        '''Release a lease acquired with :func:`acquire_lease`.
+
+        :param url: URL of the resource
+        '''
+        s = get_session()
+        s.query(UpstreamState)\
+         .filter(UpstreamState.url == url)\
+         .update({'lease': None}, synchronize_session=False)
+        s.commit()
+        s.close()
+
+
+class ServiceEndpoint(Base):
+    '''Endpoint of an Opencast service as announced by the service registry
+    together with statistics about its health.'''
+    __tablename__ = 'service_endpoint'
+    type = Column('type', Text(), primary_key=True)
+    url = Column('url', Text(), primary_key=True)
+    latency = Column('latency', Float(), nullable=True)
+    failures = Column('failures', Integer(), nullable=False, default=0)
+    last_failure = Column('last_failure', DateTime(), nullable=True)
+    error_rate = Column('error_rate', Float(), nullable=True)
+    throughput = Column('throughput', Float(), nullable=True)
+    throughput_updated = Column('throughput_updated', DateTime(),
+                                nullable=True)
+    selected = Column('selected', DateTime(), nullable=True)
+
+    def penalized(self, now=None):
+        '''Check if the endpoint failed recently. The time an endpoint is
+        penalized for doubles with every consecutive failure.
+
+        :param now: Current time
+        :return: True if the endpoint should be avoided
+        '''
+        if not self.failures or not self.last_failure:
+            return False
+        penalty = min(60 * 2 ** (self.failures - 1), 3600)
+        age = ((now or datetime.utcnow()) - self.last_failure).total_seconds()
+        return age < penalty
+
+
+# Upper bounds of the capture latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Statistic(Base):
+    '''Counters and gauges shared between the pyCA processes.'''
+    __tablename__ = 'statistic'
+    name = Column('name', Text(), primary_key=True)
+    label = Column('label', Text(), primary_key=True, default='')
+    value = Column('value', Float(), nullable=False, default=0)
+
+    @staticmethod
+    def increase(values, label=''):
+        '''Increase several counters with the same label.
+
+        :param values: Dictionary mapping counter names to increments
+        :param label: Label of the counters
+        '''
+        Statistic.increase_labeled({(name, label): value
+                                    for name, value in values.items()})
+
+    @staticmethod
+    def increase_labeled(values):
+        '''Increase several counters with different labels at once.
+
+        :param values: Dictionary mapping tuples of counter name and label to
+                       increments
+        '''
+        s = get_session()
+        try:
+            for attempt in (1, 2):
+                for (name, label), value in values.items():
+                    counter = s.query(Statistic)\
+                               .filter(Statistic.name == name)\
+                               .filter(Statistic.label == label)
+                    if not counter.update({'value': Statistic.value + value}):
+                        s.add(Statistic(name=name, label=label, value=value))
+                try:
+                    s.commit()
+                    return
+                except IntegrityError:
+                    # Counter was created concurrently by another process
+                    s.rollback()
+                    if attempt == 2:
+                        raise
+        finally:
+            s.close()
+
+    @staticmethod
+    def observe(name, value, buckets):
+        '''Add a value to a histogram. Histograms are stored as counters of
+        the number and the sum of all values and of the cumulative number of
+        values in each bucket, labeled by the upper bound of the bucket.
+        Buckets which no value fell into have no counter.
+
+        :param name: Name of the histogram
+        :param value: Observed value
+        :param buckets: Upper bounds of the buckets
+        '''
+        values = {(name + '_count', ''): 1, (name + '_sum', ''): value}
+        for bound in buckets:
+            if value <= bound:
+                values[(name + '_bucket', str(bound))] = 1
+        Statistic.increase_labeled(values)
+
+    @staticmethod
+    def update(name, value, label=''):
+        '''Set a gauge to a given value.
+        '''
+        s = get_session()
+        s.merge(Statistic(name=name, label=label, value=value))
+        s.commit()
+        s.close()
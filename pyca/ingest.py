@@ -9,19 +9,51 @@
 
 from pyca.config import config
 from pyca.db import get_session, RecordedEvent, Status, Service, ServiceStatus
-from pyca.utils import http_request, service, set_service_status
+from pyca.db import Statistic, TrackUpload
+from pyca.utils import http_request, select_endpoint, set_service_status
 from pyca.utils import set_service_status_immediate, recording_state
-from pyca.utils import update_event_status, terminate
+from pyca.utils import update_event_status, terminate, backoff
+from pyca.utils import cached_service
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from urllib.parse import quote as urlquote, urlsplit
+from xml.etree import ElementTree  # nosec B405
+import functools
+import hashlib
+import json
 import logging
+import mmap
+import os.path
 import pycurl
 import random
 import sdnotify
 import shutil
+import threading
 import time
+import uuid
 
 logger = logging.getLogger(__name__)
 notify = sdnotify.SystemdNotifier()
 
+# Number of seconds after which a recording is uploaded by another worker if
+# the lease on it is not renewed
+INGEST_LEASE = 60
+
+# Maximum number of seconds between two attempts to upload a recording
+RETRY_DELAY_MAX = 3600
+
+# Chunk size used for uploading segments if no chunk size is configured
+SEGMENT_CHUNK_SIZE = 10000000
+
+# Dublin Core catalogs which can be sent along with a single request ingest
+SINGLE_REQUEST_CATALOGS = ('episode', 'series')
+
+# Tracks reserved for uploading by a thread of the ingest service
+_uploading = set()
+_uploading_condition = threading.Condition()
+
 
 def get_config_params(properties):
     '''Extract the set of configuration parameters from the properties attached
@@ -39,32 +71,18 @@ def get_config_params(properties):
     return wdef, param
 
 
-def ingest(event):
-    '''Ingest a finished recording to the Opencast server.
-    '''
-    # Update status
-    set_service_status(Service.INGEST, ServiceStatus.BUSY)
-    notify.notify('STATUS=Uploading')
-    recording_state(event.uid, 'uploading')
-    update_event_status(event, Status.UPLOADING)
-
-    # Select ingest service
-    # The ingest service to use is selected at random from the available
-    # ingest services to ensure that not every capture agent uses the same
-    # service at the same time
-    service_url = service('ingest', force_update=True)
-    # nosec: we do not need a secure random number here
-    service_url = service_url[random.randrange(0, len(service_url))]  # nosec
-    logger.info('Selecting ingest service to use: ' + service_url)
-
-    # create mediapackage
-    logger.info('Creating new mediapackage')
-    mediapackage = http_request(service_url + '/createMediaPackage', timeout=0)
+def get_catalogs(event):
+    '''Get the workflow configuration and the Dublin Core catalogs to
+    upload from the attachments of an event.
 
-    # extract workflow_def, workflow_config and add DC catalogs
+    :param event: Event to get the attachments from
+    :return: Tuple of the workflow definition, the workflow configuration and
+             a list of catalog name and data tuples
+    '''
+    workflow_def, workflow_config, catalogs = None, [], []
     prop = 'org.opencastproject.capture.agent.properties'
     dcns = 'http://www.opencastproject.org/xsd/1.0/dublincore/'
-    for attachment in event.get_data().get('attach'):
+    for attachment in event.get_attachments():
         data = attachment.get('data')
         if attachment.get('x-apple-filename') == prop:
             workflow_def, workflow_config = get_config_params(data)
@@ -74,50 +92,806 @@ def ingest(event):
                 and dcns in data \
                 and config('ingest', 'upload_catalogs'):
             name = attachment.get('x-apple-filename', '').rsplit('.', 1)[0]
-            logger.info('Adding %s DC catalog', name)
-            fields = [('mediaPackage', mediapackage),
-                      ('flavor', 'dublincore/%s' % name),
-                      ('dublinCore', data.encode('utf-8'))]
-            mediapackage = http_request(service_url + '/addDCCatalog', fields,
-                                        timeout=0)
+            catalogs.append((name, data))
 
         else:
             logger.info('Not uploading %s', attachment.get('x-apple-filename'))
-            continue
+    return workflow_def, workflow_config, catalogs
 
-    # add track
-    for (flavor, track) in event.get_tracks():
-        logger.info('Adding track (%s -> %s)', flavor, track)
-        track = track.encode('ascii', 'ignore')
-        fields = [('mediaPackage', mediapackage), ('flavor', flavor),
-                  ('BODY1', (pycurl.FORM_FILE, track))]
-        mediapackage = http_request(service_url + '/addTrack', fields,
-                                    timeout=0)
 
-    # ingest
-    logger.info('Ingest recording')
-    fields = [('mediaPackage', mediapackage)]
-    if workflow_def:
-        fields.append(('workflowDefinitionId', workflow_def))
+def ingest(event):
+    '''Ingest a finished recording to the Opencast server.
+    '''
+    # Update status
+    recording_state(event.uid, 'uploading')
+    update_event_status(event, Status.UPLOADING)
+
+    # Select ingest service
+    # The ingest service to use is selected based on the configured strategy
+    # from the available ingest services
+    service_url = select_endpoint('ingest')
+    logger.info('Selecting ingest service to use: ' + service_url)
+
+    tracks = event.get_tracks()
+    progress = UploadProgress(event, tracks)
+    workflow_def, workflow_config, catalogs = get_catalogs(event)
+    workflow_config = list(workflow_config)
     if event.uid:
-        fields.append(('workflowInstanceId',
-                       event.uid.encode('ascii', 'ignore')))
-    fields += workflow_config
-    mediapackage = http_request(service_url + '/ingest', fields, timeout=0)
+        workflow_config.append(('workflowInstanceId',
+                                event.uid.encode('ascii', 'ignore')))
+    if config('capture', 'segmented'):
+        # The segments need to be concatenated by Opencast before the
+        # scheduled workflow can process the recording
+        if workflow_def:
+            workflow_config.append(('scheduledWorkflowDefinitionId',
+                                    workflow_def))
+        workflow_def = config('ingest', 'segment_workflow')
+
+    # Wait for segments which are still being uploaded in the background
+    with reserve_tracks([track for _, track in tracks]):
+        upload(service_url, tracks, catalogs, workflow_def, workflow_config,
+               progress)
 
     # Update status
     recording_state(event.uid, 'upload_finished')
     update_event_status(event, Status.FINISHED_UPLOADING)
+    reset_retries(event)
+    remove_track_uploads(event)
     if config('ingest', 'delete_after_upload'):
         directory = event.directory()
         logger.info("Removing uploaded event directory %s", directory)
         shutil.rmtree(directory)
-    notify.notify('STATUS=Running')
-    set_service_status_immediate(Service.INGEST, ServiceStatus.IDLE)
 
     logger.info('Finished ingest')
 
 
+def upload(service_url, tracks, catalogs, workflow_def, workflow_config,
+           progress=None):
+    '''Ingest a recording with a single request if configured and possible
+    or step by step otherwise.
+
+    :param service_url: Location of the ingest service to use
+    :param tracks: List of flavor and file path tuples
+    :param catalogs: List of Dublin Core catalog name and data tuples
+    :param workflow_def: Identifier of the workflow definition to start
+    :param workflow_config: List of additional form fields
+    :param progress: UploadProgress object to report the progress to
+    '''
+    ingested = False
+    single_request = config('ingest', 'single_request')
+    unsupported = [name for name, _ in catalogs
+                   if name not in SINGLE_REQUEST_CATALOGS]
+    if single_request and unsupported:
+        logger.info('Using step by step ingest to upload the %s catalogs',
+                    ', '.join(unsupported))
+    elif single_request:
+        try:
+            ingest_single_request(service_url, tracks, catalogs,
+                                  workflow_def, workflow_config, progress)
+            ingested = True
+        except pycurl.error as e:
+            # Older Opencast versions may not support the endpoint
+            if getattr(e, 'status', None) not in (404, 405):
+                raise
+            logger.warning('Single request ingest failed (%s). Falling back '
+                           'to step by step ingest.', e)
+    if not ingested:
+        ingest_step_by_step(service_url, tracks, catalogs, workflow_def,
+                            workflow_config, progress)
+
+
+@contextmanager
+def reserve_tracks(tracks):
+    '''Reserve tracks for uploading them, waiting until no other thread is
+    uploading any of them.
+
+    :param tracks: List of file paths
+    '''
+    with _uploading_condition:
+        _uploading_condition.wait_for(lambda: _uploading.isdisjoint(tracks))
+        _uploading.update(tracks)
+    try:
+        yield
+    finally:
+        with _uploading_condition:
+            _uploading.difference_update(tracks)
+            _uploading_condition.notify_all()
+
+
+def chunk_size():
+    '''Get the size of the chunks to upload tracks in. Segments are always
+    uploaded in chunks, so that an upload interrupted by the end of the
+    recording can be resumed.
+
+    :return: Chunk size in bytes or 0 to upload tracks in a single request
+    '''
+    size = config('ingest', 'chunk_size')
+    if config('capture', 'segmented'):
+        return size or SEGMENT_CHUNK_SIZE
+    return size
+
+
+def ingest_step_by_step(service_url, tracks, catalogs, workflow_def,
+                        workflow_config, progress=None):
+    '''Ingest a recording by creating a mediapackage and adding catalogs and
+    tracks one request at a time.
+
+    :param service_url: Location of the ingest service to use
+    :param tracks: List of flavor and file path tuples
+    :param catalogs: List of Dublin Core catalog name and data tuples
+    :param workflow_def: Identifier of the workflow definition to start
+    :param workflow_config: List of additional form fields
+    :param progress: UploadProgress object to report the progress to
+    '''
+    # create mediapackage
+    logger.info('Creating new mediapackage')
+    mediapackage = http_request(service_url + '/createMediaPackage', timeout=0)
+
+    # add DC catalogs
+    for name, data in catalogs:
+        logger.info('Adding %s DC catalog', name)
+        fields = [('mediaPackage', mediapackage),
+                  ('flavor', 'dublincore/%s' % name),
+                  ('dublinCore', data.encode('utf-8'))]
+        mediapackage = http_request(service_url + '/addDCCatalog', fields,
+                                    timeout=0)
+
+    # add track
+    mediapackage = add_tracks(service_url, mediapackage, tracks, progress)
+
+    # ingest
+    logger.info('Ingest recording')
+    fields = [('mediaPackage', mediapackage)]
+    if workflow_def:
+        fields.append(('workflowDefinitionId', workflow_def))
+    fields += workflow_config
+    http_request(service_url + '/ingest', fields, timeout=0)
+
+
+def ingest_single_request(service_url, tracks, catalogs, workflow_def,
+                          workflow_config, progress=None):
+    '''Ingest a recording with a single request, letting Opencast create the
+    mediapackage from the catalogs and tracks sent along. Tracks larger than
+    the configured chunk size are uploaded in chunks first and only
+    referenced in the request.
+
+    :param service_url: Location of the ingest service to use
+    :param tracks: List of flavor and file path tuples
+    :param catalogs: List of Dublin Core catalog name and data tuples. Only
+                     episode and series catalogs are supported.
+    :param workflow_def: Identifier of the workflow definition to start
+    :param workflow_config: List of additional form fields
+    :param progress: UploadProgress object to report the progress to
+    '''
+    def report(sent, total):
+        for index, track_sent in zip(streamed, body.sent(sent)):
+            progress.update(index, track_sent)
+
+    fields, streamed = [], []
+    size = chunk_size()
+    for index, (flavor, track) in enumerate(tracks):
+        fields.append(('flavor', flavor))
+        url = uploaded_url(track)
+        if url:
+            fields.append(('mediaUri', url))
+        elif size and os.path.getsize(track) > size:
+            report_chunk = progress and functools.partial(progress.update,
+                                                          index)
+            url = upload_chunked(service_url, track, size, report_chunk)
+            fields.append(('mediaUri', url))
+        else:
+            fields.append(('BODY', (pycurl.FORM_FILE, track)))
+            streamed.append(index)
+    for name, data in catalogs:
+        if name not in SINGLE_REQUEST_CATALOGS:
+            raise ValueError(f'Cannot ingest {name} catalog with a single '
+                             'request')
+        fields.append((name + 'DCCatalog', data))
+    fields += workflow_config
+
+    url = service_url + '/addMediaPackage'
+    if workflow_def:
+        url += '/' + urlquote(workflow_def)
+    logger.info('Ingest recording with a single request')
+    # Opencast creates the mediapackage, there is nothing to attach a
+    # checksum to. Hence, tracks are not hashed.
+    with TrackStream(fields) as body:
+        http_request(url, timeout=0, progress=report if progress else None,
+                     body=body)
+    if progress:
+        for index in range(len(tracks)):
+            progress.finish(index)
+
+
+class UploadProgress():
+    '''Upload progress of the tracks of a recording. The progress is stored
+    in the database at a limited rate to make it available to the other pyCA
+    services.
+    '''
+
+    # Minimum number of seconds between two database updates
+    INTERVAL = 1.0
+
+    def __init__(self, event, tracks):
+        self.event = event
+        self.tracks = [{'flavor': flavor,
+                        'file': os.path.basename(track),
+                        'sent': 0,
+                        'total': os.path.getsize(track),
+                        'rate': None,
+                        'eta': None}
+                       for flavor, track in tracks]
+        self.samples = [(time.monotonic(), 0)] * len(tracks)
+        self.stored = 0
+        self.lock = threading.Lock()
+
+    def update(self, index, sent):
+        '''Update the number of bytes of a track which have been uploaded.
+        The rate is measured over intervals of at least one second.
+
+        :param index: Index of the track
+        :param sent: Number of bytes uploaded
+        '''
+        now = time.monotonic()
+        with self.lock:
+            track = self.tracks[index]
+            track['sent'] = sent = min(sent, track['total'])
+            last_time, last_sent = self.samples[index]
+            if now - last_time >= self.INTERVAL:
+                track['rate'] = (sent - last_sent) / (now - last_time)
+                track['eta'] = (track['total'] - sent) / track['rate'] \
+                    if track['rate'] else None
+                self.samples[index] = (now, sent)
+            if now - self.stored < self.INTERVAL:
+                return
+            self.stored = now
+        self.store()
+
+    def finish(self, index):
+        '''Mark a track as uploaded completely.
+
+        :param index: Index of the track
+        '''
+        with self.lock:
+            track = self.tracks[index]
+            track['sent'] = track['total']
+            track['eta'] = 0
+        Statistic.increase({'ingest_uploaded_bytes': track['total']})
+        self.store()
+
+    def store(self):
+        '''Store the current progress in the database.
+        '''
+        with self.lock:
+            progress = json.dumps(self.tracks)
+        try:
+            session = get_session()
+            session.query(RecordedEvent)\
+                   .filter(RecordedEvent.uid == self.event.uid)\
+                   .filter(RecordedEvent.start == self.event.start)\
+                   .update({'upload_progress': progress},
+                           synchronize_session=False)
+            session.commit()
+            session.close()
+        except Exception:
+            logger.warning('Could not store upload progress', exc_info=True)
+
+
+def add_tracks(service_url, mediapackage, tracks, progress=None):
+    '''Add several tracks to a mediapackage. Depending on the configured
+    concurrency, tracks are uploaded in parallel. The mediapackages returned
+    for each track are merged afterwards.
+
+    :param service_url: Location of the ingest service to use
+    :param mediapackage: Mediapackage to add the tracks to
+    :param tracks: List of flavor and file path tuples
+    :param progress: UploadProgress object to report the progress to
+    :return: Updated mediapackage
+    '''
+    def upload(index, mediapackage):
+        flavor, track = tracks[index]
+        report = progress and functools.partial(progress.update, index)
+        mediapackage = add_track(service_url, mediapackage, flavor, track,
+                                 report)
+        if progress:
+            progress.finish(index)
+        return mediapackage
+
+    start = time.time()
+    concurrency = min(config('ingest', 'upload_concurrency'), len(tracks))
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = [executor.submit(upload, index, mediapackage)
+                       for index in range(len(tracks))]
+            results = [result.result() for result in results]
+        mediapackage = merge_mediapackages(mediapackage, results)
+    else:
+        for index in range(len(tracks)):
+            mediapackage = upload(index, mediapackage)
+
+    duration = max(time.time() - start, 0.001)
+    size = sum(os.path.getsize(track) for _, track in tracks)
+    logger.info('Uploaded %i tracks (%.1f MB) in %.1f seconds (%.1f MB/s)',
+                len(tracks), size / 1e6, duration, size / 1e6 / duration)
+    return mediapackage
+
+
+def merge_mediapackages(mediapackage, results):
+    '''Merge the tracks of several mediapackages which have been created by
+    adding tracks to the same mediapackage independently. Tracks are added
+    in the order of the given results.
+
+    :param mediapackage: Mediapackage all tracks have been added to
+    :param results: List of mediapackages with added tracks
+    :return: Merged mediapackage
+    '''
+    # nosec: the mediapackages are created by Opencast
+    merged = ElementTree.fromstring(mediapackage)  # nosec B314
+    namespace = merged.tag[:-len('mediapackage')]
+    if namespace:
+        ElementTree.register_namespace('', namespace.strip('{}'))
+    media = merged.find(namespace + 'media')
+    if media is None:
+        media = ElementTree.SubElement(merged, namespace + 'media')
+    known = {track.get('id') for track in media}
+    for result in results:
+        # nosec: the mediapackages are created by Opencast
+        result = ElementTree.fromstring(result)  # nosec B314
+        for track in result.iterfind(f'{namespace}media/{namespace}track'):
+            if track.get('id') not in known:
+                known.add(track.get('id'))
+                media.append(track)
+    return ElementTree.tostring(merged, encoding='utf-8')
+
+
+def add_track(service_url, mediapackage, flavor, track, progress=None):
+    '''Add a track to a mediapackage. Tracks larger than the configured chunk
+    size are uploaded in chunks first.
+
+    :param service_url: Location of the ingest service to use
+    :param mediapackage: Mediapackage to add the track to
+    :param flavor: Flavor of the track
+    :param track: Path of the file to add
+    :param progress: Function called with the number of bytes uploaded
+    :return: Updated mediapackage
+    '''
+    def report(sent, total):
+        progress(sent)
+
+    logger.info('Adding track (%s -> %s)', flavor, track)
+    size = chunk_size()
+    url = uploaded_url(track)
+    if url:
+        logger.info('Track %s has already been uploaded', track)
+        fields = [('mediaPackage', mediapackage), ('flavor', flavor),
+                  ('url', url)]
+        progress = None
+    elif size and os.path.getsize(track) > size:
+        url = upload_chunked(service_url, track, size, progress)
+        fields = [('mediaPackage', mediapackage), ('flavor', flavor),
+                  ('url', url)]
+        # Nothing to report when adding the uploaded file
+        progress = None
+    elif config('ingest', 'streaming_upload'):
+        return stream_track(service_url, mediapackage, flavor, track,
+                            progress)
+    else:
+        track = track.encode('ascii', 'ignore')
+        fields = [('mediaPackage', mediapackage), ('flavor', flavor),
+                  ('BODY1', (pycurl.FORM_FILE, track))]
+    return http_request(service_url + '/addTrack', fields, timeout=0,
+                        progress=report if progress else None)
+
+
+def stream_track(service_url, mediapackage, flavor, track, progress=None):
+    '''Add a track to a mediapackage, streaming the file from memory and
+    calculating its checksum in the same pass. The checksum is added to the
+    track in the returned mediapackage.
+
+    :param service_url: Location of the ingest service to use
+    :param mediapackage: Mediapackage to add the track to
+    :param flavor: Flavor of the track
+    :param track: Path of the file to add
+    :param progress: Function called with the number of bytes uploaded
+    :return: Updated mediapackage
+    '''
+    def report(sent, total):
+        progress(body.sent(sent)[0])
+
+    fields = [('mediaPackage', mediapackage), ('flavor', flavor),
+              ('BODY1', (pycurl.FORM_FILE, track))]
+    algorithm = config('ingest', 'checksum')
+    with TrackStream(fields, algorithm) as body:
+        result = http_request(service_url + '/addTrack', timeout=0,
+                              progress=report if progress else None,
+                              body=body)
+        checksum, = body.checksums()
+    logger.debug('%s checksum of %s is %s', algorithm, track, checksum)
+    return set_track_checksum(mediapackage, result, algorithm, checksum)
+
+
+class TrackStream():
+    '''Multipart form data request body containing files. Fields are
+    specified like for pycurl's HTTPPOST with files given as
+    `(pycurl.FORM_FILE, path)`. Files are memory mapped and, if a hash
+    algorithm is given, hashed while they are read by libcurl, so that each
+    file is read from disk only once.
+    '''
+
+    def __init__(self, fields, algorithm=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self.algorithm = algorithm
+        # Body parts and the index of the file each part belongs to
+        self.parts = []
+        self.indexes = []
+        # Offset and size of each file within the body
+        self.files = []
+        self.handles = []
+        head = b''
+        for name, value in fields:
+            if isinstance(value, tuple) and value[0] == pycurl.FORM_FILE:
+                filename = os.path.basename(value[1])
+                head += self.part(name, b'', filename)[:-2]
+                self.append(head)
+                data = self.open(value[1])
+                self.files.append((self.size, len(data)))
+                self.append(data, len(self.files) - 1)
+                head = b'\r\n'
+            else:
+                head += self.part(name, value)
+        self.append(head + f'--{self.boundary}--\r\n'.encode())
+        self.seek(0, os.SEEK_SET)
+
+    @property
+    def size(self):
+        return sum(len(part) for part in self.parts)
+
+    def append(self, data, index=None):
+        self.parts.append(data)
+        self.indexes.append(index)
+
+    def open(self, path):
+        '''Memory map a file.
+        '''
+        f = open(path, 'rb')
+        self.handles.append(f)
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        self.handles.append(data)
+        return data
+
+    def part(self, name, value, filename=None):
+        '''Encode a form field.
+        '''
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            filename = filename.encode('ascii', 'ignore').decode()
+            disposition += '; filename="%s"\r\n' \
+                'Content-Type: application/octet-stream' \
+                % filename.replace('"', '%22')
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        return (f'--{self.boundary}\r\n'
+                f'Content-Disposition: {disposition}\r\n\r\n').encode() \
+            + value + b'\r\n'
+
+    def read(self, size):
+        '''Read the next part of the request body. Used as libcurl read
+        callback.
+        '''
+        start = self.position
+        for part, index in zip(self.parts, self.indexes):
+            if start < len(part):
+                break
+            start -= len(part)
+        else:
+            return b''
+        data = part[start:start + size]
+        if index is not None and self.algorithm:
+            self.hashes[index].update(data)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, origin):
+        '''Rewind the request body if libcurl needs to send it again. Used
+        as libcurl seek callback.
+        '''
+        if offset or origin != os.SEEK_SET:
+            return pycurl.SEEKFUNC_CANTSEEK
+        self.position = 0
+        if self.algorithm:
+            self.hashes = [hashlib.new(self.algorithm) for _ in self.files]
+        return pycurl.SEEKFUNC_OK
+
+    def sent(self, sent):
+        '''Get the number of bytes sent of each file.
+
+        :param sent: Number of bytes of the body sent
+        :return: List of the number of bytes sent for each file
+        '''
+        return [min(max(sent - offset, 0), size)
+                for offset, size in self.files]
+
+    def checksums(self):
+        '''Get the checksums of the files. Only valid once the whole body
+        has been read.
+        '''
+        if not self.algorithm:
+            raise RuntimeError('Tracks are not hashed')
+        if self.position != self.size:
+            raise RuntimeError('Tracks were not read completely')
+        return [checksum.hexdigest() for checksum in self.hashes]
+
+    def close(self):
+        for handle in reversed(self.handles):
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def set_track_checksum(mediapackage, result, algorithm, checksum):
+    '''Add the checksum of a new track to a mediapackage. If Opencast has
+    already calculated a checksum of the same type, it has to match.
+
+    :param mediapackage: Mediapackage the track has been added to
+    :param result: Mediapackage returned by Opencast after adding the track
+    :param algorithm: Name of the hash algorithm
+    :param checksum: Hex encoded checksum of the track
+    :return: Mediapackage with checksum
+    '''
+    checksum_type = {'sha256': 'sha-256'}.get(algorithm, algorithm)
+    # nosec: the mediapackages are created by Opencast
+    result = ElementTree.fromstring(result)  # nosec B314
+    namespace = result.tag[:-len('mediapackage')]
+    if namespace:
+        ElementTree.register_namespace('', namespace.strip('{}'))
+    path = f'{namespace}media/{namespace}track'
+    known = set()
+    if mediapackage:
+        mediapackage = ElementTree.fromstring(mediapackage)  # nosec B314
+        known = {track.get('id') for track in mediapackage.iterfind(path)}
+    for track in result.iterfind(path):
+        if track.get('id') in known:
+            continue
+        element = track.find(namespace + 'checksum')
+        if element is not None and element.get('type') == checksum_type:
+            if element.text != checksum:
+                raise RuntimeError(f'Checksum mismatch for track '
+                                   f'{track.get("id")}: {element.text} '
+                                   f'(Opencast) != {checksum} (local)')
+            continue
+        if element is not None:
+            track.remove(element)
+        element = ElementTree.Element(namespace + 'checksum',
+                                      {'type': checksum_type})
+        element.text = checksum
+        # Keep the order of elements expected by Opencast
+        url = track.find(namespace + 'url')
+        position = len(track) if url is None else list(track).index(url) + 1
+        track.insert(position, element)
+    return ElementTree.tostring(result, encoding='utf-8')
+
+
+def upload_chunked(service_url, track, chunk_size, progress=None):
+    '''Upload a file in chunks using the upload service of the Opencast node
+    running the selected ingest service. The progress is stored in the
+    database after each chunk so that an interrupted upload can be resumed
+    later, even after a restart.
+
+    :param service_url: Location of the ingest service to use
+    :param track: Path of the file to upload
+    :param chunk_size: Size of the chunks in bytes
+    :param progress: Function called with the number of bytes uploaded
+    :return: URL of the uploaded file in Opencast
+    '''
+    def report(sent, total):
+        # The request contains some form data in addition to the chunk
+        progress(chunk * chunk_size + min(sent, len(data)))
+
+    size = os.path.getsize(track)
+    chunks = -(-size // chunk_size)
+    job_url, chunk = resumable_upload(track, size, chunk_size)
+    if job_url:
+        logger.info('Resuming upload of %s from chunk %i of %i',
+                    track, chunk, chunks)
+    else:
+        job_url = create_upload_job(service_url, track, size, chunk_size)
+        save_upload_progress(track, size, chunk_size, job_url, chunk)
+
+    endpoint = upload_endpoint(job_url)
+    with open(track, 'rb') as f:
+        f.seek(chunk * chunk_size)
+        while chunk < chunks:
+            logger.debug('Uploading chunk %i of %i of %s',
+                         chunk, chunks, track)
+            data = f.read(chunk_size)
+            fields = [('chunknumber', str(chunk)),
+                      ('filedata', (pycurl.FORM_BUFFER,
+                                    os.path.basename(track),
+                                    pycurl.FORM_BUFFERPTR, data))]
+            http_request(job_url, fields, timeout=0,
+                         progress=report if progress else None,
+                         endpoint=endpoint)
+            chunk += 1
+            save_upload_progress(track, size, chunk_size, job_url, chunk)
+
+    # Opencast may need a moment to assemble the file
+    for attempt in range(10):
+        job = get_upload_job(job_url)
+        if job and job.get('state') == 'COMPLETE':
+            return job['payload']['url']
+        time.sleep(attempt)
+    raise RuntimeError(f'Upload of {track} did not complete')
+
+
+def resumable_upload(track, size, chunk_size):
+    '''Find an unfinished upload job for a file.
+
+    :return: Tuple of the upload job URL and the next chunk to upload or
+             (None, 0) if there is no job to resume.
+    '''
+    session = get_session()
+    upload = session.query(TrackUpload)\
+                    .filter(TrackUpload.path == track)\
+                    .filter(TrackUpload.size == size)\
+                    .filter(TrackUpload.chunk_size == chunk_size)\
+                    .first()
+    job_url = upload.job if upload else None
+    session.close()
+    job = get_upload_job(job_url) if job_url else None
+    if not job:
+        return None, 0
+    # Opencast knows best which chunks it has received
+    return job_url, job['current-chunk']['number'] + 1
+
+
+def uploaded_url(track):
+    '''Get the location of a file which has already been uploaded to
+    Opencast's upload service completely, e.g. a segment uploaded while the
+    recording was still running.
+
+    :param track: Path of the file
+    :return: URL of the uploaded file or None if it was not uploaded yet
+    '''
+    size = os.path.getsize(track)
+    session = get_session()
+    upload = session.query(TrackUpload)\
+                    .filter(TrackUpload.path == track)\
+                    .filter(TrackUpload.size == size)\
+                    .filter(TrackUpload.chunks * TrackUpload.chunk_size
+                            >= size)\
+                    .first()
+    job_url = upload.job if upload else None
+    session.close()
+    job = get_upload_job(job_url) if job_url else None
+    if not job or job.get('state') != 'COMPLETE':
+        return None
+    return job['payload']['url']
+
+
+def upload_segments():
+    '''Upload the finished segments of running recordings to the upload
+    service, so that only the last segment is left to upload once the
+    recording has ended. Uploaded segments are later added to the recording
+    by reference.
+    '''
+    session = get_session()
+    events = session.query(RecordedEvent)\
+                    .filter(RecordedEvent.status == Status.RECORDING)\
+                    .all()
+    session.expunge_all()
+    session.close()
+    if not events:
+        return
+    service_url = select_endpoint('ingest')
+    for event in events:
+        for _, track in event.get_tracks():
+            # Leave the segments to the ingest once the recording ended
+            with reserve_tracks([track]):
+                if recording(event) and not uploaded_url(track):
+                    logger.info('Uploading segment %s', track)
+                    upload_chunked(service_url, track, chunk_size())
+
+
+def recording(event):
+    '''Check if a recording is still running.
+    '''
+    session = get_session()
+    status = session.query(RecordedEvent.status)\
+                    .filter(RecordedEvent.uid == event.uid)\
+                    .filter(RecordedEvent.start == event.start)\
+                    .scalar()
+    session.close()
+    return status == Status.RECORDING
+
+
+def safe_upload_segments():
+    '''Upload finished segments but make sure to catch any errors, log them
+    but otherwise ignore them. Failed uploads are resumed in the next run.
+    '''
+    try:
+        upload_segments()
+    except Exception:
+        logger.exception('Could not upload segments')
+
+
+def save_upload_progress(track, size, chunk_size, job_url, chunks):
+    '''Store the number of chunks of a file confirmed by Opencast.
+    '''
+    session = get_session()
+    session.merge(TrackUpload(path=track, size=size, chunk_size=chunk_size,
+                              job=job_url, chunks=chunks))
+    session.commit()
+    session.close()
+
+
+def create_upload_job(service_url, track, size, chunk_size):
+    '''Create a new chunked upload job in Opencast.
+
+    :return: URL of the upload job
+    '''
+    upload_url = '%s://%s/upload' % urlsplit(service_url)[:2]
+    fields = [('filename', os.path.basename(track)),
+              ('filesize', str(size)),
+              ('chunksize', str(chunk_size))]
+    job_id = http_request(upload_url + '/newjob', fields,
+                          endpoint=service_url).decode('utf-8')
+    logger.info('Created upload job %s for %s', job_id, track)
+    return f'{upload_url}/job/{job_id.strip()}'
+
+
+def get_upload_job(job_url):
+    '''Get the state of an upload job.
+
+    :param job_url: URL of the upload job
+    :return: Dictionary describing the job or None if the job does not exist
+    '''
+    try:
+        response = http_request(job_url + '.json',
+                                endpoint=upload_endpoint(job_url))
+    except pycurl.error as e:
+        if e.args[0] != pycurl.E_HTTP_RETURNED_ERROR:
+            raise
+        logger.warning('Could not get upload job %s: %s', job_url, e)
+        return None
+    return json.loads(response.decode('utf-8')).get('uploadjob')
+
+
+def upload_endpoint(job_url):
+    '''Get the location of the ingest service running on the same Opencast
+    node as an upload job. Requests to the upload service are made for this
+    ingest service and count towards its health.
+
+    :param job_url: URL of the upload job
+    :return: Location of the ingest service or None if it is not known
+    '''
+    node = '%s://%s/' % urlsplit(job_url)[:2]
+    for endpoint in cached_service('org.opencastproject.ingest')[0]:
+        if (endpoint + '/').startswith(node):
+            return endpoint
+    return None
+
+
+def remove_track_uploads(event):
+    '''Remove the progress of chunked uploads of an event's tracks.
+    '''
+    paths = [track for _, track in event.get_tracks()]
+    session = get_session()
+    session.query(TrackUpload)\
+           .filter(TrackUpload.path.in_(paths))\
+           .delete(synchronize_session=False)
+    session.commit()
+    session.close()
+
+
 def safe_start_ingest(event):
     '''Start a capture process but make sure to catch any errors during this
     process, log them but otherwise ignore them.
@@ -129,7 +903,132 @@ def safe_start_ingest(event):
         # Update state if something went wrong
         recording_state(event.uid, 'upload_error')
         update_event_status(event, Status.FAILED_UPLOADING)
-        set_service_status_immediate(Service.INGEST, ServiceStatus.IDLE)
+        schedule_retry(event)
+
+
+def schedule_retry(event):
+    '''Schedule another upload attempt for a failed recording. The delay
+    between attempts grows exponentially until the configured maximum number
+    of attempts is reached.
+    '''
+    attempts = (event.attempts or 0) + 1
+    next_retry = None
+    if attempts < config('ingest', 'max_attempts'):
+        delay = backoff(attempts - 1, config('ingest', 'retry_delay'),
+                        RETRY_DELAY_MAX)
+        next_retry = datetime.utcnow() + timedelta(seconds=delay)
+        logger.info('Retrying upload of %s in %i seconds', event, delay)
+    else:
+        logger.error('Giving up uploading %s after %i attempts',
+                     event, attempts)
+    session = get_session()
+    session.query(RecordedEvent)\
+           .filter(RecordedEvent.uid == event.uid)\
+           .filter(RecordedEvent.start == event.start)\
+           .update({'attempts': attempts, 'next_retry': next_retry},
+                   synchronize_session=False)
+    session.commit()
+    session.close()
+    event.attempts = attempts
+    event.next_retry = next_retry
+
+
+def reset_retries(event):
+    '''Forget about failed upload attempts of a recording, e.g. once it has
+    been uploaded successfully.
+    '''
+    session = get_session()
+    session.query(RecordedEvent)\
+           .filter(RecordedEvent.uid == event.uid)\
+           .filter(RecordedEvent.start == event.start)\
+           .update({'attempts': None, 'next_retry': None},
+                   synchronize_session=False)
+    session.commit()
+    session.close()
+    event.attempts = None
+    event.next_retry = None
+
+
+def ingest_worker(event):
+    '''Ingest a recording after a random delay.
+    '''
+    # nosec: we do not need a secure random number here
+    delay = random.randint(config('ingest', 'delay_min'),  # nosec
+                           config('ingest', 'delay_max'))
+    logger.info("Delaying ingest for %s seconds", delay)
+    time.sleep(delay)
+    safe_start_ingest(event)
+
+
+def claimable(retries=False):
+    '''Get a filter for recordings waiting to be uploaded. This includes
+    recordings whose upload has been interrupted and whose lease expired.
+
+    :param retries: Get failed recordings due for a retry instead
+    '''
+    if retries:
+        return and_(RecordedEvent.status == Status.FAILED_UPLOADING,
+                    RecordedEvent.next_retry <= datetime.utcnow())
+    return or_(RecordedEvent.status == Status.FINISHED_RECORDING,
+               and_(RecordedEvent.status == Status.UPLOADING,
+                    or_(RecordedEvent.lease.is_(None),
+                        RecordedEvent.lease < datetime.utcnow())))
+
+
+def claim_next_event(retries=False):
+    '''Get the next recording to upload according to the configured priority
+    and lease it so that no other worker will pick it up.
+
+    :param retries: Get a failed recording due for a retry instead
+    :return: Leased recording or None if there is nothing to upload
+    '''
+    session = get_session()
+    try:
+        events = session.query(RecordedEvent).filter(claimable(retries))
+        priority = config('ingest', 'priority')
+        if priority == 'newest':
+            events = events.order_by(RecordedEvent.start.desc()).all()
+        elif priority == 'smallest':
+            events = sorted(events, key=lambda e: e.track_size())
+        else:
+            events = events.order_by(RecordedEvent.start).all()
+        for event in events:
+            claimed = session.query(RecordedEvent)\
+                             .filter(RecordedEvent.uid == event.uid)\
+                             .filter(RecordedEvent.start == event.start)\
+                             .filter(claimable(retries))\
+                             .update({'status': Status.UPLOADING,
+                                      'lease': lease_expiry()},
+                                     synchronize_session=False)
+            session.commit()
+            if claimed:
+                session.refresh(event)
+                session.expunge(event)
+                return event
+    finally:
+        session.close()
+
+
+def renew_leases(events):
+    '''Extend the leases of recordings which are being uploaded.
+    '''
+    if not events:
+        return
+    session = get_session()
+    for event in events:
+        session.query(RecordedEvent)\
+               .filter(RecordedEvent.uid == event.uid)\
+               .filter(RecordedEvent.start == event.start)\
+               .filter(RecordedEvent.status == Status.UPLOADING)\
+               .update({'lease': lease_expiry()}, synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+def lease_expiry():
+    '''Get the expiry date of a lease acquired now.
+    '''
+    return datetime.utcnow() + timedelta(seconds=INGEST_LEASE)
 
 
 def control_loop():
@@ -139,22 +1038,41 @@ def control_loop():
     set_service_status_immediate(Service.INGEST, ServiceStatus.IDLE)
     notify.notify('READY=1')
     notify.notify('STATUS=Running')
-    while not terminate():
-        notify.notify('WATCHDOG=1')
-        # Get next recording
-        session = get_session()
-        event = session.query(RecordedEvent)\
-                       .filter(RecordedEvent.status ==
-                               Status.FINISHED_RECORDING).first()
-        if event:
-            # nosec: we do not need a secure random number here
-            delay = random.randint(config('ingest', 'delay_min'),  # nosec
-                                   config('ingest', 'delay_max'))
-            logger.info("Delaying ingest for %s seconds", delay)
-            time.sleep(delay)
-            safe_start_ingest(event)
-        session.close()
-        time.sleep(1.0)
+    workers = config('ingest', 'workers')
+    active = {}
+    segments = None
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=1) as segment_executor:
+        while not terminate():
+            notify.notify('WATCHDOG=1')
+            renew_leases(active.values())
+
+            # Upload segments of running recordings in the background
+            if config('capture', 'segmented') \
+                    and (segments is None or segments.done()):
+                segments = segment_executor.submit(safe_upload_segments)
+            for future in [f for f in active if f.done()]:
+                del active[future]
+            busy = bool(active)
+
+            # Get next recordings. Retries may not occupy all workers to
+            # make sure that new recordings are not delayed by failing ones.
+            while len(active) < workers:
+                retries = len([e for e in active.values() if e.attempts])
+                event = claim_next_event()
+                if not event and retries < max(workers - 1, 1):
+                    event = claim_next_event(retries=True)
+                if not event:
+                    break
+                active[executor.submit(ingest_worker, event)] = event
+
+            if bool(active) != busy:
+                status = ServiceStatus.BUSY if active else ServiceStatus.IDLE
+                set_service_status_immediate(Service.INGEST, status)
+                notify.notify('STATUS=' + ('Uploading' if active
+                                           else 'Running'))
+            time.sleep(1.0)
+        logger.info('Waiting for %i uploads to finish', len(active))
     logger.info('Shutting down ingest service')
     set_service_status(Service.INGEST, ServiceStatus.STOPPED)
 
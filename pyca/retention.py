@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+'''
+    python-capture-agent
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: 2014-2017, Lars Kiesow <lkiesow@uos.de>
+    :license: LGPL – see license.lgpl for more details.
+'''
+
+from pyca.utils import set_service_status, timestamp, terminate
+from pyca.config import config
+from pyca.db import get_session, RecordedEvent, Status, Service, \
+                    ServiceStatus, Statistic
+import logging
+import os
+import os.path
+import sdnotify
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+notify = sdnotify.SystemdNotifier()
+
+
+def disk_usage():
+    '''Get the disk usage of the file system recordings are stored on. If the
+    capture directory does not exist, the parent directory is used.
+
+    :return: Tuple of total, used and free bytes
+    '''
+    directory = config('capture', 'directory')
+    if not os.path.exists(directory):
+        directory = os.path.abspath(os.path.join(directory, os.pardir))
+    return shutil.disk_usage(directory)
+
+
+def headroom():
+    '''Get the number of bytes which can be written before the high
+    watermark is reached. If no watermark is configured, this is the free
+    disk space.
+    '''
+    total, used, free = disk_usage()
+    high = config('retention', 'high_watermark')
+    if not high:
+        return free
+    return min(int(total * high / 100) - used, free)
+
+
+def directory_size(directory):
+    '''Get the size of all files in a directory and the time they were last
+    accessed or modified.
+
+    :return: Tuple of size in bytes and last usage as timestamp
+    '''
+    size, used = 0, 0
+    for path, _, files in os.walk(directory):
+        for name in files:
+            stat = os.stat(os.path.join(path, name))
+            size += stat.st_size
+            used = max(used, stat.st_atime, stat.st_mtime)
+    return size, used
+
+
+def eviction_candidates():
+    '''Get uploaded recordings whose files still exist in the order they
+    should be removed in.
+
+    :return: List of recordings
+    '''
+    session = get_session()
+    events = session.query(RecordedEvent)\
+                    .filter(RecordedEvent.status == Status.FINISHED_UPLOADING)\
+                    .order_by(RecordedEvent.start)\
+                    .all()
+    session.expunge_all()
+    session.close()
+    events = [event for event in events if os.path.isdir(event.directory())]
+    if config('retention', 'order') == 'lru':
+        events.sort(key=lambda event: directory_size(event.directory())[1])
+    return events
+
+
+def evict(free):
+    '''Remove the files of uploaded recordings until the requested amount of
+    disk space is free. Recordings which are not uploaded completely are
+    never removed.
+
+    :param free: Number of bytes which should be free afterwards
+    :return: Number of bytes freed
+    '''
+    freed, evicted = 0, 0
+    for event in eviction_candidates():
+        if disk_usage()[2] >= free:
+            break
+        # Make sure the recording has not been scheduled for another upload
+        session = get_session()
+        status = session.query(RecordedEvent.status)\
+                        .filter(RecordedEvent.uid == event.uid)\
+                        .filter(RecordedEvent.start == event.start)\
+                        .scalar()
+        session.close()
+        if status != Status.FINISHED_UPLOADING:
+            continue
+        directory = event.directory()
+        size = directory_size(directory)[0]
+        logger.info('Removing uploaded recording %s (%i bytes)',
+                    directory, size)
+        shutil.rmtree(directory)
+        freed += size
+        evicted += 1
+    if evicted:
+        Statistic.increase({'retention_freed_bytes': freed,
+                            'retention_evicted_recordings': evicted})
+    if disk_usage()[2] < free:
+        logger.warning('Could not free enough disk space. %i bytes are '
+                       'missing.', free - disk_usage()[2])
+    return freed
+
+
+def enforce_watermarks():
+    '''Remove uploaded recordings if the disk usage exceeds the high
+    watermark until it falls below the low watermark.
+
+    :return: Number of bytes freed
+    '''
+    high = config('retention', 'high_watermark')
+    if not high:
+        return 0
+    total, used, free = disk_usage()
+    if used <= total * high / 100:
+        return 0
+    low = min(config('retention', 'low_watermark'), high)
+    logger.info('Disk usage of %.1f%% exceeds high watermark of %i%%',
+                used * 100 / total, high)
+    return evict(free + used - int(total * low / 100))
+
+
+def control_loop():
+    '''Main loop of the retention service, regularly checking the disk usage
+    and removing uploaded recordings if necessary.
+    '''
+    set_service_status(Service.RETENTION, ServiceStatus.IDLE)
+    notify.notify('READY=1')
+    notify.notify('STATUS=Running')
+    while not terminate():
+        notify.notify('WATCHDOG=1')
+        set_service_status(Service.RETENTION, ServiceStatus.BUSY)
+        try:
+            freed = enforce_watermarks()
+            if freed:
+                logger.info('Freed %i bytes. Headroom is now %i bytes.',
+                            freed, headroom())
+        except Exception:
+            logger.exception('Could not enforce disk watermarks')
+        set_service_status(Service.RETENTION, ServiceStatus.IDLE)
+
+        next_check = timestamp() + config('retention', 'interval')
+        while not terminate() and timestamp() < next_check:
+            time.sleep(0.1)
+
+    logger.info('Shutting down retention service')
+    set_service_status(Service.RETENTION, ServiceStatus.STOPPED)
+
+
+def run():
+    '''Start the retention service.
+    '''
+    control_loop()
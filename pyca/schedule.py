@@ -10,14 +10,19 @@
 from pyca.utils import http_request, service, timestamp, terminate, \
                        set_service_status_immediate
 from pyca.config import config
-from pyca.db import get_session, UpcomingEvent, Service, ServiceStatus, \
-    UpstreamState, with_session
+from pyca.db import get_session, UpcomingEvent, RecordedEvent, Service, \
+    ServiceStatus, UpstreamState, Statistic, Attachment, with_session, \
+    attachment_hashes
 from base64 import b64decode
-from datetime import datetime
+from datetime import datetime, timezone
+import codecs
 import dateutil.parser
+import functools
+import hashlib
 import logging
 import pycurl
 import sdnotify
+import tempfile
 import time
 from urllib.parse import urlencode
 
@@ -25,22 +30,119 @@ logger = logging.getLogger(__name__)
 notify = sdnotify.SystemdNotifier()
 
 
-def parse_ical(vcal):
-    '''Parse Opencast schedule iCalendar file and return events as dict
+def _split_lines(chunks):
+    '''Split a stream of text or UTF-8 encoded chunks into lines separated
+    by CRLF. Empty lines are kept.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        lines = (buf + chunk).split('\r\n')
+        buf = lines.pop()
+        yield from lines
+    yield buf + decoder.decode(b'', final=True)
+
+
+def _unfold_lines(lines):
+    '''Join folded lines. A line starting with a space is appended to the
+    previous line without that space. This never applies to the very first
+    line.
     '''
-    vcal = vcal.replace('\r\n ', '').replace('\r\n\r\n', '\r\n')
-    vevents = vcal.split('\r\nBEGIN:VEVENT\r\n')
-    del vevents[0]
-    events = []
-    for vevent in vevents:
+    lines = iter(lines)
+    folded = [next(lines)]
+    for line in lines:
+        if line.startswith(' '):
+            folded.append(line[1:])
+            continue
+        # Joining lines may create new line breaks (e.g. `\r` + `\n`)
+        yield from ''.join(folded).split('\r\n')
+        folded = [line]
+    yield from ''.join(folded).split('\r\n')
+
+
+def _collapse_empty_lines(lines):
+    '''Reduce runs of line breaks to half of their length (rounded up) as if
+    every CRLF CRLF was replaced by a single CRLF.
+    '''
+    empty = 0
+    leading = True
+    for line in lines:
+        if not line:
+            empty += 1
+            continue
+        # n line breaks between two lines (or n - 1 at the beginning)
+        breaks = empty if leading else empty + 1
+        yield from [''] * ((breaks + 1) // 2 - (0 if leading else 1))
+        empty = 0
+        leading = False
+        yield line
+    # The last line is not followed by a line break
+    breaks = empty - 1 if leading else empty
+    yield from [''] * ((breaks + 1) // 2 + (1 if leading else 0))
+
+
+def _vevent_lines(lines):
+    '''Group lines into events. Yields a list of lines for each event. An
+    event starts with a `BEGIN:VEVENT` line with line breaks on both sides
+    which are not already part of the start of the previous event.
+    '''
+    lines = iter(lines)
+    previous = next(lines)
+    vevent = None
+    after_begin = True
+    for line in lines:
+        if previous == 'BEGIN:VEVENT' and not after_begin:
+            if vevent is not None:
+                yield vevent
+            vevent = []
+            after_begin = True
+        else:
+            if vevent is not None:
+                vevent.append(previous)
+            after_begin = False
+        previous = line
+    if vevent is not None:
+        vevent.append(previous)
+        yield vevent
+
+
+def parse_timestamp(value):
+    '''Convert an iCalendar date-time value to a unix timestamp. The UTC form
+    `YYYYMMDDTHHMMSSZ` used by Opencast is parsed directly. All other formats
+    are handled by dateutil.
+    '''
+    if len(value) == 16 and value[8] == 'T' and value[15] == 'Z' \
+            and value.isascii() and value[:8].isdigit() \
+            and value[9:15].isdigit():
+        try:
+            return int(datetime(
+                int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                int(value[9:11]), int(value[11:13]), int(value[13:15]),
+                tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            pass
+    return int(dateutil.parser.parse(value).timestamp())
+
+
+def iter_ical(chunks, decode_attachments=True):
+    '''Parse Opencast schedule iCalendar data incrementally and yield events
+    as dict. Only the lines of the current event are kept in memory.
+
+    :param chunks: Iterable of text or UTF-8 encoded chunks of the calendar
+    :param decode_attachments: Decode attachments or keep them base64 encoded
+    '''
+    lines = _collapse_empty_lines(_unfold_lines(_split_lines(chunks)))
+    for vevent in _vevent_lines(lines):
         event = {}
-        for line in vevent.split('\r\n'):
+        for line in vevent:
             line = line.split(':', 1)
             key = line[0].lower()
             if len(line) <= 1 or key == 'end':
                 continue
             if key.startswith('dt'):
-                event[key] = int(dateutil.parser.parse(line[1]).timestamp())
+                event[key] = parse_timestamp(line[1])
                 continue
             if not key.startswith('attach'):
                 event[key] = line[1]
@@ -51,16 +153,32 @@ def parse_ical(vcal):
             for x in [x.split('=') for x in line[0].split(';')]:
                 if x[0].lower() in ['fmttype', 'x-apple-filename']:
                     attachment[x[0].lower()] = x[1]
-            attachment['data'] = b64decode(line[1]).decode('utf-8')
+            attachment['data'] = b64decode(line[1]).decode('utf-8') \
+                if decode_attachments else line[1]
             event['attach'].append(attachment)
-        events.append(event)
-    return events
+        yield event
+
+
+def parse_ical(vcal):
+    '''Parse Opencast schedule iCalendar file and return events as dict
+    '''
+    return list(iter_ical([vcal]))
+
+
+def _chunks(f, size=64 * 1024):
+    '''Read a file in chunks of a given size.
+    '''
+    return iter(functools.partial(f.read, size), b'')
 
 
 @with_session
 def get_schedule(db):
     '''Try to load schedule from the Matterhorn core. Returns a valid schedule
     or None on failure.
+
+    The validators of the last response are used for a conditional request.
+    If the calendar did not change, parsing it and updating the database is
+    skipped.
     '''
     params = {'agentid': config('agent', 'name').encode('utf8')}
     lookahead = config('agent', 'cal_lookahead') * 24 * 60 * 60
@@ -68,31 +186,177 @@ def get_schedule(db):
         params['cutoff'] = str((timestamp() + lookahead) * 1000)
     uri = '%s/calendars?%s' % (service('scheduler')[0],
                                urlencode(params))
-    try:
-        vcal = http_request(uri)
-        UpstreamState.update_sync_time(config('server', 'url'))
-    except pycurl.error as e:
-        logger.error('Could not get schedule: %s', e)
-        return
+    state = db.query(UpstreamState)\
+              .filter(UpstreamState.url == config('server', 'url'))\
+              .first() \
+        or UpstreamState(url=config('server', 'url'))
+    headers = []
+    if state.calendar_etag:
+        headers.append('If-None-Match: ' + state.calendar_etag)
+    if state.calendar_last_modified:
+        headers.append('If-Modified-Since: ' + state.calendar_last_modified)
+    response_headers = {}
+    # Spool the calendar to a temporary file while hashing it, so that it
+    # is never held in memory as a whole
+    checksum = hashlib.sha256()
+    with tempfile.TemporaryFile() as vcal:
+        def write(data):
+            checksum.update(data)
+            vcal.write(data)
 
-    try:
-        cal = parse_ical(vcal.decode('utf-8'))
-    except Exception:
-        logger.exception('Could not parse ical')
-        return
-    db.query(UpcomingEvent).delete()
-    for event in cal:
+        try:
+            modified = http_request(uri, headers=headers,
+                                    response_headers=response_headers,
+                                    write=write) is not None
+        except pycurl.error as e:
+            logger.error('Could not get schedule: %s', e)
+            return
+
+        try:
+            calendar_hash = modified and checksum.hexdigest()
+            if not modified or calendar_hash == state.calendar_hash:
+                logger.debug('Schedule has not been modified')
+                removed = remove_finished_events(db)
+                UpstreamState.update_sync_time(config('server', 'url'))
+                log_changes(0, 0, removed)
+                return
+            vcal.seek(0)
+            events = iter_ical(_chunks(vcal), decode_attachments=False)
+            added, updated, removed = update_events(db, events)
+            if updated or removed:
+                remove_unused_attachments(db)
+        except Exception:
+            logger.exception('Could not parse ical')
+            db.rollback()
+            return
+
+    # Remember validators for the next conditional request
+    state.calendar_etag = response_headers.get('etag')
+    state.calendar_last_modified = response_headers.get('last-modified')
+    state.calendar_hash = calendar_hash
+    db.merge(state)
+    db.commit()
+    UpstreamState.update_sync_time(config('server', 'url'))
+    log_changes(added, updated, removed)
+
+
+def event_hash(data):
+    '''Get a hash of the serialized event data to detect changes.
+    '''
+    return hashlib.sha256(data).digest()
+
+
+def update_events(db, events):
+    '''Reconcile upcoming events in the database with a new schedule.
+    Events are identified by uid and start time. New events are inserted,
+    changed events are updated and events no longer part of the schedule are
+    deleted. Changes are not committed.
+
+    :param db: Database session
+    :param events: Iterable of parsed events
+    :return: Number of added, updated and removed events
+    '''
+    existing = {(uid, start): event_hash(data) for uid, start, data in
+                db.query(UpcomingEvent.uid, UpcomingEvent.start,
+                         UpcomingEvent.data)}
+    attachments = {h for h, in db.query(Attachment.hash)}
+    scheduled = set()
+    added = updated = 0
+    for event in events:
         # Ignore events that have already ended
         if event['dtend'] <= timestamp():
             continue
+        store_attachments(db, event, attachments)
         e = UpcomingEvent()
         e.start = event['dtstart']
         e.end = event['dtend']
         e.uid = event.get('uid')
         e.title = event.get('summary')
         e.set_data(event)
-        db.add(e)
+        key = (e.uid, e.start)
+        if key in scheduled:
+            logger.warning('Ignoring duplicate event %s starting at %i', *key)
+            continue
+        scheduled.add(key)
+        if key not in existing:
+            db.add(e)
+            added += 1
+        elif existing[key] != event_hash(e.data):
+            db.query(UpcomingEvent)\
+              .filter(UpcomingEvent.uid == e.uid)\
+              .filter(UpcomingEvent.start == e.start)\
+              .update({'end': e.end, 'title': e.title, 'data': e.data,
+                       'attachment_hashes': e.attachment_hashes})
+            updated += 1
+    removed = existing.keys() - scheduled
+    for uid, start in removed:
+        db.query(UpcomingEvent)\
+          .filter(UpcomingEvent.uid == uid)\
+          .filter(UpcomingEvent.start == start)\
+          .delete()
+    return added, updated, len(removed)
+
+
+def store_attachments(db, event, stored):
+    '''Store the base64 encoded attachments of an event in the attachment
+    table and replace their data with a reference to it. Identical
+    attachments are stored only once.
+
+    :param db: Database session
+    :param event: Parsed event with encoded attachments
+    :param stored: Set of hashes of attachments already stored
+    '''
+    for attachment in event.get('attach', []):
+        data = attachment.pop('data').encode('utf-8')
+        attachment['hash'] = hashlib.sha256(data).hexdigest()
+        if attachment['hash'] not in stored:
+            db.add(Attachment(hash=attachment['hash'], data=data))
+            stored.add(attachment['hash'])
+
+
+def remove_unused_attachments(db):
+    '''Delete attachments which are neither referenced by upcoming nor by
+    recorded events. Only the attachment hashes of the events are loaded,
+    not their data.
+    '''
+    used = set()
+    for event_type in (UpcomingEvent, RecordedEvent):
+        # Events stored by older versions do not list their attachments yet
+        legacy = db.query(event_type)\
+                   .filter(event_type.attachment_hashes.is_(None))
+        for event in legacy:
+            event.attachment_hashes = attachment_hashes(event.get_data())
+        for hashes, in db.query(event_type.attachment_hashes):
+            used.update(hashes.split())
+    unused = {h for h, in db.query(Attachment.hash)} - used
+    for attachment_hash in unused:
+        db.query(Attachment).filter(Attachment.hash == attachment_hash)\
+                            .delete()
+    logger.debug('Removed %i unused attachments', len(unused))
+
+
+def remove_finished_events(db):
+    '''Remove events from the schedule which have already ended.
+
+    :return: Number of removed events
+    '''
+    removed = db.query(UpcomingEvent)\
+                .filter(UpcomingEvent.end <= timestamp())\
+                .delete()
     db.commit()
+    return removed
+
+
+def log_changes(added, updated, removed):
+    '''Log and count changes to the schedule.
+    '''
+    if not (added or updated or removed):
+        return
+    logger.info('Updated schedule: %i added, %i updated, %i removed events',
+                added, updated, removed)
+    Statistic.increase({'schedule_events_added': added,
+                        'schedule_events_updated': updated,
+                        'schedule_events_removed': removed})
 
 
 def control_loop():
@@ -4,7 +4,7 @@ Simple UI telling about the current state of the capture agent.
 '''
 from flask import Flask, send_from_directory, redirect, url_for, make_response
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
-from pyca.ui import capture_devices_collector, process_status_collector, recordings_collector # noqa
+from pyca.ui import capture_devices_collector, process_status_collector, recordings_collector, statistics_collector # noqa
 from pyca.config import config
 from pyca.ui.utils import requires_auth
 import os.path
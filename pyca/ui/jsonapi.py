@@ -2,8 +2,9 @@
 from flask import jsonify, make_response, request
 from pyca.config import config
 from pyca.db import Service, ServiceStatus, UpcomingEvent, \
-    RecordedEvent, UpstreamState
-from pyca.db import with_session, Status, ServiceStates
+    RecordedEvent, UpstreamState, ServiceEndpoint
+from pyca.db import with_session, Status, ServiceStates, Statistic
+from pyca import retention
 from pyca.ui import app
 from pyca.ui.utils import requires_auth, jsonapi_mediatype
 from pyca.ui.opencast_commands import schedule
@@ -74,7 +75,9 @@ def internal_state():
         'capture': ServiceStatus.str(get_service_status(Service.CAPTURE)),
         'ingest': ServiceStatus.str(get_service_status(Service.INGEST)),
         'schedule': ServiceStatus.str(get_service_status(Service.SCHEDULE)),
-        'agentstate': ServiceStatus.str(get_service_status(Service.AGENTSTATE))
+        'agentstate': ServiceStatus.str(
+            get_service_status(Service.AGENTSTATE)),
+        'retention': ServiceStatus.str(get_service_status(Service.RETENTION))
     }}
     return make_response(jsonify({'meta': data}))
 
@@ -103,12 +106,15 @@ def events(db):
 @with_session
 def event(db, uid):
     '''Return a specific events JSON
+
+    Use ?attachments=true parameter to include the decoded attachments.
     '''
     event = db.query(RecordedEvent).filter(RecordedEvent.uid == uid).first() \
         or db.query(UpcomingEvent).filter(UpcomingEvent.uid == uid).first()
 
     if event:
-        return make_data_response(event.serialize())
+        attachments = request.args.get('attachments', 'false') == 'true'
+        return make_data_response(event.serialize(attachments))
     return make_error_response('No event with specified uid', 404)
 
 
@@ -175,7 +181,11 @@ def modify_event(db, uid):
         return make_error_response('No event with specified uid', 404)
     event.start = data['attributes'].get('start', event.start)
     event.end = data['attributes'].get('end', event.end)
-    event.status = data['attributes'].get('status', event.status)
+    if 'status' in data['attributes']:
+        event.status = data['attributes']['status']
+        # Start over with retrying failed uploads
+        event.attempts = None
+        event.next_retry = None
     logger.debug('Updating event %s via api', uid)
     db.commit()
     return make_data_response(event.serialize())
@@ -189,11 +199,7 @@ def metrics(dbs):
     '''Serve several metrics about the pyCA services and the machine via
     json.'''
     # Get Disk Usage
-    # If the capture directory do not exists, use the parent directory.
-    directory = config('capture', 'directory')
-    if not os.path.exists(directory):
-        directory = os.path.abspath(os.path.join(directory, os.pardir))
-    total, used, free = shutil.disk_usage(directory)
+    total, used, free = retention.disk_usage()
 
     # Get Loads
     load_1m, load_5m, load_15m = os.getloadavg()
@@ -213,6 +219,39 @@ def metrics(dbs):
     state = dbs.query(UpstreamState).filter(
         UpstreamState.url == config('server', 'url')).first()
     last_synchronized = state.last_synced.isoformat() if state else None
+
+    # Get ingest queue
+    queue = dbs.query(RecordedEvent).filter(RecordedEvent.status.in_(
+        [Status.FINISHED_RECORDING, Status.UPLOADING])).all()
+    queue_size = sum(event.track_size() for event in queue)
+    throughput = [e.throughput for e in dbs.query(ServiceEndpoint).filter(
+        ServiceEndpoint.type == 'org.opencastproject.ingest')
+        if e.throughput]
+    drain_time = None
+    if queue and throughput:
+        # Rough estimate based on the average upload throughput per worker
+        throughput = sum(throughput) / len(throughput)
+        workers = min(config('ingest', 'workers'), len(queue))
+        drain_time = queue_size / (throughput * workers)
+
+    # Get disk space check of the latest recording
+    checked = dbs.query(RecordedEvent)\
+                 .filter(RecordedEvent.estimated_size.isnot(None))\
+                 .order_by(RecordedEvent.start.desc())\
+                 .first()
+    preflight = None
+    if checked:
+        preflight = {
+            'uid': checked.uid,
+            'status': checked.status_str(),
+            'estimated_size_in_bytes': checked.estimated_size,
+            'available_in_bytes': checked.space_available,
+            'sufficient': checked.space_available >= checked.estimated_size,
+        }
+
+    # Get retention statistics
+    statistics = {s.name: int(s.value) for s in dbs.query(Statistic).filter(
+        Statistic.name.like('retention_%'))}
     return make_response(jsonify(
         {'meta': {
             'services': services,
@@ -236,6 +275,20 @@ def metrics(dbs):
             },
             'upstream': {
                 'last_synchronized': last_synchronized,
+            },
+            'ingest_queue': {
+                'recordings': len(queue),
+                'uploading': len([e for e in queue
+                                  if e.status == Status.UPLOADING]),
+                'size_in_bytes': queue_size,
+                'estimated_drain_time_in_seconds': drain_time,
+            },
+            'disk_preflight': preflight,
+            'retention': {
+                'headroom_in_bytes': retention.headroom(),
+                'freed_in_bytes': statistics.get('retention_freed_bytes', 0),
+                'evicted_recordings': statistics.get(
+                    'retention_evicted_recordings', 0),
             }
         }}))
 
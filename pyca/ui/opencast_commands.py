@@ -9,10 +9,9 @@
 
 from xml.sax.saxutils import escape as xml_escape  # nosec B406
 from pyca.config import config
-from pyca.utils import http_request, service
+from pyca.utils import http_request, select_endpoint
 from datetime import datetime, timedelta
 import logging
-import random
 
 logger = logging.getLogger(__name__)
 
@@ -44,11 +43,9 @@ def schedule(title='pyCA Recording', duration=60, creator=None):
         creator = config('ui', 'username')
 
     # Select ingest service
-    # The ingest service to use is selected at random from the available
-    # ingest services to ensure that not every capture agent uses the same
-    # service at the same time
-    service_url = service('ingest', force_update=True)
-    service_url = service_url[random.randrange(0, len(service_url))]  # nosec
+    # The ingest service to use is selected based on the configured strategy
+    # from the available ingest services
+    service_url = select_endpoint('ingest')
     logger.info('Selecting ingest service for scheduling: ' + service_url)
 
     # create media package
@@ -1,7 +1,9 @@
-from prometheus_client.metrics_core import GaugeMetricFamily
+from prometheus_client.metrics_core import GaugeMetricFamily, \
+    HistogramMetricFamily
 from prometheus_client.registry import REGISTRY
 
-from pyca.db import get_session, RecordedEvent, UpcomingEvent, Status
+from pyca.db import get_session, RecordedEvent, UpcomingEvent, Status, \
+    Statistic, LATENCY_BUCKETS
 from pyca.utils import timestamp
 
 
@@ -47,5 +49,63 @@ class RecordingsCollector(object):
 
         yield recordings
 
+        latencies = (
+            ('pyca_capture_start_latency_seconds',
+             'Delay between scheduled start and capture process spawn',
+             'capture_start_latency'),
+            ('pyca_capture_data_latency_seconds',
+             'Delay between capture process spawn and first bytes written',
+             'capture_data_latency'),
+            ('pyca_capture_exit_latency_seconds',
+             'Delay between scheduled end and capture process exit',
+             'capture_exit_latency'))
+        for name, description, statistic in latencies:
+            yield self.histogram(name, description, statistic)
+
+        yield from self.upload_progress()
+
+    def upload_progress(self):
+        '''Create metrics about the progress of running uploads.
+        '''
+        labels = ['uid', 'flavor', 'file']
+        metrics = {
+            'sent': GaugeMetricFamily(
+                'pyca_upload_sent_bytes',
+                'Bytes of a track uploaded so far', labels=labels),
+            'total': GaugeMetricFamily(
+                'pyca_upload_size_bytes',
+                'Size of a track being uploaded', labels=labels),
+            'rate': GaugeMetricFamily(
+                'pyca_upload_rate_bytes_per_second',
+                'Current upload rate of a track', labels=labels),
+            'eta': GaugeMetricFamily(
+                'pyca_upload_eta_seconds',
+                'Estimated time until the upload of a track finishes',
+                labels=labels)}
+        uploads = self.db.query(RecordedEvent)\
+                         .filter(RecordedEvent.status == Status.UPLOADING)
+        for event in uploads:
+            for track in event.get_upload_progress():
+                values = [event.uid, track['flavor'], track['file']]
+                for key, metric in metrics.items():
+                    if track.get(key) is not None:
+                        metric.add_metric(values, value=track[key])
+        yield from metrics.values()
+
+    def histogram(self, name, description, statistic):
+        '''Create a histogram metric from the counters of a histogram
+        stored by :func:`pyca.db.Statistic.observe`.
+        '''
+        names = [f'{statistic}_{kind}' for kind in ('bucket', 'count', 'sum')]
+        counters = self.db.query(Statistic)\
+                          .filter(Statistic.name.in_(names))
+        counters = {(c.name[len(statistic) + 1:], c.label): c.value
+                    for c in counters}
+        buckets = [(str(bound), counters.get(('bucket', str(bound)), 0))
+                   for bound in LATENCY_BUCKETS]
+        buckets.append(('+Inf', counters.get(('count', ''), 0)))
+        return HistogramMetricFamily(name, description, buckets=buckets,
+                                     sum_value=counters.get(('sum', ''), 0))
+
 
 RECORDINGS_COLLECTOR = RecordingsCollector()
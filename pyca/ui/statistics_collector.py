@@ -0,0 +1,74 @@
+from prometheus_client.metrics_core import CounterMetricFamily
+from prometheus_client.registry import REGISTRY
+
+from pyca.db import get_session, Statistic
+
+
+class StatisticsCollector(object):
+    '''Return metrics about counters shared between the pyCA processes.
+    '''
+
+    # Statistic name: (metric name, description, label name)
+    COUNTERS = {
+        'http_received_bytes': (
+            'pyca_http_received_bytes',
+            'Bytes received from Opencast before decompression',
+            'endpoint'),
+        'http_decoded_bytes': (
+            'pyca_http_decoded_bytes',
+            'Bytes received from Opencast after decompression',
+            'endpoint'),
+        'http_requests': (
+            'pyca_http_requests',
+            'Number of HTTP requests sent to Opencast',
+            'endpoint'),
+        'schedule_events_added': (
+            'pyca_schedule_events_added',
+            'Number of events added to the schedule'),
+        'schedule_events_updated': (
+            'pyca_schedule_events_updated',
+            'Number of scheduled events which have been modified'),
+        'schedule_events_removed': (
+            'pyca_schedule_events_removed',
+            'Number of events removed from the schedule'),
+        'ingest_uploaded_bytes': (
+            'pyca_ingest_uploaded_bytes',
+            'Bytes of tracks uploaded to Opencast'),
+        'agentstate_updates_sent': (
+            'pyca_agentstate_updates_sent',
+            'Number of agent state updates sent to Opencast'),
+        'agentstate_updates_suppressed': (
+            'pyca_agentstate_updates_suppressed',
+            'Number of unchanged agent state updates not sent to Opencast'),
+        'capture_restarts': (
+            'pyca_capture_restarts',
+            'Number of recordings restarted after failing or ending early'),
+        'retention_freed_bytes': (
+            'pyca_retention_freed_bytes',
+            'Bytes freed by removing uploaded recordings'),
+        'retention_evicted_recordings': (
+            'pyca_retention_evicted_recordings',
+            'Number of uploaded recordings removed to free disk space'),
+    }
+
+    def __init__(self, registry=REGISTRY):
+        registry.register(self)
+
+    def collect(self):
+        metrics = {name: CounterMetricFamily(*spec[:2], labels=spec[2:])
+                   for name, spec in self.COUNTERS.items()}
+
+        db = get_session()
+        for statistic in db.query(Statistic):
+            if statistic.name in metrics:
+                labels = [statistic.label] if statistic.label else []
+                metrics[statistic.name].add_metric(
+                    labels,
+                    value=statistic.value)
+        db.close()
+
+        for metric in metrics.values():
+            yield metric
+
+
+STATISTICS_COLLECTOR = StatisticsCollector()
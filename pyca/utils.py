@@ -11,26 +11,178 @@ from pyca.config import config
 from pyca import db
 from datetime import datetime
 from dateutil.tz import tzutc
+import atexit
+import collections
 import errno
 import json
 import logging
 import os
 import os.path
 import pycurl
+import random
+import socket
+import threading
 import time
 from io import BytesIO as bio
-from urllib.parse import quote as urlquote
+from urllib.parse import quote as urlquote, urlsplit
 
 
 logger = logging.getLogger(__name__)
 
+# Per-process pool of reusable curl handles
+_curl_pool = {}
+_curl_pool_lock = threading.Lock()
+_curl_pool_pid = None
 
-def http_request(url, post_data=None, timeout=None):
+# Number of seconds after which an unfinished service registry update may be
+# taken over by another process
+SERVICE_LEASE = 60
+# Per-process locks making sure only one thread updates a service type
+_service_locks = {}
+_service_locks_lock = threading.Lock()
+
+# Number of seconds after which upload throughput measurements are outdated
+THROUGHPUT_MAX_AGE = 24 * 3600
+
+# Number of bytes libcurl requests at once when streaming a request body
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+# Per-process limiter shared by all uploads
+_bandwidth_limiter = None
+_bandwidth_limiter_pid = None
+
+# Per-process queue of state updates sent to Opencast in the background
+_outbox = collections.deque()
+_outbox_condition = threading.Condition()
+_outbox_thread = None
+_outbox_pid = None
+# Number of attempts to send a state update before it is dropped
+STATE_UPDATE_ATTEMPTS = 10
+
+# Number of seconds transfer statistics are collected in memory before they
+# are written to the database
+STATISTICS_FLUSH_INTERVAL = 30
+# Per-process transfer counters not yet written to the database
+_transfer_statistics = collections.Counter()
+_transfer_statistics_lock = threading.Lock()
+_transfer_statistics_flushed = 0
+_transfer_statistics_pid = None
+
+
+def _curl_pool_key(url):
+    '''Get the key identifying handles which may be reused for a request to
+    the given URL. Handles are only shared between requests to the same host
+    using the same authentication settings.
+    '''
+    location = urlsplit(url)
+    return (location.scheme, location.netloc,
+            config('server', 'auth_method'),
+            config('server', 'username'),
+            config('server', 'password'))
+
+
+def http2_enabled():
+    '''Check if HTTP/2 should be negotiated for HTTPS connections, i.e. if
+    it is configured and supported by the installed libcurl.
+    '''
+    if not config('http', 'http2'):
+        return False
+    features = pycurl.version_info()[4]
+    if not features & getattr(pycurl, 'VERSION_HTTP2', 0):
+        logger.warning('HTTP/2 is not supported by libcurl. '
+                       'Falling back to HTTP/1.1.')
+        config('http')['http2'] = False
+        return False
+    return True
+
+
+def _curl_share():
+    '''Create a share object for DNS cache, TLS sessions and cookies. The
+    connection cache is not shared since handles are used by several threads
+    at once, which libcurl does not support for shared connections. Every
+    pooled handle keeps its own connection instead.
+    '''
+    share = pycurl.CurlShare()
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_COOKIE)
+    return share
+
+
+def _acquire_curl(key):
+    '''Get an idle curl handle for the given pool key or create a new one.
+    Handles inherited from a parent process are never reused.
+    '''
+    global _curl_pool_pid
+    with _curl_pool_lock:
+        if _curl_pool_pid != os.getpid():
+            _curl_pool.clear()
+            _curl_pool_pid = os.getpid()
+        if key not in _curl_pool:
+            _curl_pool[key] = (_curl_share(), [])
+        share, idle = _curl_pool[key]
+        curl = idle.pop() if idle else None
+    if curl is None:
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, share)
+    else:
+        # Resetting options keeps connections, caches and the share
+        curl.reset()
+    return curl
+
+
+def _release_curl(key, curl):
+    '''Return a curl handle to the pool to keep its connection alive for
+    further requests. The handle is closed if the pool is full.
+    '''
+    with _curl_pool_lock:
+        idle = _curl_pool.get(key, (None, None))[1]
+        if idle is not None and len(idle) < config('http', 'pool_size'):
+            idle.append(curl)
+            return
+    curl.close()
+
+
+def http_request(url, post_data=None, timeout=None, headers=None,
+                 response_headers=None, progress=None, body=None,
+                 write=None, endpoint=None):
     '''Make an HTTP request to a given URL with optional parameters.
+    Connections are kept alive and reused for further requests to the same
+    host.
+
+    :param url: URL to request
+    :param post_data: List of form fields to send as POST request
+    :param timeout: Request timeout in seconds overriding the configuration
+    :param headers: List of additional request headers
+    :param response_headers: Dictionary to store the response headers in.
+                             Header names are converted to lower case.
+    :param progress: Function called regularly during the request with the
+                     number of bytes uploaded so far and the total number of
+                     bytes to upload
+    :param body: Request body to stream as POST request instead of form
+                 fields. The object needs to provide `read(size)`,
+                 `seek(offset, origin)`, `size` and `content_type`.
+    :param write: Function called with each chunk of the response body as it
+                  is received instead of keeping the body in memory
+    :param endpoint: Location of the service the request is made for. The
+                     health statistics of this endpoint are updated instead
+                     of those of the endpoint the URL belongs to.
+    :return: Response body or None if the server responded with
+             `304 Not Modified` to a conditional request. If `write` is
+             given, the body is empty.
+    :raises pycurl.error: If the request failed. The HTTP status code of
+                          the response, if any, is available as `status`.
     '''
     logger.debug('Requesting URL: %s', url)
     buf = bio()
-    curl = pycurl.Curl()
+    decoded = [0]
+
+    def write_body(data):
+        decoded[0] += len(data)
+        return (write or buf.write)(data)
+
+    key = _curl_pool_key(url)
+    curl = _acquire_curl(key)
     curl.setopt(curl.URL, url.encode('ascii', 'ignore'))
 
     # Use cookies if configured
@@ -38,6 +190,16 @@ def http_request(url, post_data=None, timeout=None):
         curl.setopt(curl.COOKIEJAR, config('server', 'cookiefile'))
         curl.setopt(curl.COOKIEFILE, config('server', 'cookiefile'))
 
+    # Negotiate HTTP/2 for HTTPS connections. Requests are not multiplexed.
+    # That would need one multi handle driving all transfers to a host, and
+    # the transfer callback throttling uploads would then stall all of them.
+    if http2_enabled():
+        curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+
+    # Let the server compress responses. Libcurl decodes them transparently.
+    if config('http', 'compression'):
+        curl.setopt(pycurl.ACCEPT_ENCODING, '')
+
     # More verbose curl calls in debug mode
     if logger.getEffectiveLevel() == logging.DEBUG:
         curl.setopt(pycurl.VERBOSE, True)
@@ -54,11 +216,6 @@ def http_request(url, post_data=None, timeout=None):
         # Import your certificates
         curl.setopt(pycurl.CAINFO, config('server', 'certificate'))
 
-    if config('ingest', 'upload_rate') > 0:
-        curl.setopt(
-            curl.MAX_SEND_SPEED_LARGE,
-            config('ingest', 'upload_rate'))
-
     curl.setopt(curl.CONNECTTIMEOUT, config('http', 'connection_timeout'))
     if timeout is not None:
         curl.setopt(curl.TIMEOUT, timeout)
@@ -67,23 +224,271 @@ def http_request(url, post_data=None, timeout=None):
 
     if post_data:
         curl.setopt(curl.HTTPPOST, post_data)
-    curl.setopt(curl.WRITEFUNCTION, buf.write)
+    headers = list(headers or [])
+    if body is not None:
+        curl.setopt(pycurl.POST, 1)
+        curl.setopt(pycurl.READFUNCTION, body.read)
+        curl.setopt(pycurl.SEEKFUNCTION, body.seek)
+        curl.setopt(pycurl.POSTFIELDSIZE_LARGE, body.size)
+        curl.setopt(pycurl.UPLOAD_BUFFERSIZE, UPLOAD_BUFFER_SIZE)
+        headers.append('Content-Type: ' + body.content_type)
+    curl.setopt(curl.WRITEFUNCTION, write_body)
+    if response_headers is not None:
+        curl.setopt(pycurl.HEADERFUNCTION,
+                    lambda line: _parse_header(line, response_headers))
+    # Throttle uploads from within the transfer callback. Unlike a fixed
+    # curl option, this picks up rate changes while a transfer is running.
+    limiter = bandwidth_limiter()
+    uploaded = [0]
+
+    def transfer_info(dltotal, dlnow, ultotal, ulnow):
+        if ulnow > uploaded[0]:
+            limiter.consume(ulnow - uploaded[0], url)
+            uploaded[0] = ulnow
+        if progress is not None:
+            progress(ulnow, ultotal)
+
+    curl.setopt(pycurl.NOPROGRESS, False)
+    curl.setopt(pycurl.XFERINFOFUNCTION, transfer_info)
     logger.debug('Using authentication method %s',
                  config('server')['auth_method'])
     if config('server')['auth_method'] == 'digest':
-        curl.setopt(curl.HTTPHEADER, ['X-Requested-Auth: Digest'])
+        headers.append('X-Requested-Auth: Digest')
         curl.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_DIGEST)
+    if headers:
+        curl.setopt(curl.HTTPHEADER, headers)
     curl.setopt(pycurl.USERPWD, ':'.join([config('server', 'username'),
                                           config('server', 'password')]))
     curl.setopt(curl.FAILONERROR, True)
     curl.setopt(curl.FOLLOWLOCATION, True)
-    curl.perform()
-    curl.close()
+    try:
+        curl.perform()
+        status = curl.getinfo(pycurl.RESPONSE_CODE)
+        received = curl.getinfo(pycurl.SIZE_DOWNLOAD_T)
+        latency = throughput = None
+        # Large uploads would dominate the time to the first response byte
+        if curl.getinfo(pycurl.SIZE_UPLOAD_T) < 1024 * 1024:
+            latency = curl.getinfo(pycurl.STARTTRANSFER_TIME)
+        else:
+            throughput = curl.getinfo(pycurl.SPEED_UPLOAD_T)
+        if config('server', 'cookiefile'):
+            # Pooled handles live on, make sure cookies are written anyway
+            curl.setopt(pycurl.COOKIELIST, 'FLUSH')
+    except pycurl.error as e:
+        e.status = curl.getinfo(pycurl.RESPONSE_CODE)
+        # Client errors like a 404 say nothing about the server's health
+        if e.args[0] != pycurl.E_HTTP_RETURNED_ERROR or e.status >= 500:
+            update_endpoint_health(endpoint or url, failed=True)
+        curl.close()
+        raise
+    except Exception:
+        curl.close()
+        raise
+    _release_curl(key, curl)
     result = buf.getvalue()
     buf.close()
+    update_transfer_statistics(url, received, decoded[0])
+    update_endpoint_health(endpoint or url, latency, throughput)
+    if status == 304:
+        return None
     return result
 
 
+def scheduled_upload_rate(now=None):
+    '''Get the upload rate configured for the given time of day. If no
+    window of the upload rate schedule matches, the static upload rate
+    applies.
+
+    :param now: Local time to get the rate for. Defaults to now.
+    :return: Upload rate in bytes per second or 0 for no limit
+    '''
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    for start, end, rate in config('ingest', 'upload_rate_schedule'):
+        if start <= minute < end \
+                or (end < start and (minute >= start or minute < end)):
+            return rate
+    return config('ingest', 'upload_rate')
+
+
+class BandwidthLimiter():
+    '''Token bucket limiting the combined rate of all uploads of a process
+    to the scheduled upload rate. In adaptive mode, the round-trip time to
+    the server is probed regularly and the rate is halved if it rises
+    significantly above the lowest time observed, indicating a saturated
+    uplink. Without congestion, the rate is increased again step by step.
+    '''
+
+    # Seconds between two round-trip time probes in adaptive mode
+    PROBE_INTERVAL = 5.0
+    # Factor by which the round-trip time may rise before backing off
+    RTT_TOLERANCE = 2.0
+    # Additive increase in bytes per second per probe without congestion
+    RATE_INCREASE = 100000
+    # The adaptive rate is never reduced below this many bytes per second
+    RATE_MIN = 50000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.adaptive = None
+        self.base_rtt = None
+        self.probed = self.updated
+        self.sent = 0
+
+    def rate(self):
+        '''Get the current upload rate limit.
+
+        :return: Upload rate in bytes per second or 0 for no limit
+        '''
+        rate = scheduled_upload_rate()
+        if self.adaptive:
+            rate = min(rate or self.adaptive, self.adaptive)
+        return rate
+
+    def consume(self, size, url):
+        '''Account for uploaded data and block until sending it is allowed
+        by the current upload rate.
+
+        :param size: Number of bytes uploaded
+        :param url: URL the data is sent to
+        '''
+        now = time.monotonic()
+        probe = False
+        with self.lock:
+            self.sent += size
+            if config('ingest', 'adaptive_rate') \
+                    and now - self.probed >= self.PROBE_INTERVAL:
+                throughput = self.sent / (now - self.probed)
+                self.probed = now
+                self.sent = 0
+                probe = True
+            rate = self.rate()
+            if rate:
+                # Allow bursts of up to one second worth of data
+                self.tokens = min(rate, self.tokens
+                                  + (now - self.updated) * rate) - size
+            self.updated = now
+            delay = -self.tokens / rate if rate and self.tokens < 0 else 0
+        if probe:
+            self.adapt(round_trip_time(url), throughput)
+        if delay:
+            time.sleep(delay)
+
+    def adapt(self, rtt, throughput):
+        '''Adjust the adaptive rate limit to a new round-trip time sample
+        by additive increase and multiplicative decrease.
+
+        :param rtt: Round-trip time in seconds or None if unknown
+        :param throughput: Bytes per second sent since the last probe
+        '''
+        if rtt is None:
+            return
+        with self.lock:
+            self.base_rtt = min(self.base_rtt or rtt, rtt)
+            limit = scheduled_upload_rate()
+            if rtt > self.base_rtt * self.RTT_TOLERANCE:
+                rate = self.adaptive or limit or throughput
+                self.adaptive = max(int(rate / 2), self.RATE_MIN)
+                logger.info('Round-trip time increased to %.3f s. Reducing '
+                            'upload rate to %d B/s', rtt, self.adaptive)
+            elif self.adaptive:
+                self.adaptive += self.RATE_INCREASE
+                # Lift the limit once the regular limit is reached or the
+                # uploads do not make use of the available rate anyway
+                if (limit and self.adaptive >= limit) \
+                        or (not limit and self.adaptive > 2 * throughput):
+                    self.adaptive = None
+                    logger.info('Lifting adaptive upload rate limit')
+
+
+def bandwidth_limiter():
+    '''Get the bandwidth limiter of this process.
+    '''
+    global _bandwidth_limiter, _bandwidth_limiter_pid
+    if _bandwidth_limiter_pid != os.getpid():
+        _bandwidth_limiter = BandwidthLimiter()
+        _bandwidth_limiter_pid = os.getpid()
+    return _bandwidth_limiter
+
+
+def round_trip_time(url, timeout=2):
+    '''Measure the round-trip time to a server by the time it takes to
+    establish a TCP connection.
+
+    :param url: URL of the server
+    :param timeout: Maximum number of seconds to wait
+    :return: Round-trip time in seconds or None if the server is unreachable
+    '''
+    location = urlsplit(url)
+    start = time.monotonic()
+    try:
+        port = location.port or (443 if location.scheme == 'https' else 80)
+        if not location.hostname:
+            return None
+        socket.create_connection((location.hostname, port), timeout).close()
+    except (OSError, ValueError):
+        return None
+    return time.monotonic() - start
+
+
+def update_transfer_statistics(url, received, decoded):
+    '''Count the number of bytes transferred from an endpoint. The endpoint is
+    identified by the first two segments of the URL path to not end up with a
+    counter for each recording. Counters are collected in memory and written
+    to the database at most every STATISTICS_FLUSH_INTERVAL seconds.
+
+    :param url: Requested URL
+    :param received: Number of bytes received over the network
+    :param decoded: Number of bytes after decompressing the response
+    '''
+    global _transfer_statistics_pid
+    endpoint = '/'.join(urlsplit(url).path.split('/')[:3])
+    with _transfer_statistics_lock:
+        if _transfer_statistics_pid != os.getpid():
+            # Counters inherited from the parent process are its to write
+            _transfer_statistics.clear()
+            _transfer_statistics_pid = os.getpid()
+        _transfer_statistics[('http_received_bytes', endpoint)] += received
+        _transfer_statistics[('http_decoded_bytes', endpoint)] += decoded
+        _transfer_statistics[('http_requests', endpoint)] += 1
+    if time.monotonic() - _transfer_statistics_flushed \
+            >= STATISTICS_FLUSH_INTERVAL:
+        flush_transfer_statistics()
+
+
+@atexit.register
+def flush_transfer_statistics():
+    '''Write the transfer counters collected in memory to the database.
+    '''
+    global _transfer_statistics_flushed
+    with _transfer_statistics_lock:
+        if _transfer_statistics_pid != os.getpid() or not _transfer_statistics:
+            return
+        values = dict(_transfer_statistics)
+        _transfer_statistics.clear()
+        _transfer_statistics_flushed = time.monotonic()
+    try:
+        db.Statistic.increase_labeled(values)
+    except Exception:
+        logger.warning('Could not update transfer statistics', exc_info=True)
+        with _transfer_statistics_lock:
+            _transfer_statistics.update(values)
+
+
+def _parse_header(line, response_headers):
+    '''Store a single response header line in a dictionary. Headers of
+    previous responses (e.g. redirects) are discarded.
+    '''
+    line = line.decode('iso-8859-1').rstrip('\r\n')
+    if line.startswith('HTTP/'):
+        response_headers.clear()
+    elif ':' in line:
+        name, value = line.split(':', 1)
+        response_headers[name.strip().lower()] = value.strip()
+
+
 def get_service(service_type):
     '''Get available service endpoints for a given service type from the
     Opencast ServiceRegistry.
@@ -94,9 +499,7 @@ def get_service(service_type):
         return [override]
 
     # Get available services from Opencast
-    endpoint = '/services/available.json?serviceType=' + str(service_type)
-    url = config('server', 'url') + endpoint
-    response = http_request(url).decode('utf-8')
+    response = http_request(_registry_url(service_type)).decode('utf-8')
     services = json.loads(response).get('services', {}).get('service', [])
     services = ensurelist(services)
     endpoints = [service['host'] + service['path'] for service in services
@@ -106,6 +509,13 @@ def get_service(service_type):
     return endpoints
 
 
+def _registry_url(service_type):
+    '''Get the service registry URL listing endpoints of a service type.
+    '''
+    endpoint = '/services/available.json?serviceType=' + str(service_type)
+    return config('server', 'url') + endpoint
+
+
 def timestamp():
     '''Get current unix timestamp
     '''
@@ -123,8 +533,11 @@ def try_mkdir(directory):
 
 
 def service(service_name, force_update=False):
-    '''Get the location of a given service from Opencast and add it to the
-    current configuration.
+    '''Get the locations of a given service from Opencast. Locations are
+    cached in the database for all pyCA processes and are sorted by their
+    health with the best location first. Only one process at a time will
+    update expired locations while others continue to use the old ones. A
+    failed update is not retried before its lease expires.
 
     :param service_name: Name of the service type to request locations for
     :param force_update: Force an update, possibly wait for a service to
@@ -132,24 +545,251 @@ def service(service_name, force_update=False):
     :return: List of service locations
     '''
     service_id = f'org.opencastproject.{service_name}'
-    service_url = config('services', service_id)
-    logger.debug('Cached service URLs for %s: %s', service_name, service_url)
-    if service_url and not force_update:
-        return service_url
-
-    # Get service from Opencast server
-    config('services')[service_id] = []
-    while not config('services', service_id) and not terminate():
+    registry_url = _registry_url(service_id)
+    lock = _service_lock(service_id)
+    attempt = 0
+    while True:
+        endpoints, expired = cached_service(service_id)
+        logger.debug('Cached service URLs for %s: %s',
+                     service_name, endpoints)
+        if endpoints and not expired and not force_update:
+            return endpoints
+        # Keep using expired endpoints while another thread updates them
+        if not lock.acquire(blocking=force_update or not endpoints):
+            return endpoints
         try:
-            config('services')[service_id] = get_service(service_id)
-            logger.debug('Updates service URL for %s: %s',
-                         service_name,
-                         config('services', service_id))
-        except pycurl.error:
-            logger.exception('Could not get %s endpoint. Retry in 5s',
-                             service_name)
-            time.sleep(5.0)
-    return config('services', service_id)
+            # The endpoints may have been updated while waiting for the lock
+            endpoints, expired = cached_service(service_id)
+            if endpoints and not expired and not force_update:
+                return endpoints
+            if db.UpstreamState.acquire_lease(registry_url, SERVICE_LEASE):
+                try:
+                    store_service_endpoints(service_id,
+                                            get_service(service_id))
+                    endpoints = cached_service(service_id)[0]
+                    force_update = False
+                    logger.debug('Updated service URLs for %s: %s',
+                                 service_name, endpoints)
+                    db.UpstreamState.release_lease(registry_url)
+                except pycurl.error:
+                    # Keep the lease so that no process asks the registry
+                    # again before it expires
+                    logger.exception('Could not get %s endpoint',
+                                     service_name)
+                except Exception:
+                    db.UpstreamState.release_lease(registry_url)
+                    raise
+            if endpoints and not force_update:
+                return endpoints
+        finally:
+            lock.release()
+        if terminate():
+            return endpoints
+        delay = backoff(attempt)
+        logger.warning('No %s endpoint available. Retry in %.1fs',
+                       service_name, delay)
+        time.sleep(delay)
+        attempt += 1
+
+
+def _service_lock(service_type):
+    '''Get the lock for updating the cached locations of a service type.
+    '''
+    with _service_locks_lock:
+        return _service_locks.setdefault(service_type, threading.Lock())
+
+
+def cached_service(service_type):
+    '''Get the cached locations of a given service type sorted by their
+    health. Endpoints which failed recently are put last. Others are sorted by
+    their latency.
+
+    :param service_type: Full service type identifier
+    :return: Tuple of the list of locations and whether the cache expired
+    '''
+    now = datetime.utcnow()
+    dbs = db.get_session()
+    try:
+        registry_url = _registry_url(service_type)
+        state = dbs.query(db.UpstreamState)\
+                   .filter(db.UpstreamState.url == registry_url)\
+                   .first()
+        if not state or not state.last_synced:
+            return [], True
+        endpoints = dbs.query(db.ServiceEndpoint)\
+                       .filter(db.ServiceEndpoint.type == service_type)\
+                       .order_by(db.ServiceEndpoint.url)\
+                       .all()
+    finally:
+        dbs.close()
+    endpoints.sort(key=lambda e: (e.penalized(now), e.latency or 0))
+    age = (now - state.last_synced).total_seconds()
+    # Refresh early if all endpoints failed recently, but not more than once
+    # per lease period. A single node being down would otherwise make every
+    # lookup ask the service registry first.
+    expired = not 0 <= age < config('server', 'service_ttl') \
+        or (age >= SERVICE_LEASE and all(e.penalized(now) for e in endpoints))
+    return [e.url for e in endpoints], expired
+
+
+@db.with_session
+def store_service_endpoints(dbs, service_type, endpoints):
+    '''Replace the cached locations of a given service type. Health
+    statistics of locations which are still available are kept.
+
+    :param service_type: Full service type identifier
+    :param endpoints: List of service locations
+    '''
+    dbs.query(db.ServiceEndpoint)\
+       .filter(db.ServiceEndpoint.type == service_type)\
+       .filter(~db.ServiceEndpoint.url.in_(endpoints))\
+       .delete(synchronize_session=False)
+    known = {e.url for e in dbs.query(db.ServiceEndpoint)
+             .filter(db.ServiceEndpoint.type == service_type)}
+    for url in set(endpoints) - known:
+        dbs.add(db.ServiceEndpoint(type=service_type, url=url, failures=0))
+    dbs.merge(db.UpstreamState(url=_registry_url(service_type),
+                               last_synced=datetime.utcnow()))
+    dbs.commit()
+
+
+def update_endpoint_health(url, latency=None, throughput=None,
+                           failed=False):
+    '''Update the health statistics of the service endpoint a request has
+    been sent to. Latency, upload throughput and error rate are tracked as
+    exponential moving averages.
+
+    :param url: Requested URL
+    :param latency: Time until the response started in seconds
+    :param throughput: Upload speed in bytes per second
+    :param failed: If the request failed due to a server or network error
+    '''
+    now = datetime.utcnow()
+    dbs = db.get_session()
+    try:
+        endpoints = dbs.query(db.ServiceEndpoint)\
+                       .filter(db.ServiceEndpoint.url.in_(_url_prefixes(url)))\
+                       .all()
+        for endpoint in endpoints:
+            endpoint.error_rate = _moving_average(endpoint.error_rate,
+                                                  float(failed))
+            if failed:
+                endpoint.failures = (endpoint.failures or 0) + 1
+                endpoint.last_failure = now
+                continue
+            endpoint.failures = 0
+            if latency is not None:
+                endpoint.latency = _moving_average(endpoint.latency, latency)
+            if throughput is not None:
+                endpoint.throughput = _moving_average(endpoint.throughput,
+                                                      throughput)
+                endpoint.throughput_updated = now
+        if endpoints:
+            dbs.commit()
+    except Exception:
+        logger.warning('Could not update endpoint health', exc_info=True)
+    finally:
+        dbs.close()
+
+
+def _url_prefixes(url):
+    '''Get all URLs a service endpoint containing the given URL may have, i.e.
+    the URL cut off after each segment of its path.
+
+    :param url: Requested URL
+    :return: List of URL prefixes
+    '''
+    location = urlsplit(url)
+    base = '%s://%s' % (location.scheme, location.netloc)
+    segments = location.path.split('/')
+    prefixes = [base + '/'.join(segments[:i])
+                for i in range(1, len(segments) + 1)]
+    return prefixes + [p + '/' for p in prefixes] + [url]
+
+
+def _moving_average(average, value, weight=0.2):
+    '''Add a value to an exponential moving average.
+    '''
+    if average is None:
+        return value
+    return (1 - weight) * average + weight * value
+
+
+def select_endpoint(service_name):
+    '''Select the location of a service to send data to. Depending on the
+    configured selection strategy, a random location is chosen or the one
+    which had the highest upload throughput and the lowest error rate. The
+    sticky strategy keeps using the previously selected location as long as
+    it works. Both of these avoid locations which failed recently.
+
+    :param service_name: Name of the service type to select a location for
+    :return: Service location
+    '''
+    endpoints = service(service_name)
+    strategy = config('ingest', 'node_selection')
+    if strategy == 'random' or len(endpoints) < 2:
+        # nosec: we do not need a secure random number here
+        return endpoints[random.randrange(0, len(endpoints))]  # nosec
+
+    now = datetime.utcnow()
+    dbs = db.get_session()
+    try:
+        candidates = dbs.query(db.ServiceEndpoint)\
+                        .filter(db.ServiceEndpoint.type ==
+                                f'org.opencastproject.{service_name}')\
+                        .filter(db.ServiceEndpoint.url.in_(endpoints))\
+                        .all()
+        candidates = [e for e in candidates if not e.penalized(now)] \
+            or candidates
+        selected = None
+        if strategy == 'sticky':
+            used = [e for e in candidates if e.selected]
+            if used:
+                selected = max(used, key=lambda e: e.selected)
+        if not selected:
+            selected = _fastest_endpoint(candidates, now)
+        selected.selected = now
+        dbs.commit()
+        logger.debug('Selected %s out of %s using strategy %s',
+                     selected.url, endpoints, strategy)
+        return selected.url
+    finally:
+        dbs.close()
+
+
+def _fastest_endpoint(endpoints, now):
+    '''Get the endpoint with the best expected upload throughput. Endpoints
+    without recent measurements are tried first so that every endpoint gets
+    measured.
+    '''
+    def expected_throughput(endpoint):
+        if not endpoint.throughput or not endpoint.throughput_updated:
+            return None
+        age = (now - endpoint.throughput_updated).total_seconds()
+        if age > THROUGHPUT_MAX_AGE:
+            return None
+        return endpoint.throughput * (1 - (endpoint.error_rate or 0))
+
+    throughput = {e.url: expected_throughput(e) for e in endpoints}
+    unknown = [e for e in endpoints if throughput[e.url] is None]
+    if unknown:
+        # nosec: we do not need a secure random number here
+        return random.choice(unknown)  # nosec
+    return max(endpoints, key=lambda e: throughput[e.url])
+
+
+def backoff(attempt, base=1, maximum=300):
+    '''Get a randomized delay for retrying an operation which grows
+    exponentially with the number of attempts.
+
+    :param attempt: Number of failed attempts so far
+    :param base: Delay after the first failure in seconds
+    :param maximum: Maximum delay in seconds
+    :return: Delay in seconds
+    '''
+    delay = min(base * 2 ** attempt, maximum)
+    # nosec: we do not need a secure random number here
+    return random.uniform(delay / 2, delay)  # nosec
 
 
 def ensurelist(x):
@@ -157,33 +797,70 @@ def ensurelist(x):
     return x if type(x) is list else [x]
 
 
-def register_ca(status='idle'):
+def register_ca(status='idle', force=True):
     '''Register this capture agent at the Matterhorn admin server so that it
     shows up in the admin interface.
 
     :param status: Current status of the capture agent
+    :param force: Send the status even if it has been sent recently
+    :return: False if the state could not be sent, True otherwise
     '''
     # If this is a backup CA we don't tell the Matterhorn core that we are
     # here.  We will just run silently in the background:
     if config('agent', 'backup_mode'):
-        return
+        return True
     service_endpoint = service('capture.admin')
     if not service_endpoint:
         logger.warning('Missing endpoint for updating agent status.')
-        return
+        return False
     params = [('address', config('ui', 'url')), ('state', status)]
     name = urlquote(config('agent', 'name').encode('utf-8'), safe='')
     url = f'{service_endpoint[0]}/agents/{name}'
+    dbs = db.get_session()
     try:
-        response = http_request(url, params).decode('utf-8')
-        if response:
-            logger.info(response)
-    except pycurl.error as e:
-        logger.warning('Could not set agent state to %s: %s', status, e)
+        if not force and agent_state_unchanged(dbs, url, status):
+            logger.debug('Agent state %s has not changed', status)
+            db.Statistic.increase({'agentstate_updates_suppressed': 1})
+            return True
+        try:
+            response = http_request(url, params).decode('utf-8')
+            if response:
+                logger.info(response)
+        except pycurl.error as e:
+            logger.warning('Could not set agent state to %s: %s', status, e)
+            return False
+        dbs.merge(db.UpstreamState(url=url,
+                                   agent_state=status,
+                                   agent_state_sent=datetime.utcnow()))
+        dbs.commit()
+    finally:
+        dbs.close()
+    db.Statistic.increase({'agentstate_updates_sent': 1})
+    return True
+
+
+def agent_state_unchanged(dbs, url, status):
+    '''Check if a state has already been sent to Opencast within the
+    configured keep-alive interval.
+
+    :param dbs: Database session
+    :param url: Agent endpoint the state is sent to
+    :param status: Current status of the capture agent
+    :return: True if the state does not need to be sent
+    '''
+    keepalive = config('agent', 'state_keepalive')
+    state = dbs.query(db.UpstreamState)\
+               .filter(db.UpstreamState.url == url)\
+               .first()
+    if not keepalive or not state or state.agent_state != status:
+        return False
+    age = (datetime.utcnow() - state.agent_state_sent).total_seconds()
+    return 0 <= age < keepalive
 
 
 def recording_state(recording_id, status):
-    '''Send the state of the current recording to the Matterhorn core.
+    '''Send the state of the current recording to the Matterhorn core. The
+    state is queued and sent in the background.
 
     :param recording_id: ID of the current recording
     :param status: Status of the recording
@@ -193,6 +870,16 @@ def recording_state(recording_id, status):
     # in the background:
     if config('agent', 'backup_mode'):
         return
+    queue_state_update(('recording', recording_id), status)
+
+
+def send_recording_state(recording_id, status):
+    '''Send the state of a recording to the Matterhorn core right away.
+
+    :param recording_id: ID of the current recording
+    :param status: Status of the recording
+    :return: False if sending the state failed and should be retried
+    '''
     params = [('state', status)]
     url = service('capture.admin')[0]
     url += f'/recordings/{recording_id}'
@@ -200,7 +887,98 @@ def recording_state(recording_id, status):
         result = http_request(url, params).decode('utf-8')
         logger.info(result)
     except pycurl.error as e:
+        # Client errors like an unknown recording will not go away
+        if 400 <= getattr(e, 'status', 0) < 500:
+            logger.error('Dropping recording state %s of %s: %s',
+                         status, recording_id, e)
+            return True
         logger.warning('Could not set recording state to %s: %s', status, e)
+        return False
+    return True
+
+
+def queue_state_update(key, status=None):
+    '''Queue a state update to be sent to Opencast by a background thread.
+    Updates are sent in order. A pending update for the same key is replaced
+    by the new one.
+
+    :param key: Tuple identifying the updated object
+    :param status: State to send
+    '''
+    global _outbox_thread, _outbox_pid
+    with _outbox_condition:
+        if _outbox_pid != os.getpid():
+            # Threads do not survive forking
+            _outbox.clear()
+            _outbox_thread = None
+            _outbox_pid = os.getpid()
+        for update in [u for u in _outbox if u[0] == key]:
+            _outbox.remove(update)
+        _outbox.append((key, status))
+        if _outbox_thread is None:
+            _outbox_thread = threading.Thread(
+                target=_send_state_updates,
+                args=(_outbox, _outbox_condition),
+                daemon=True)
+            _outbox_thread.start()
+        _outbox_condition.notify_all()
+
+
+def _send_state_updates(outbox, condition):
+    '''Send queued state updates to Opencast. Failed updates are retried
+    with an exponentially growing delay. An update which keeps failing is
+    dropped after a limited number of attempts to not hold back later ones.
+    '''
+    delay, attempts, update = 1, 0, None
+    while True:
+        with condition:
+            while not outbox:
+                condition.wait()
+            if outbox is not _outbox:
+                # The queue has been replaced, e.g. by reloading the module
+                return
+            if outbox[0] is not update:
+                # Start over with the next or a replacing update
+                delay, attempts = 1, 0
+            update = outbox[0]
+        key, status = update
+        try:
+            if key[0] == 'agent':
+                success = update_agent_state()
+            else:
+                success = send_recording_state(key[1], status)
+        except Exception:
+            logger.exception('Dropping state update %s %s', key, status)
+            success = True
+        attempts += 1
+        if not success and attempts >= STATE_UPDATE_ATTEMPTS:
+            logger.error('Dropping state update %s %s after %i attempts',
+                         key, status, attempts)
+        elif not success:
+            logger.info('Retrying state update in %i seconds', delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 300)
+            continue
+        with condition:
+            if outbox and outbox[0] == update:
+                outbox.popleft()
+            condition.notify_all()
+
+
+@atexit.register
+def flush_state_updates(timeout=10):
+    '''Wait for queued state updates to be sent.
+
+    :param timeout: Maximum time to wait in seconds
+    :return: True if all updates have been sent
+    '''
+    deadline = time.time() + timeout
+    with _outbox_condition:
+        if _outbox_pid != os.getpid():
+            return True
+        while _outbox and time.time() < deadline:
+            _outbox_condition.wait(deadline - time.time())
+        return not _outbox
 
 
 @db.with_session
@@ -227,10 +1005,10 @@ def set_service_status(dbs, service, status):
 
 def set_service_status_immediate(service, status):
     '''Update the status of a particular service in the database and send an
-    immediate signal to Opencast.
+    immediate signal to Opencast in the background.
     '''
     set_service_status(service, status)
-    update_agent_state()
+    queue_state_update(('agent',))
 
 
 @db.with_session
@@ -245,20 +1023,29 @@ def get_service_status(dbs, service):
     return db.ServiceStatus.STOPPED
 
 
-def update_agent_state():
-    '''Update the current agent state in opencast.
+@db.with_session
+def update_agent_state(dbs, force=False):
+    '''Update the current agent state in opencast. The state is only sent if
+    it has changed or if the keep-alive interval has passed.
+
+    :param force: Send the state even if it has not changed
+    :return: False if the state could not be sent, True otherwise
     '''
-    status = 'idle'
+    services = {srv.type: srv.status for srv in dbs.query(db.ServiceStates)}
+
+    def status(service):
+        return services.get(service, db.ServiceStatus.STOPPED)
 
     # Determine reported agent state with priority list
-    if get_service_status(db.Service.SCHEDULE) == db.ServiceStatus.STOPPED:
-        status = 'offline'
-    elif get_service_status(db.Service.CAPTURE) == db.ServiceStatus.BUSY:
-        status = 'capturing'
-    elif get_service_status(db.Service.INGEST) == db.ServiceStatus.BUSY:
-        status = 'uploading'
-
-    register_ca(status=status)
+    state = 'idle'
+    if status(db.Service.SCHEDULE) == db.ServiceStatus.STOPPED:
+        state = 'offline'
+    elif status(db.Service.CAPTURE) == db.ServiceStatus.BUSY:
+        state = 'capturing'
+    elif status(db.Service.INGEST) == db.ServiceStatus.BUSY:
+        state = 'uploading'
+
+    return register_ca(status=state, force=force)
 
 
 def terminate(shutdown=None):
@@ -22,7 +22,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        "pycurl>=7.19.5",
+        "pycurl>=7.45.5",
         "python-dateutil>=2.4.0",
         "configobj>=5.0.0",
         "sqlalchemy>=0.9.8",
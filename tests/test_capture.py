@@ -4,10 +4,13 @@
 Tests for basic capturing
 '''
 
+import datetime
 import os
 import os.path
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 from pyca import capture, config, db, utils
@@ -26,10 +29,11 @@ class TestPycaCapture(unittest.TestCase):
         config.config()['capture']['command'] = 'touch {{dir}}/{{name}}.mp4'
         config.config()['capture']['directory'] = self.cadir
         config.config()['capture']['preview'] = [preview]
-        config.config()['services']['org.opencastproject.capture.admin'] = ['']
 
         # Mock event
         db.init()
+        utils.store_service_endpoints('org.opencastproject.capture.admin',
+                                      [''])
         self.event = db.BaseEvent()
         self.event.uid = '123123'
         self.event.title = u'äüÄÜß'
@@ -54,12 +58,130 @@ class TestPycaCapture(unittest.TestCase):
         os.close(self.fd)
         os.remove(self.dbfile)
         shutil.rmtree(self.cadir)
+        reload(capture.retention)
         reload(capture)
         reload(config)
         reload(utils)
 
     def test_start_capture(self):
         capture.start_capture(self.event)
+        event = db.get_session().query(db.RecordedEvent).one()
+        self.assertGreaterEqual(event.start_latency, 0)
+        self.assertIsNotNone(event.exit_latency)
+
+    def test_record_latencies(self):
+        capture.start_capture(self.event)
+        capture.start_capture(self.event)
+        statistics = {(s.name, s.label): s.value
+                      for s in db.get_session().query(db.Statistic)}
+
+        # The start latency of the restarted recording is not observed
+        self.assertEqual(statistics[('capture_start_latency_count', '')], 1)
+        self.assertEqual(statistics[('capture_exit_latency_count', '')], 2)
+        self.assertEqual(statistics[('capture_restarts', '')], 1)
+        self.assertEqual(statistics[('capture_start_latency_bucket', '300')],
+                         1)
+
+    def test_start_capture_segmented(self):
+        config.config()['capture']['segmented'] = True
+        config.config()['capture']['command'] = \
+            'sh -c "touch {{dir}}/part-000.ts; sleep 0.3; ' \
+            'touch {{dir}}/part-001.ts; sleep 0.3"'
+        config.config()['capture']['files'] = ['{{dir}}/part-*.ts']
+        capture.SEGMENT_INTERVAL = 0
+        stored = []
+        capture.store_segments = lambda event, tracks: stored.append(
+            [os.path.basename(track) for _, track in tracks])
+        capture.start_capture(self.event)
+
+        # Segments are handed over once the next one has been started
+        self.assertEqual(stored, [['part-000.ts']])
+        event = db.get_session().query(db.RecordedEvent).one()
+        self.assertEqual([(flavor, os.path.basename(track))
+                          for flavor, track in event.get_tracks()],
+                         [('presenter/source', 'part-000.ts'),
+                          ('presenter/source', 'part-001.ts')])
+        self.assertEqual(event.status, db.Status.FINISHED_RECORDING)
+
+    def test_record_bitrate(self):
+        config.config()['capture']['command'] = \
+            'sh -c "head -c 1000 /dev/zero > {{dir}}/{{name}}.webm"'
+        capture.start_capture(self.event)
+        capture.start_capture(self.event)
+        session = db.get_session()
+        self.assertEqual(session.query(db.Statistic.value).filter(
+            db.Statistic.name == 'capture_bytes').scalar(), 2000)
+        self.assertGreater(capture.observed_bitrate(session), 0)
+
+        # Bitrates are tracked for each capture command
+        config.config()['capture']['command'] = 'true'
+        self.assertIsNone(capture.observed_bitrate(session))
+        session.close()
+
+    def test_check_disk_space(self):
+        config.config()['capture']['space_margin'] = 0
+        session = db.get_session()
+        event = db.RecordedEvent(self.event)
+        event.end = utils.timestamp() + 100
+        self.assertTrue(capture.check_disk_space(session, event))
+        self.assertIsNone(event.estimated_size)
+
+        # 1000 bytes per second for 100 seconds
+        db.Statistic.increase({'capture_bytes': 1000, 'capture_seconds': 1},
+                              label=capture.command_label())
+        capture.retention.disk_usage = lambda: (10 ** 9, 0, 200000)
+        self.assertTrue(capture.check_disk_space(session, event))
+        self.assertAlmostEqual(event.estimated_size, 100000, delta=2000)
+        self.assertEqual(event.space_available, 200000)
+
+        # Space is reserved for recordings starting before this one ends
+        upcoming = db.UpcomingEvent()
+        upcoming.uid = 'next'
+        upcoming.start = utils.timestamp() + 50
+        upcoming.end = upcoming.start + 150
+        upcoming.set_data({})
+        session.add(upcoming)
+        session.commit()
+        # Nothing is removed before the recording started
+        capture.retention.evict = should_fail
+        self.assertFalse(capture.check_disk_space(session, event))
+        self.assertAlmostEqual(event.space_available, 50000, delta=2000)
+        session.close()
+
+    def test_free_disk_space(self):
+        event = db.RecordedEvent(self.event)
+        event.estimated_size = 100000
+        event.space_available = 50000
+        session = db.get_session()
+        session.add(event)
+        session.commit()
+        evicted = []
+        capture.retention.disk_usage = lambda: (10 ** 9, 0, 200000)
+        capture.retention.evict = lambda free: evicted.append(free) or 10000
+        capture.free_disk_space(event.uid, event.start, 50000)
+        self.assertEqual(evicted, [250000])
+        session.refresh(event)
+        self.assertEqual(event.space_available, 60000)
+        session.close()
+
+    def test_start_capture_frees_disk_space(self):
+        db.Statistic.increase({'capture_bytes': 10 ** 9,
+                               'capture_seconds': 1},
+                              label=capture.command_label())
+        self.event.end = self.event.start + 100
+        freed = threading.Event()
+        calls = []
+
+        def free_disk_space(uid, start, missing):
+            calls.append((uid, missing))
+            freed.set()
+
+        capture.safe_free_disk_space = free_disk_space
+        capture.start_capture(self.event)
+        # Uploaded recordings are removed once the capture process started
+        self.assertTrue(freed.wait(5))
+        self.assertEqual(calls[0][0], self.event.uid)
+        self.assertGreater(calls[0][1], 0)
 
     def test_start_capture_recording_command_failure(self):
         config.config()['capture']['command'] = 'false'
@@ -87,6 +209,71 @@ class TestPycaCapture(unittest.TestCase):
         capture.terminate = terminate_fn(1)
         capture.run()
 
+    def test_run_starts_due_event(self):
+        event = db.UpcomingEvent()
+        event.uid = '123'
+        event.start = utils.timestamp()
+        event.end = event.start + 10
+        event.set_data({})
+        session = db.get_session()
+        session.add(event)
+        session.commit()
+        session.close()
+
+        started = []
+        capture.safe_start_capture = lambda e: started.append(e.uid)
+        capture.terminate = terminate_fn(1)
+        capture.run()
+        self.assertEqual(started, ['123'])
+
+    def test_run_restarts_failed_event(self):
+        event = db.UpcomingEvent()
+        event.uid = '123'
+        event.start = utils.timestamp()
+        event.end = event.start + 10
+        event.set_data({})
+        session = db.get_session()
+        session.add(event)
+        session.commit()
+        session.close()
+
+        # Restarts are delayed by 0.2, 0.4, 0.8, … seconds
+        started = []
+        capture.RESTART_DELAY = 0.2
+        capture.start_capture = lambda e: started.append(time.time()) \
+            or should_fail()
+        deadline = time.time() + 1
+        capture.terminate = lambda: time.time() > deadline
+        capture.run()
+        self.assertIn(len(started), (2, 3))
+        self.assertGreaterEqual(started[1] - started[0], 0.2)
+
+    def test_next_schedule_check(self):
+        frequency = config.config('agent', 'update_frequency')
+        session = db.get_session()
+        now = time.time()
+        self.assertGreaterEqual(capture.next_schedule_check(session),
+                                now + frequency)
+
+        # Next check right after the next schedule update
+        last_synced = datetime.datetime.utcnow()
+        session.merge(db.UpstreamState(url=config.config('server', 'url'),
+                                       last_synced=last_synced))
+        session.commit()
+        next_check = capture.next_schedule_check(session)
+        self.assertLessEqual(next_check, now + frequency + 1)
+        self.assertGreater(next_check, now + frequency - 1)
+
+        # Overdue schedule update
+        last_synced -= datetime.timedelta(seconds=frequency + 10)
+        session.merge(db.UpstreamState(url=config.config('server', 'url'),
+                                       last_synced=last_synced))
+        session.commit()
+        next_check = capture.next_schedule_check(session)
+        self.assertLess(next_check, time.time() + frequency)
+        self.assertGreater(next_check, time.time())
+        session.close()
+
     def test_sigterm(self):
         with self.assertRaises(BaseException) as e:
             capture.sigterm_handler(0, 0)
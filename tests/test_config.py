@@ -4,9 +4,11 @@
 Tests for pyCA configuration
 '''
 
+import tempfile
 import unittest
 
 from pyca import config
+from tests.tools import reload
 
 
 class TestPycaConfig(unittest.TestCase):
@@ -16,3 +18,23 @@ class TestPycaConfig(unittest.TestCase):
         config.config()['server']['certificate'] = '/xxx'
         with self.assertRaises(IOError):
             config.check()
+
+    def test_parse_rate_schedule(self):
+        schedule = config.parse_rate_schedule(['08:00-18:00 2m',
+                                               '22:30-06:00 0'])
+        self.assertEqual(schedule, [(480, 1080, 2000000), (1350, 360, 0)])
+        with self.assertRaises(ValueError):
+            config.parse_rate_schedule(['08:00 2m'])
+
+    def test_segment_workflow(self):
+        self.addCleanup(reload, config)
+        with tempfile.NamedTemporaryFile('w', suffix='.conf') as cfg:
+            cfg.write('[capture]\nsegmented = True\n')
+            cfg.flush()
+            # Segments are separate tracks which need to be joined
+            with self.assertRaises(ValueError):
+                config.update_configuration(cfg.name)
+            cfg.write('[ingest]\nsegment_workflow = concat\n')
+            cfg.flush()
+            self.assertEqual(config.update_configuration(cfg.name)['ingest']
+                             ['segment_workflow'], 'concat')
@@ -63,6 +63,28 @@ class TestPycaDb(unittest.TestCase):
         self.assertEqual(e.serialize()['id'], 'asd')
         self.assertEqual(e.get_tracks(), [])
 
+    def test_migrate(self):
+        engine = db.create_engine(config.config('agent', 'database'))
+        with engine.begin() as connection:
+            connection.execute(db.text(
+                'create table upstream_state (url text primary key)'))
+        db.init()
+        columns = [c['name'] for c in
+                   db.inspect(db.engine).get_columns('upstream_state')]
+        self.assertIn('calendar_etag', columns)
+
+    def test_statistic(self):
+        db.init()
+        db.Statistic.increase({'a': 1, 'b': 2}, label='x')
+        db.Statistic.increase({'a': 1})
+        db.Statistic.increase({'a': 1})
+        db.Statistic.update('c', 5)
+        db.Statistic.update('c', 3)
+        values = {(s.name, s.label): s.value
+                  for s in db.get_session().query(db.Statistic)}
+        self.assertEqual(values, {('a', 'x'): 1, ('b', 'x'): 2, ('a', ''): 2,
+                                  ('c', ''): 3})
+
     def test_servicestate(self):
         s = db.ServiceStates()
         s.type = 0
@@ -4,16 +4,22 @@
 Tests for basic capturing
 '''
 
+import hashlib
 import os
 import os.path
+import pycurl
 import shutil
 import tempfile
+import threading
 import unittest
 
+from datetime import datetime, timedelta
 from unittest.mock import patch
+from xml.etree import ElementTree
 
 from pyca import ingest, config, db, utils
-from tests.tools import should_fail, terminate_fn
+from tests import tools
+from tests.tools import should_fail, terminate_fn, OpencastMock, reload
 
 
 class TestPycaIngest(unittest.TestCase):
@@ -24,11 +30,12 @@ class TestPycaIngest(unittest.TestCase):
         self.cadir = tempfile.mkdtemp()
         config.config('agent')['database'] = 'sqlite:///' + self.dbfile
         config.config('capture')['directory'] = self.cadir
-        config.config()['services']['org.opencastproject.ingest'] = ['']
-        config.config()['services']['org.opencastproject.capture.admin'] = ['']
 
         # Mock event
         db.init()
+        utils.store_service_endpoints('org.opencastproject.ingest', [''])
+        utils.store_service_endpoints('org.opencastproject.capture.admin',
+                                      [''])
         event = db.RecordedEvent()
         event.uid = '123123'
         event.status = db.Status.FINISHED_RECORDING
@@ -63,6 +70,8 @@ class TestPycaIngest(unittest.TestCase):
         os.close(self.fd)
         os.remove(self.dbfile)
         shutil.rmtree(self.cadir)
+        reload(ingest)
+        reload(config)
 
     @patch(__name__+'.ingest.ingest')
     def test_safe_start_ingest(self, ingest_fn):
@@ -79,6 +88,397 @@ class TestPycaIngest(unittest.TestCase):
         config.config('agent')['backup_mode'] = True
         ingest.run()
 
+    def test_upload_chunked(self):
+        opencast = OpencastMock()
+        self.addCleanup(opencast.stop)
+        ingest.http_request = utils.http_request
+        config.config('ingest')['chunk_size'] = 4
+        self.addCleanup(config.config('ingest').__setitem__, 'chunk_size', 0)
+        track = os.path.join(self.cadir, 'track.mp4')
+        with open(track, 'wb') as f:
+            f.write(b'0123456789')
+
+        # Interrupt the upload after the first chunk
+        opencast.fail_chunks = {1}
+        with self.assertRaises(pycurl.error):
+            ingest.add_track(opencast.url + '/ingest', '', 'a/b', track)
+        upload = db.get_session().query(db.TrackUpload).one()
+        self.assertEqual(upload.chunks, 1)
+
+        # Resume with the missing chunks
+        ingest.add_track(opencast.url + '/ingest', '', 'a/b', track)
+        self.assertEqual(opencast.tracks, [b'0123456789'])
+        self.assertEqual(len(opencast.jobs), 1)
+        chunks = [fields['chunknumber'] for path, fields in opencast.requests
+                  if path == '/upload/job/1']
+        self.assertEqual(chunks, [b'0', b'1', b'1', b'2'])
+
+        # Restart the upload if the job does not exist any longer
+        opencast.jobs.clear()
+        ingest.add_track(opencast.url + '/ingest', '', 'a/b', track)
+        self.assertEqual(opencast.tracks, [b'0123456789'] * 2)
+
+        # Files uploaded completely before are referenced
+        ingest.add_track(opencast.url + '/ingest', '', 'a/b', track)
+        self.assertEqual(opencast.requests[-1][1]['url'],
+                         (opencast.url + '/upload/job/1/data').encode())
+        self.assertEqual(len(opencast.jobs), 1)
+
+        # Small files are uploaded in a single request
+        ingest.remove_track_uploads(self.event)
+        session = db.get_session()
+        session.query(db.TrackUpload).delete()
+        session.commit()
+        config.config('ingest')['chunk_size'] = 10
+        ingest.add_track(opencast.url + '/ingest', '', 'a/b', track)
+        self.assertEqual(opencast.tracks, [b'0123456789'] * 4)
+        self.assertEqual(opencast.requests[-1][1]['BODY1'], b'0123456789')
+        self.assertEqual(len(opencast.jobs), 1)
+
+    def test_upload_chunked_endpoint_health(self):
+        opencast = OpencastMock()
+        self.addCleanup(opencast.stop)
+        ingest.http_request = utils.http_request
+        service_url = opencast.url + '/ingest'
+        utils.store_service_endpoints('org.opencastproject.ingest',
+                                      [service_url])
+        track = os.path.join(self.cadir, 'track.mp4')
+        with open(track, 'wb') as f:
+            f.write(b'0' * 2200000)
+
+        # Requests to the upload service count towards the ingest service
+        opencast.fail_chunks = {1}
+        with self.assertRaises(pycurl.error):
+            ingest.upload_chunked(service_url, track, 1100000)
+        endpoint = db.get_session().query(db.ServiceEndpoint)\
+            .filter(db.ServiceEndpoint.url == service_url).one()
+        self.assertEqual(endpoint.failures, 1)
+        ingest.upload_chunked(service_url, track, 1100000)
+        endpoint = db.get_session().query(db.ServiceEndpoint)\
+            .filter(db.ServiceEndpoint.url == service_url).one()
+        self.assertEqual(endpoint.failures, 0)
+        self.assertGreater(endpoint.throughput, 0)
+
+    def test_upload_segments(self):
+        opencast = OpencastMock()
+        self.addCleanup(opencast.stop)
+        ingest.http_request = utils.http_request
+        utils.store_service_endpoints('org.opencastproject.ingest',
+                                      [opencast.url + '/ingest'])
+        config.config('capture')['segmented'] = True
+        config.config('ingest')['segment_workflow'] = 'concat'
+        segment = os.path.join(self.event.directory(), 'test-000.ts')
+        with open(segment, 'wb') as f:
+            f.write(b'segment')
+        last = os.path.join(self.event.directory(), 'test-001.ts')
+        with open(last, 'wb') as f:
+            f.write(b'last')
+        self.assertIsNone(ingest.uploaded_url(segment))
+
+        # Segments of running recordings are uploaded in advance
+        session = db.get_session()
+        event = session.query(db.RecordedEvent).one()
+        event.status = db.Status.RECORDING
+        event.set_tracks([('presenter/source', segment)])
+        session.commit()
+        ingest.upload_segments()
+        ingest.upload_segments()
+        self.assertEqual(len(opencast.jobs), 1)
+        url = ingest.uploaded_url(segment)
+        self.assertEqual(url, opencast.url + '/upload/job/1/data')
+
+        # Segments are left to the ingest once the recording ended
+        event.status = db.Status.FINISHED_RECORDING
+        event.set_tracks([('presenter/source', segment),
+                          ('presenter/source', last)])
+        session.commit()
+        ingest.upload_segments()
+        self.assertEqual(len(opencast.jobs), 1)
+
+        # The ingest waits for segments still being uploaded
+        session.refresh(event)
+        session.expunge(event)
+        session.close()
+        reserved = ingest.reserve_tracks([last])
+        reserved.__enter__()
+        thread = threading.Thread(target=ingest.ingest, args=(event,))
+        thread.start()
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive())
+        reserved.__exit__(None, None, None)
+        thread.join()
+
+        # Uploaded segments are referenced and joined by the segment workflow
+        # which is told about the scheduled workflow
+        self.assertEqual(opencast.tracks, [b'segment', b'last'])
+        added = [fields for path, fields in opencast.requests
+                 if path == '/ingest/addTrack']
+        self.assertEqual(added[0]['url'], url.encode())
+        path, fields = opencast.requests[-1]
+        self.assertEqual(path, '/ingest/ingest')
+        self.assertEqual(fields['workflowDefinitionId'], b'concat')
+        self.assertEqual(fields['scheduledWorkflowDefinitionId'], b'fast')
+
+    def test_add_tracks_parallel(self):
+        opencast = OpencastMock()
+        self.addCleanup(opencast.stop)
+        opencast.delay = 0.2
+        ingest.http_request = utils.http_request
+        config.config('ingest')['upload_concurrency'] = 3
+        self.addCleanup(config.config('ingest').__setitem__,
+                        'upload_concurrency', 1)
+        tracks = []
+        for flavor in ('presenter/source', 'presentation/source', 'a/b'):
+            track = os.path.join(self.cadir, flavor.split('/')[0])
+            with open(track, 'wb') as f:
+                f.write(flavor.encode())
+            tracks.append((flavor, track))
+
+        mediapackage = ingest.add_tracks(opencast.url + '/ingest',
+                                         tools.MEDIAPACKAGE, tracks)
+        self.assertEqual(opencast.max_active, 3)
+        self.assertEqual(sorted(opencast.tracks),
+                         sorted(flavor.encode() for flavor, _ in tracks))
+
+        # All tracks are part of the merged mediapackage in order
+        namespace = '{http://mediapackage.opencastproject.org}'
+        media = ElementTree.fromstring(mediapackage).find(namespace + 'media')
+        self.assertEqual([track.get('type') for track in media],
+                         [flavor for flavor, _ in tracks])
+        self.assertIn(b'<mediapackage xmlns=', mediapackage)
+
+    def test_stream_track(self):
+        opencast = OpencastMock()
+        self.addCleanup(opencast.stop)
+        ingest.http_request = utils.http_request
+        config.config('ingest')['streaming_upload'] = True
+        config.config('ingest')['checksum'] = 'sha256'
+        data = os.urandom(3 * utils.UPLOAD_BUFFER_SIZE + 1)
+        track = os.path.join(self.cadir, 'track.mp4')
+        with open(track, 'wb') as f:
+            f.write(data)
+        empty = os.path.join(self.cadir, 'empty.mp4')
+        open(empty, 'wb').close()
+
+        sent = []
+        mediapackage = ingest.add_track(opencast.url + '/ingest',
+                                        tools.MEDIAPACKAGE, 'a/b', track,
+                                        sent.append)
+        mediapackage = ingest.add_track(opencast.url + '/ingest',
+                                        mediapackage, 'c/d', empty)
+        self.assertEqual(opencast.tracks, [data, b''])
+        self.assertEqual(max(sent), len(data))
+
+        # The checksums are added to the new tracks
+        namespace = '{http://mediapackage.opencastproject.org}'
+        media = ElementTree.fromstring(mediapackage).find(namespace + 'media')
+        checksums = [(track.find(namespace + 'checksum').get('type'),
+                      track.find(namespace + 'checksum').text)
+                     for track in media]
+        self.assertEqual(checksums,
+                         [('sha-256', hashlib.sha256(data).hexdigest()),
+                          ('sha-256', hashlib.sha256(b'').hexdigest())])
+
+    def test_ingest_single_request(self):
+        opencast = OpencastMock()
+        self.addCleanup(opencast.stop)
+        ingest.http_request = utils.http_request
+        utils.store_service_endpoints('org.opencastproject.ingest',
+                                      [opencast.url + '/ingest'])
+        config.config('ingest')['single_request'] = True
+        config.config('ingest')['upload_catalogs'] = True
+        config.config('ingest')['chunk_size'] = 4
+        self.addCleanup(config.config('ingest').__setitem__, 'chunk_size', 0)
+        tracks = []
+        for name, data in (('a', b'0123456789'), ('b', b'012')):
+            track = os.path.join(self.cadir, name)
+            with open(track, 'wb') as f:
+                f.write(data)
+            tracks.append(('%s/source' % name, track))
+        self.event.set_tracks(tracks)
+
+        ingest.ingest(self.event)
+        path, fields = opencast.requests[-1]
+        self.assertEqual(path, '/ingest/addMediaPackage/fast')
+        self.assertEqual(fields['workflowInstanceId'], b'123123')
+        self.assertEqual(fields['x'], b'123')
+        self.assertIn('episodeDCCatalog', fields)
+        self.assertEqual(opencast.tracks, [b'0123456789', b'012'])
+        self.assertNotIn('/ingest/createMediaPackage',
+                         [path for path, _ in opencast.requests])
+        event = db.get_session().query(db.RecordedEvent).one()
+        self.assertEqual(event.status, db.Status.FINISHED_UPLOADING)
+        self.assertEqual([t['sent'] for t in event.get_upload_progress()],
+                         [10, 3])
+
+        # Fall back to step by step ingest
+        opencast.single_request_error = 404
+        opencast.tracks.clear()
+        ingest.ingest(self.event)
+        self.assertEqual(opencast.tracks, [b'0123456789', b'012'])
+        self.assertEqual(opencast.requests[-1][0], '/ingest/ingest')
+
+        # Other errors do not cause a second upload
+        opencast.single_request_error = 500
+        opencast.requests.clear()
+        with self.assertRaises(pycurl.error):
+            ingest.ingest(self.event)
+        self.assertNotIn('/ingest/createMediaPackage',
+                         [path for path, _ in opencast.requests])
+
+        # Catalogs other than episode and series are ingested step by step
+        opencast.single_request_error = None
+        opencast.requests.clear()
+        dcns = 'http://www.opencastproject.org/xsd/1.0/dublincore/'
+        self.event.set_data({'attach': [{'data': dcns,
+                                         'fmttype': 'application/xml',
+                                         'x-apple-filename': 'extra.xml'}]})
+        ingest.ingest(self.event)
+        self.assertIn(('/ingest/addDCCatalog', 'dublincore/extra'),
+                      [(path, fields.get('flavor', b'').decode())
+                       for path, fields in opencast.requests])
+        self.assertNotIn('/ingest/addMediaPackage',
+                         [path for path, _ in opencast.requests])
+
+    def test_set_track_checksum(self):
+        track = '<track id="t1"><url>x</url><checksum type="md5">%s' \
+                '</checksum><duration>1</duration></track></media>'
+        result = tools.MEDIAPACKAGE.replace('</media>', track % 'abc')
+        mediapackage = ingest.set_track_checksum(tools.MEDIAPACKAGE, result,
+                                                 'md5', 'abc')
+        self.assertIn(b'<url>x</url><checksum type="md5">abc</checksum>',
+                      mediapackage)
+        with self.assertRaises(RuntimeError):
+            ingest.set_track_checksum(tools.MEDIAPACKAGE, result, 'md5', 'x')
+
+        # Tracks which were part of the mediapackage before are not touched
+        self.assertEqual(ingest.set_track_checksum(result, result, 'md5', 'x'),
+                         ingest.set_track_checksum(result, result, 'md5', 'y'))
+
+    def test_upload_progress(self):
+        opencast = OpencastMock()
+        self.addCleanup(opencast.stop)
+        ingest.http_request = utils.http_request
+        config.config('ingest')['chunk_size'] = 4
+        self.addCleanup(config.config('ingest').__setitem__, 'chunk_size', 0)
+        tracks = []
+        for name, data in (('a', b'0123456789'), ('b', b'012')):
+            track = os.path.join(self.cadir, name)
+            with open(track, 'wb') as f:
+                f.write(data)
+            tracks.append(('%s/source' % name, track))
+
+        reported = []
+        progress = ingest.UploadProgress(self.event, tracks)
+        progress.INTERVAL = 0
+        update = progress.update
+        progress.update = lambda i, sent: reported.append((i, sent)) or \
+            update(i, sent)
+        ingest.add_tracks(opencast.url + '/ingest', '', tracks, progress)
+
+        # Progress of chunked uploads is reported relative to the whole file
+        self.assertEqual(max(s for i, s in reported if i == 0), 10)
+        self.assertIn((0, 8), reported)
+        self.assertIn(1, [i for i, _ in reported])
+        event = db.get_session().query(db.RecordedEvent).one()
+        stored = event.serialize()['attributes']['upload_progress']
+        self.assertEqual([(t['flavor'], t['sent'], t['total'], t['eta'])
+                          for t in stored],
+                         [('a/source', 10, 10, 0), ('b/source', 3, 3, 0)])
+        self.assertIsNotNone(stored[0]['rate'])
+        uploaded = db.get_session().query(db.Statistic).filter(
+            db.Statistic.name == 'ingest_uploaded_bytes').one()
+        self.assertEqual(uploaded.value, 13)
+
+    def test_claim_next_event(self):
+        session = db.get_session()
+        for offset, size in ((-10, 5), (10, 1)):
+            event = db.RecordedEvent(self.event)
+            event.start += offset
+            event.status = db.Status.FINISHED_RECORDING
+            os.makedirs(event.directory())
+            track = os.path.join(event.directory(), 'test.mp4')
+            with open(track, 'wb') as f:
+                f.write(b'x' * size)
+            event.set_tracks([('presenter/source', track)])
+            session.add(event)
+        session.commit()
+        start = self.event.start
+
+        config.config('ingest')['priority'] = 'smallest'
+        self.assertEqual(ingest.claim_next_event().start, start)
+        config.config('ingest')['priority'] = 'newest'
+        self.assertEqual(ingest.claim_next_event().start, start + 10)
+        config.config('ingest')['priority'] = 'oldest'
+        self.assertEqual(ingest.claim_next_event().start, start - 10)
+
+        # Leased recordings are not picked up again until the lease expires
+        self.assertIsNone(ingest.claim_next_event())
+        session.query(db.RecordedEvent)\
+               .filter(db.RecordedEvent.start == start)\
+               .update({'lease': datetime.utcnow() - timedelta(seconds=1)})
+        session.commit()
+        event = ingest.claim_next_event()
+        self.assertEqual(event.start, start)
+        self.assertEqual(event.status, db.Status.UPLOADING)
+        ingest.renew_leases([event])
+        self.assertIsNone(ingest.claim_next_event())
+
+    @patch(__name__+'.ingest.ingest')
+    def test_retry(self, ingest_fn):
+        ingest_fn.side_effect = should_fail
+        config.config('ingest')['max_attempts'] = 2
+        event = ingest.claim_next_event()
+        ingest.safe_start_ingest(event)
+        self.assertEqual(event.attempts, 1)
+        self.assertGreater(event.next_retry, datetime.utcnow())
+
+        # Failed recordings are not uploaded before the retry is due
+        self.assertIsNone(ingest.claim_next_event())
+        self.assertIsNone(ingest.claim_next_event(retries=True))
+        session = db.get_session()
+        session.query(db.RecordedEvent)\
+               .update({'next_retry': datetime.utcnow()})
+        session.commit()
+        self.assertIsNone(ingest.claim_next_event())
+        event = ingest.claim_next_event(retries=True)
+        self.assertEqual(event.status, db.Status.UPLOADING)
+
+        # Give up after the maximum number of attempts
+        ingest.safe_start_ingest(event)
+        event = session.query(db.RecordedEvent).one()
+        self.assertEqual(event.status, db.Status.FAILED_UPLOADING)
+        self.assertEqual(event.attempts, 2)
+        self.assertIsNone(event.next_retry)
+        session.close()
+
+    def test_retry_reset(self):
+        ingest.ingest_step_by_step = lambda *args: None
+        session = db.get_session()
+        session.query(db.RecordedEvent)\
+               .update({'attempts': 3, 'next_retry': datetime.utcnow()})
+        session.commit()
+        self.event.attempts = 3
+
+        # Failed attempts are forgotten once the upload succeeds
+        ingest.ingest(self.event)
+        event = session.query(db.RecordedEvent).one()
+        self.assertEqual(event.status, db.Status.FINISHED_UPLOADING)
+        self.assertIsNone(event.attempts)
+        self.assertIsNone(event.next_retry)
+        self.assertIsNone(self.event.attempts)
+        session.close()
+
+    def test_run_workers(self):
+        ingested = []
+        ingest.safe_start_ingest = ingested.append
+        config.config('ingest')['workers'] = 2
+        ingest.terminate = terminate_fn(1)
+        ingest.run()
+        self.assertEqual([e.start for e in ingested], [self.event.start])
+        self.assertEqual(utils.get_service_status(db.Service.INGEST),
+                         db.ServiceStatus.STOPPED)
+
     def test_get_config_params(self):
         properties = '\n'.join([
             'org.opencastproject.workflow.config.encode_720p=true',
@@ -9,6 +9,7 @@ import tempfile
 import unittest
 
 from pyca import __main__, agentstate, capture, ingest, schedule, ui, utils
+from pyca import retention
 from tests.tools import should_fail, ShouldFailException, reload
 
 
@@ -63,7 +64,7 @@ class TestPycaMain(unittest.TestCase):
             os.remove(fn)
 
     def test_run(self):
-        for mod in (agentstate, capture, ingest, schedule):
+        for mod in (agentstate, capture, ingest, schedule, retention):
             mod.run = should_fail
             sys.argv = ['pyca', mod.__name__.split('.')[-1]]
             with self.assertRaises(ShouldFailException):
@@ -76,7 +77,7 @@ class TestPycaMain(unittest.TestCase):
             __main__.main()
 
         # Test run all
-        for mod in (agentstate, capture, ingest, schedule):
+        for mod in (agentstate, capture, ingest, schedule, retention):
             mod.run = lambda: True
         sys.argv = ['pyca', 'run']
         try:
@@ -84,7 +85,7 @@ class TestPycaMain(unittest.TestCase):
         except Exception:
             self.fail()
 
-        for mod in (agentstate, capture, ingest, schedule):
+        for mod in (agentstate, capture, ingest, schedule, retention):
             reload(mod)
 
     def test_sigterm(self):
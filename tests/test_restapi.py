@@ -6,6 +6,7 @@ pyCA tests for the REST api.
 import json
 import os
 import os.path
+import shutil
 import tempfile
 import unittest
 
@@ -22,12 +23,15 @@ class TestPycaRestInterface(unittest.TestCase):
 
     def setUp(self):
         self.fd1, self.dbfile = tempfile.mkstemp()
+        self.cadir = tempfile.mkdtemp()
         config.config()['agent']['database'] = 'sqlite:///' + self.dbfile
+        config.config()['capture']['directory'] = self.cadir
         db.init()
 
     def tearDown(self):
         os.close(self.fd1)
         os.remove(self.dbfile)
+        shutil.rmtree(self.cadir)
 
     def add_test_event(self):
         event = db.RecordedEvent()
@@ -109,7 +113,8 @@ class TestPycaRestInterface(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             keys = json.loads(response.data.decode('utf-8'))['meta'].keys()
             expect = {'disk_usage_in_bytes', 'load', 'memory_usage_in_bytes',
-                      'services', 'upstream'}
+                      'services', 'upstream', 'ingest_queue', 'retention',
+                      'disk_preflight'}
             self.assertEqual(set(keys), expect)
 
     def test_mediatype_param(self):
@@ -291,6 +296,20 @@ class TestPycaRestInterface(unittest.TestCase):
             self.assertEqual(jsonevent['attributes'].get('start'), 1000)
             self.assertEqual(jsonevent['attributes'].get('end'), 2000)
 
+        # Changing the status starts over with retrying failed uploads
+        session = db.get_session()
+        session.query(db.RecordedEvent).update({'attempts': 10})
+        session.commit()
+        content['data'][0]['attributes'] = {'status': 'finished recording'}
+        args['data'] = json.dumps(content)
+        with ui.app.test_request_context(**args):
+            response = ui.jsonapi.modify_event(event.uid)
+            self.assertEqual(response.status_code, 200)
+        event = session.query(db.RecordedEvent).one()
+        self.assertEqual(event.status, db.Status.FINISHED_RECORDING)
+        self.assertIsNone(event.attempts)
+        session.close()
+
     def test_schedule_event(self):
         # Mock scheduling
         ui.jsonapi.schedule = lambda title, duration, creator: True
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests for the removal of uploaded recordings
+'''
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from pyca import retention, config, db, utils
+from tests.tools import terminate_fn, reload
+
+
+class TestPycaRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        self.cadir = tempfile.mkdtemp()
+        config.config('agent')['database'] = 'sqlite:///' + self.dbfile
+        config.config('capture')['directory'] = self.cadir
+        db.init()
+
+        # One recording of each state with 100 bytes of data
+        session = db.get_session()
+        for status in db.Status.values():
+            event = db.RecordedEvent()
+            event.uid = str(status)
+            event.start = 1000 - status
+            event.end = event.start + 1
+            event.status = status
+            event.set_data({})
+            os.mkdir(event.directory())
+            with open(os.path.join(event.directory(), 'a.mp4'), 'wb') as f:
+                f.write(b'x' * 100)
+            session.add(event)
+        session.commit()
+        session.close()
+
+        # Fake a file system with 1000 bytes
+        self.free = 500
+        retention.disk_usage = lambda: (1000, 1000 - self.free, self.free)
+        rmtree = shutil.rmtree
+
+        def remove(directory):
+            self.free += retention.directory_size(directory)[0]
+            rmtree(directory)
+        retention.shutil.rmtree = remove
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+        shutil.rmtree(self.cadir)
+        reload(retention.shutil)
+        reload(retention)
+        reload(config)
+
+    def existing(self):
+        return sorted(int(name.split('-')[-1])
+                      for name in os.listdir(self.cadir))
+
+    def test_enforce_watermarks(self):
+        statuses = sorted(db.Status.values())
+
+        # Nothing happens without configured watermark or below it
+        self.assertEqual(retention.enforce_watermarks(), 0)
+        config.config('retention')['high_watermark'] = 50
+        config.config('retention')['low_watermark'] = 30
+        self.assertEqual(retention.enforce_watermarks(), 0)
+        self.assertEqual(retention.headroom(), 0)
+
+        # Only uploaded recordings are removed
+        self.free = 400
+        self.assertEqual(retention.headroom(), -100)
+        self.assertEqual(retention.enforce_watermarks(), 100)
+        self.assertEqual(self.existing(),
+                         [s for s in statuses
+                          if s != db.Status.FINISHED_UPLOADING])
+        self.assertEqual(retention.enforce_watermarks(), 0)
+        statistics = {s.name: s.value for s in db.get_session()
+                      .query(db.Statistic)}
+        self.assertEqual(statistics['retention_freed_bytes'], 100)
+        self.assertEqual(statistics['retention_evicted_recordings'], 1)
+
+    def test_evict_order(self):
+        session = db.get_session()
+        session.query(db.RecordedEvent).update(
+            {'status': db.Status.FINISHED_UPLOADING})
+        session.commit()
+        session.close()
+        # Recordings are removed oldest first by default
+        events = retention.eviction_candidates()
+        self.assertEqual([e.uid for e in events][:2], ['9', '8'])
+
+        # The least recently used recording is removed first in LRU mode
+        config.config('retention')['order'] = 'lru'
+        oldest = events[-1]
+        path = os.path.join(oldest.directory(), 'a.mp4')
+        os.utime(path, (0, 0))
+        self.assertEqual(retention.eviction_candidates()[0].uid, oldest.uid)
+
+        # Free only as much as requested
+        self.assertEqual(retention.evict(650), 200)
+        self.assertEqual(len(self.existing()), 7)
+
+    def test_run(self):
+        retention.terminate = terminate_fn(1)
+        retention.run()
+        self.assertEqual(utils.get_service_status(db.Service.RETENTION),
+                         db.ServiceStatus.STOPPED)
@@ -3,14 +3,88 @@
 pyCA tests for schedule handling
 '''
 
+import base64
 import datetime
+import dateutil.parser
 import os
 import os.path
+import random
 import tempfile
 import unittest
 
+from unittest.mock import patch
+
 from pyca import schedule, config, db, utils
-from tests.tools import should_fail, ShouldFailException, terminate_fn, reload
+from tests.tools import should_fail, terminate_fn, reload
+
+
+def legacy_parse_ical(vcal):
+    '''Split based iCalendar parser used by pyCA before the streaming parser.
+    This is the reference the streaming parser is tested against.
+    '''
+    vcal = vcal.replace('\r\n ', '').replace('\r\n\r\n', '\r\n')
+    vevents = vcal.split('\r\nBEGIN:VEVENT\r\n')
+    del vevents[0]
+    events = []
+    for vevent in vevents:
+        event = {}
+        for line in vevent.split('\r\n'):
+            line = line.split(':', 1)
+            key = line[0].lower()
+            if len(line) <= 1 or key == 'end':
+                continue
+            if key.startswith('dt'):
+                event[key] = int(dateutil.parser.parse(line[1]).timestamp())
+                continue
+            if not key.startswith('attach'):
+                event[key] = line[1]
+                continue
+            event['attach'] = event.get('attach', [])
+            attachment = {}
+            for x in [x.split('=') for x in line[0].split(';')]:
+                if x[0].lower() in ['fmttype', 'x-apple-filename']:
+                    attachment[x[0].lower()] = x[1]
+            attachment['data'] = base64.b64decode(line[1]).decode('utf-8')
+            event['attach'].append(attachment)
+        events.append(event)
+    return events
+
+
+def random_calendar(rnd):
+    '''Generate a random, possibly broken, calendar.
+    '''
+    attachment = base64.b64encode('äü<xml/>'.encode('utf-8')).decode('ascii')
+    parts = ['BEGIN:VCALENDAR', 'BEGIN:VEVENT', 'END:VEVENT', 'BEGIN:VEVENT',
+             'END:VCALENDAR', '', '', ' ', ' x', ' UID:1', 'UID:äü%i',
+             'SUMMARY:a:b', 'DTSTART:20170223T230000Z', 'DTEND:20170224',
+             'DTSTART;TZID=Europe/Berlin:20170223T230000', 'NOCOLON',
+             'ATTACH;FMTTYPE=application/xml;X-APPLE-FILENAME=episode.xml:'
+             + attachment, 'ATTACH;VALUE=BINARY:', ' ' + attachment[:4],
+             attachment[4:], '\r', '\n', 'BEGIN:VEVENT\r', ' \nx']
+    lines = [rnd.choice(parts) for _ in range(rnd.randint(0, 30))]
+    lines = [line % i if '%' in line else line for i, line in enumerate(lines)]
+    return '\r\n'.join(lines) + rnd.choice(['', '\r\n', '\r\n\r\n'])
+
+
+def respond(body):
+    '''Mock http_request sending the given response body.
+    '''
+    def http_request(url, write=None, **kwargs):
+        if body:
+            write(body)
+        return body
+    return http_request
+
+
+def random_chunks(data, rnd):
+    '''Split data into chunks of random sizes.
+    '''
+    chunks = []
+    while data:
+        size = rnd.randint(1, 8)
+        chunks.append(data[:size])
+        data = data[size:]
+    return chunks
 
 
 class TestPycaCapture(unittest.TestCase):
@@ -32,11 +106,12 @@ class TestPycaCapture(unittest.TestCase):
         utils.http_request = lambda x, y=False, timeout=0: b'xxx'
         self.fd, self.dbfile = tempfile.mkstemp()
         config.config()['agent']['database'] = 'sqlite:///' + self.dbfile
-        config.config()['services']['org.opencastproject.scheduler'] = ['']
-        config.config()['services']['org.opencastproject.capture.admin'] = ['']
 
         # Mock event
         db.init()
+        utils.store_service_endpoints('org.opencastproject.scheduler', [''])
+        utils.store_service_endpoints('org.opencastproject.capture.admin',
+                                      [''])
 
     def tearDown(self):
         os.close(self.fd)
@@ -51,15 +126,154 @@ class TestPycaCapture(unittest.TestCase):
         self.assertEqual(db.get_session().query(db.UpcomingEvent).count(), 0)
 
         # Failed parsing ical
-        schedule.http_request = lambda x: ShouldFailException
+        schedule.http_request = respond(b'BEGIN:VEVENT\r\nUID:x\r\n'
+                                        b'BEGIN:VEVENT\r\nEND:VEVENT')
         schedule.get_schedule()
         self.assertEqual(db.get_session().query(db.UpcomingEvent).count(), 0)
 
         # Get schedule
-        schedule.http_request = lambda x: self.VCAL
+        schedule.http_request = respond(self.VCAL)
         schedule.get_schedule()
         self.assertGreater(db.get_session().query(db.UpcomingEvent).count(), 0)
 
+    def test_get_schedule_update(self):
+        calendars = [self.VCAL, self.VCAL.replace(b'TEST', b'CHANGED'),
+                     self.VCAL.replace(b'UID:', b'UID:NEW'), b'']
+        for vcal in calendars:
+            schedule.http_request = respond(vcal)
+            schedule.get_schedule()
+            events = db.get_session().query(db.UpcomingEvent).all()
+            if vcal:
+                self.assertEqual(len(events), 1)
+                self.assertEqual(events[0].get_data()['uid'], events[0].uid)
+                self.assertEqual(events[0].get_data()['summary'],
+                                 events[0].title)
+            else:
+                self.assertEqual(events, [])
+
+        statistics = {s.name: s.value
+                      for s in db.get_session().query(db.Statistic)}
+        self.assertEqual(db.get_session().query(db.Attachment).count(), 0)
+        self.assertEqual(statistics['schedule_events_added'], 2)
+        self.assertEqual(statistics['schedule_events_updated'], 1)
+        self.assertEqual(statistics['schedule_events_removed'], 2)
+
+    def test_get_schedule_attachments(self):
+        vcal = self.VCAL.replace(b'UID:', b'UID:2') + b'\r\n' + self.VCAL
+        schedule.http_request = respond(vcal)
+        schedule.get_schedule()
+
+        # The attachment shared by both events is stored once
+        session = db.get_session()
+        self.assertEqual(session.query(db.Attachment).count(), 1)
+        for event in session.query(db.UpcomingEvent):
+            self.assertNotIn('data', event.get_data()['attach'][0])
+            self.assertEqual(event.get_attachments()[0]['data'], '...')
+            attributes = event.serialize(attachments=True)['attributes']
+            self.assertEqual(attributes['data']['attach'][0]['data'], '...')
+
+    def test_remove_unused_attachments(self):
+        schedule.http_request = respond(self.VCAL)
+        schedule.get_schedule()
+        session = db.get_session()
+        recorded = db.RecordedEvent(session.query(db.UpcomingEvent).one())
+        used = recorded.attachment_hashes
+        # Recording stored by an older version
+        recorded.attachment_hashes = None
+        session.add(recorded)
+        session.query(db.UpcomingEvent).delete()
+        session.add(db.Attachment(hash='unused', data=b''))
+        session.commit()
+
+        schedule.remove_unused_attachments(session)
+        session.commit()
+        self.assertEqual([a.hash for a in session.query(db.Attachment)],
+                         [used])
+        self.assertEqual(recorded.attachment_hashes, used)
+
+        # Only the hashes are loaded, the event data is not decoded
+        with patch.object(db.BaseEvent, 'get_data', should_fail):
+            schedule.remove_unused_attachments(session)
+
+        # Missing attachments are skipped
+        session.query(db.Attachment).delete()
+        session.commit()
+        self.assertEqual(recorded.get_attachments(), [])
+        session.close()
+
+    def test_get_schedule_conditional(self):
+        requests = []
+
+        def http_request(url, headers, response_headers, write):
+            requests.append(headers)
+            response_headers['etag'] = '"1"'
+            return respond(self.VCAL)(url, write=write)
+
+        schedule.http_request = http_request
+        schedule.get_schedule()
+        self.assertEqual(requests[-1], [])
+        schedule.get_schedule()
+        self.assertEqual(requests[-1], ['If-None-Match: "1"'])
+
+        # Neither a 304 nor an unchanged calendar is parsed. Errors are
+        # caught by get_schedule, hence the calls are checked.
+        with patch.object(schedule, 'iter_ical', side_effect=should_fail) \
+                as iter_ical:
+            schedule.get_schedule()
+            schedule.http_request = respond(None)
+            schedule.get_schedule()
+        iter_ical.assert_not_called()
+        self.assertEqual(db.get_session().query(db.UpcomingEvent).count(), 1)
+
+    def assertParsedEqual(self, vcal, chunks):
+        try:
+            expected = legacy_parse_ical(vcal)
+        except Exception as e:
+            with self.assertRaises(type(e)):
+                list(schedule.iter_ical(chunks))
+            return
+        self.assertEqual(list(schedule.iter_ical(chunks)), expected, vcal)
+
+    def test_parse_ical(self):
+        vcal = self.VCAL.decode('utf-8')
+        self.assertEqual(schedule.parse_ical(vcal), legacy_parse_ical(vcal))
+        self.assertEqual(schedule.parse_ical(vcal)[0]['summary'], 'TEST')
+
+    def test_parse_timestamp(self):
+        for value in ('20170223T230000Z', '20170223T230000', '20170223',
+                      '20171323T230000Z', '20170229T230000Z',
+                      '19700101T000000Z', '2017-02-23T23:00:00Z',
+                      '20170223T235960Z'):
+            try:
+                expected = int(dateutil.parser.parse(value).timestamp())
+            except ValueError:
+                with self.assertRaises(ValueError):
+                    schedule.parse_timestamp(value)
+                continue
+            self.assertEqual(schedule.parse_timestamp(value), expected)
+
+    def test_parse_ical_edge_cases(self):
+        for vcal in ('', '\r\n', 'BEGIN:VEVENT\r\nUID:1',
+                     '\r\nBEGIN:VEVENT\r\nUID:1',
+                     '\r\nBEGIN:VEVENT\r\nBEGIN:VEVENT\r\nUID:1',
+                     '\r\nBEGIN:VEVENT\r\n\r\nBEGIN:VEVENT\r\nUID:1',
+                     '\r\nBEGIN:VEVENT\r\n\r\n\r\nBEGIN:VEVENT\r\nX:1',
+                     'x\r\nBEGIN:VEVENT', 'x\r\nBEGIN:VEVENT\r\n',
+                     'x\r\n BEGIN:VEVENT\r\nUID:1\r\n',
+                     'x\r\nBEGIN:VEV\r\n ENT\r\nUID:1',
+                     'x\r\r\n \nBEGIN:VEVENT\r\nUID:1',
+                     ' x\r\n\r\n\r\n\r\nBEGIN:VEVENT\r\nUID:1'):
+            self.assertParsedEqual(vcal, [vcal])
+            self.assertParsedEqual(vcal, [vcal.encode('utf-8')])
+
+    def test_parse_ical_differential(self):
+        rnd = random.Random(1)
+        for _ in range(2000):
+            vcal = random_calendar(rnd)
+            self.assertParsedEqual(vcal, [vcal])
+            chunks = random_chunks(vcal.encode('utf-8'), rnd)
+            self.assertParsedEqual(vcal, chunks)
+
     def test_run(self):
         schedule.terminate = terminate_fn(2)
         schedule.run()
@@ -3,12 +3,16 @@
 pyCA tests for schedule handling
 '''
 
+import json
 import os
 import os.path
 import tempfile
 import unittest
 
+from prometheus_client.registry import CollectorRegistry
+
 from pyca import ui, config, db
+from pyca.ui.recordings_collector import RecordingsCollector
 
 
 class TestPycaUI(unittest.TestCase):
@@ -38,6 +42,7 @@ class TestPycaUI(unittest.TestCase):
             self.assertEqual(ui.home().status_code, 302)
 
     def test_prometheus_metrics(self):
+        db.Statistic.increase({'http_received_bytes': 10}, '/recordings')
         # Without authentication
         with ui.app.test_request_context():
             self.assertEqual(ui.prometheus_metrics().status_code, 401)
@@ -51,8 +56,52 @@ class TestPycaUI(unittest.TestCase):
             self.assertIn('pyca_events_count', data)
             self.assertIn('ingest', data)
             self.assertIn('upcoming', data)
+            self.assertIn('pyca_capture_start_latency_seconds_bucket', data)
+            self.assertIn('pyca_http_received_bytes_total'
+                          '{endpoint="/recordings"} 10.0', data)
+            self.assertIn('pyca_upload_rate_bytes_per_second', data)
             r.close()
 
+    def test_upload_progress_metrics(self):
+        event = db.RecordedEvent()
+        event.uid = '123'
+        event.start = event.end = 0
+        event.status = db.Status.UPLOADING
+        event.set_data({})
+        event.upload_progress = json.dumps([{
+            'flavor': 'a/b', 'file': 'a.mp4', 'sent': 10, 'total': 20,
+            'rate': 5.0, 'eta': None}])
+        session = db.get_session()
+        session.add(event)
+        session.commit()
+        collector = RecordingsCollector(session, CollectorRegistry())
+        metrics = {m.name: m.samples for m in collector.upload_progress()}
+        labels = {'uid': '123', 'flavor': 'a/b', 'file': 'a.mp4'}
+        self.assertEqual(metrics['pyca_upload_sent_bytes'][0].labels, labels)
+        self.assertEqual(metrics['pyca_upload_sent_bytes'][0].value, 10)
+        self.assertEqual(metrics['pyca_upload_rate_bytes_per_second'][0]
+                         .value, 5)
+        self.assertEqual(metrics['pyca_upload_eta_seconds'], [])
+        session.close()
+
+    def test_latency_histogram(self):
+        for latency in (0.2, 3, 1000):
+            db.Statistic.observe('capture_exit_latency', latency,
+                                 db.LATENCY_BUCKETS)
+        session = db.get_session()
+        collector = RecordingsCollector(session, CollectorRegistry())
+        histogram = collector.histogram('x', '', 'capture_exit_latency')
+        samples = {(s.name, s.labels.get('le')): s.value
+                   for s in histogram.samples}
+        self.assertEqual(samples[('x_bucket', '0.1')], 0)
+        self.assertEqual(samples[('x_bucket', '0.25')], 1)
+        self.assertEqual(samples[('x_bucket', '5')], 2)
+        self.assertEqual(samples[('x_bucket', '300')], 2)
+        self.assertEqual(samples[('x_bucket', '+Inf')], 3)
+        self.assertEqual(samples[('x_count', None)], 3)
+        self.assertEqual(samples[('x_sum', None)], 1003.2)
+        session.close()
+
     def test_ui(self):
         # Without authentication
         with ui.app.test_request_context():
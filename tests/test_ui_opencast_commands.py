@@ -13,7 +13,7 @@ class TestPycaIngest(unittest.TestCase):
 
     def setUp(self):
         opencast_commands.http_request = lambda x, y=False, timeout=0: b'xxx'
-        opencast_commands.service = lambda x, force_update=False: ['']
+        opencast_commands.select_endpoint = lambda x: ''
 
     def test_schedule_defaults(self):
         opencast_commands.schedule()
@@ -5,22 +5,29 @@ Tests for basic capturing
 '''
 
 import os
+import pycurl
 import tempfile
+import threading
+import time
 import unittest
 
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
 from pyca import utils, config, db
-from tests.tools import should_fail, CurlMock, reload
+from tests.tools import should_fail, terminate_fn, CurlMock, reload, \
+    OpencastMock, MEDIAPACKAGE
 
 
 class TestPycaUtils(unittest.TestCase):
 
     def setUp(self):
-        config.config()['services']['org.opencastproject.capture.admin'] = ['']
-
         # db
         self.fd, self.dbfile = tempfile.mkstemp()
         config.config()['agent']['database'] = 'sqlite:///' + self.dbfile
         db.init()
+        utils.store_service_endpoints('org.opencastproject.capture.admin',
+                                      [''])
 
     def tearDown(self):
         os.close(self.fd)
@@ -53,9 +60,197 @@ class TestPycaUtils(unittest.TestCase):
         self.assertEqual(utils.ensurelist([1]), [1])
 
     def test_service(self):
+        requests = []
+        utils.terminate(False)
+        utils.get_service = lambda x: requests.append(x) or ['a', 'b']
+        self.assertEqual(utils.service('x'), ['a', 'b'])
+        self.assertEqual(utils.service('x'), ['a', 'b'])
+        self.assertEqual(requests, ['org.opencastproject.x'])
+
+        # Expired cache
+        config.config()['server']['service_ttl'] = 0
+        self.assertEqual(utils.service('x'), ['a', 'b'])
+        self.assertEqual(len(requests), 2)
+
+        # Another process is updating the cache
+        registry = utils._registry_url('org.opencastproject.x')
+        self.assertTrue(db.UpstreamState.acquire_lease(registry, 60))
+        self.assertFalse(db.UpstreamState.acquire_lease(registry, 60))
+        self.assertEqual(utils.service('x'), ['a', 'b'])
+        self.assertEqual(len(requests), 2)
+        db.UpstreamState.release_lease(registry)
+
+        # Stale endpoints are used if the service registry fails. The
+        # registry is not asked again before the lease expires.
+        utils.get_service = lambda x: requests.append(x) or should_fail()
+        self.assertEqual(utils.service('x'), ['a', 'b'])
+        self.assertEqual(utils.service('x'), ['a', 'b'])
+        self.assertEqual(len(requests), 3)
+
+    def test_service_retry(self):
+        utils.get_service = should_fail
+        utils.terminate = terminate_fn(1)
+        utils.time.sleep = lambda delay: self.assertLessEqual(delay, 1)
+        self.assertEqual(utils.service('x'), [])
+        reload(utils.time)
+
+    def test_service_health(self):
+        utils.store_service_endpoints('x', ['http://a', 'http://b'])
+        self.assertEqual(utils.cached_service('x'), (['http://a', 'http://b'],
+                                                     False))
+        utils.update_endpoint_health('http://a/info', latency=2)
+        utils.update_endpoint_health('http://b/info', latency=1)
+        self.assertEqual(utils.cached_service('x')[0],
+                         ['http://b', 'http://a'])
+        utils.update_endpoint_health('http://b/info', failed=True)
+        self.assertEqual(utils.cached_service('x')[0],
+                         ['http://a', 'http://b'])
+
+        # Refresh the cache early if all endpoints fail, but not more than
+        # once per lease period
+        utils.update_endpoint_health('http://a/info', failed=True)
+        self.assertFalse(utils.cached_service('x')[1])
+        session = db.get_session()
+        session.query(db.UpstreamState).update({
+            'last_synced': datetime.utcnow() - timedelta(
+                seconds=utils.SERVICE_LEASE + 1)})
+        session.commit()
+        session.close()
+        self.assertTrue(utils.cached_service('x')[1])
+
+        # Statistics are kept for endpoints which are still available
+        utils.store_service_endpoints('x', ['http://a', 'http://c'])
+        endpoints = db.get_session().query(db.ServiceEndpoint)\
+                                    .filter(db.ServiceEndpoint.type == 'x')
+        self.assertEqual({e.url: e.failures for e in endpoints},
+                         {'http://a': 1, 'http://c': 0})
+
+    def test_endpoint_health_url(self):
+        utils.store_service_endpoints('x', ['http://a/ingest', 'http://ab'])
+        utils.update_endpoint_health('http://a/ingest/addTrack', failed=True)
+        utils.update_endpoint_health('http://a/ingest', failed=True)
+        utils.update_endpoint_health('http://ab/info', latency=1)
+        endpoints = db.get_session().query(db.ServiceEndpoint)\
+                                    .filter(db.ServiceEndpoint.type == 'x')
+        self.assertEqual({e.url: e.failures for e in endpoints},
+                         {'http://a/ingest': 2, 'http://ab': 0})
+
+    def test_select_endpoint(self):
+        service_id = 'org.opencastproject.ingest'
+        endpoints = ['http://a', 'http://b', 'http://c']
+        utils.store_service_endpoints(service_id, endpoints)
+        utils.terminate(False)
+        config.config()['ingest']['node_selection'] = 'fastest'
+
+        # Nodes without measurements are tried first
+        selected = []
+        for throughput in (30, 20, 10):
+            selected.append(utils.select_endpoint('ingest'))
+            utils.update_endpoint_health(selected[-1] + '/addTrack',
+                                         throughput=throughput)
+        self.assertEqual(sorted(selected), endpoints)
+        self.assertEqual(utils.select_endpoint('ingest'), selected[0])
+
+        # Failed nodes are avoided
+        utils.update_endpoint_health(selected[0] + '/addTrack', failed=True)
+        self.assertEqual(utils.select_endpoint('ingest'), selected[1])
+
+        # Sticky selection keeps the last selected node while it works
+        config.config()['ingest']['node_selection'] = 'sticky'
+        utils.update_endpoint_health(selected[2] + '/addTrack',
+                                     throughput=1000)
+        self.assertEqual(utils.select_endpoint('ingest'), selected[1])
+        utils.update_endpoint_health(selected[1] + '/addTrack', failed=True)
+        self.assertEqual(utils.select_endpoint('ingest'), selected[2])
+
+        config.config()['ingest']['node_selection'] = 'random'
+        self.assertIn(utils.select_endpoint('ingest'), endpoints)
+
+    def test_backoff(self):
+        for attempt in range(12):
+            delay = utils.backoff(attempt, maximum=300)
+            self.assertLessEqual(delay, min(2 ** attempt, 300))
+            self.assertGreaterEqual(delay, min(2 ** attempt, 300) / 2)
+
+    def test_scheduled_upload_rate(self):
+        config.config('ingest')['upload_rate'] = 100
+        config.config('ingest')['upload_rate_schedule'] = \
+            config.parse_rate_schedule(['08:00-18:00 2m', '22:00-06:00 0'])
+        rates = [utils.scheduled_upload_rate(datetime(2020, 1, 1, hour))
+                 for hour in (7, 8, 17, 18, 23, 5, 6)]
+        self.assertEqual(rates, [100, 2000000, 2000000, 100, 0, 0, 100])
+
+    @patch('pyca.utils.time.sleep')
+    def test_bandwidth_limiter(self, sleep):
+        config.config('ingest')['upload_rate'] = 1000
+        limiter = utils.bandwidth_limiter()
+        self.assertIs(limiter, utils.bandwidth_limiter())
+
+        # Data exceeding the available tokens has to wait
+        limiter.consume(3000, '')
+        self.assertAlmostEqual(sleep.call_args[0][0], 3, places=1)
+
+        # Rate changes apply to uploads in progress
+        sleep.reset_mock()
+        config.config('ingest')['upload_rate'] = 0
+        limiter.consume(3000, '')
+        sleep.assert_not_called()
+
+    def test_bandwidth_limiter_adaptive(self):
+        config.config('ingest')['upload_rate'] = 1000000
+        limiter = utils.BandwidthLimiter()
+        limiter.adapt(0.01, 1000000)
+        self.assertEqual(limiter.rate(), 1000000)
+
+        # Back off if the round-trip time rises
+        limiter.adapt(0.1, 1000000)
+        self.assertEqual(limiter.rate(), 500000)
+        limiter.adapt(0.1, 500000)
+        self.assertEqual(limiter.rate(), 250000)
+
+        # Increase the rate again up to the configured limit
+        limiter.adapt(0.01, 250000)
+        self.assertEqual(limiter.rate(), 350000)
+        for _ in range(10):
+            limiter.adapt(0.01, 1000000)
+        self.assertEqual(limiter.rate(), 1000000)
+        self.assertIsNone(limiter.adaptive)
+
+        # Without configured limit, the measured throughput is halved
+        config.config('ingest')['upload_rate'] = 0
+        limiter.adapt(0.1, 800000)
+        self.assertEqual(limiter.rate(), 400000)
+
+    def test_round_trip_time(self):
+        self.assertIsNone(utils.round_trip_time('http://127.0.0.1:8'))
+        self.assertIsNone(utils.round_trip_time(''))
+
+    def test_service_update_does_not_block(self):
         utils.terminate(False)
-        utils.get_service = lambda x: 'x'
-        self.assertEqual(utils.service('x'), 'x')
+        utils.store_service_endpoints('org.opencastproject.a', ['a1'])
+        utils.store_service_endpoints('org.opencastproject.b', ['b1'])
+        session = db.get_session()
+        session.merge(db.UpstreamState(
+            url=utils._registry_url('org.opencastproject.a'),
+            last_synced=datetime(2000, 1, 1)))
+        session.commit()
+        session.close()
+
+        # Slow update of the expired endpoints of service a
+        release = threading.Event()
+        utils.get_service = lambda x: release.wait(5) and ['a2']
+        thread = threading.Thread(target=utils.service, args=('a',))
+        thread.start()
+        lock = utils._service_lock('org.opencastproject.a')
+        while not lock.locked():
+            time.sleep(0.01)
+
+        # Other lookups do not wait for the update
+        self.assertEqual(utils.service('b'), ['b1'])
+        self.assertEqual(utils.service('a'), ['a1'])
+        release.set()
+        thread.join()
+        self.assertEqual(utils.service('a'), ['a2'])
 
     def test_http_request(self):
         config.config()['server']['insecure'] = True
@@ -74,6 +269,92 @@ class TestPycaUtils(unittest.TestCase):
             self.fail()
         reload(utils.pycurl)
 
+    def test_http_request_reuses_handles(self):
+        utils.pycurl.Curl = CurlMock
+        utils.http_request('http://127.0.0.1:8/a')
+        key = utils._curl_pool_key('http://127.0.0.1:8/b')
+        curl = utils._curl_pool[key][1][0]
+        utils.http_request('http://127.0.0.1:8/b')
+        self.assertEqual(utils._curl_pool[key][1], [curl])
+
+        # Disabled pooling closes handles
+        config.config()['http']['pool_size'] = 0
+        utils.http_request('http://127.0.0.1:8/c')
+        self.assertEqual(utils._curl_pool[key][1], [])
+        reload(utils.pycurl)
+
+    def test_http_request_write(self):
+        opencast = OpencastMock()
+        try:
+            chunks = []
+            self.assertEqual(utils.http_request(opencast.url + '/x',
+                                                write=chunks.append), b'')
+            self.assertEqual(b''.join(chunks), MEDIAPACKAGE.encode())
+        finally:
+            opencast.stop()
+
+    def test_transfer_statistics(self):
+        utils.update_transfer_statistics(
+            'https://example.com/recordings/calendars?agentid=x', 20, 100)
+        utils.update_transfer_statistics(
+            'https://example.com/recordings/calendars?agentid=x', 30, 100)
+
+        def statistics():
+            return {s.name: s.value for s in db.get_session()
+                    .query(db.Statistic)
+                    .filter(db.Statistic.label == '/recordings/calendars')}
+
+        # Only the first request is written right away
+        self.assertEqual(statistics(), {'http_received_bytes': 20,
+                                        'http_decoded_bytes': 100,
+                                        'http_requests': 1})
+        utils.flush_transfer_statistics()
+        self.assertEqual(statistics(), {'http_received_bytes': 50,
+                                        'http_decoded_bytes': 200,
+                                        'http_requests': 2})
+
+    def test_parse_header(self):
+        headers = {}
+        utils._parse_header(b'HTTP/1.1 302 Found\r\n', headers)
+        utils._parse_header(b'Location: /x\r\n', headers)
+        utils._parse_header(b'HTTP/1.1 200 OK\r\n', headers)
+        utils._parse_header(b'ETag: "abc"\r\n', headers)
+        utils._parse_header(b'\r\n', headers)
+        self.assertEqual(headers, {'etag': '"abc"'})
+
+    def test_http2(self):
+        self.assertFalse(utils.http2_enabled())
+        config.config()['http']['http2'] = True
+        http2 = utils.pycurl.VERSION_HTTP2
+        utils.pycurl.version_info = lambda: (0, '', 0, '', http2)
+        self.assertTrue(utils.http2_enabled())
+        options = []
+
+        class Curl(CurlMock):
+            def setopt(self, *args):
+                options.append(args)
+
+        class CurlShare():
+            def setopt(self, *args):
+                options.append(args)
+
+        utils.pycurl.Curl = Curl
+        utils.pycurl.CurlShare = CurlShare
+        utils.http_request('https://127.0.0.1:8/a')
+        self.assertIn((utils.pycurl.HTTP_VERSION,
+                       utils.pycurl.CURL_HTTP_VERSION_2TLS), options)
+
+        # Handles are used by several threads, connections must not be shared
+        self.assertNotIn((utils.pycurl.SH_SHARE,
+                          utils.pycurl.LOCK_DATA_CONNECT), options)
+        self.assertNotIn(utils.pycurl.PIPEWAIT, [o[0] for o in options])
+
+        # Fall back to HTTP/1.1 if libcurl has no HTTP/2 support
+        utils.pycurl.version_info = lambda: (0, '', 0, '', 0)
+        self.assertFalse(utils.http2_enabled())
+        self.assertFalse(config.config('http', 'http2'))
+        reload(utils.pycurl)
+
     def test_register_ca(self):
         utils.http_request = lambda x, y=False, timeout=0: b'xxx'
         utils.register_ca()
@@ -82,13 +363,127 @@ class TestPycaUtils(unittest.TestCase):
         config.config()['agent']['backup_mode'] = True
         utils.register_ca()
 
-    def test_recording_state(self):
-        utils.http_request = lambda x, y=False, timeout=0: b''
-        utils.recording_state('123', 'recording')
+    def test_update_agent_state(self):
+        sent = []
+        utils.http_request = lambda x, y=False, timeout=0: \
+            sent.append(y[1][1]) or b''
+        self.assertTrue(utils.update_agent_state())
+        self.assertTrue(utils.update_agent_state())
+        self.assertEqual(sent, ['offline'])
+
+        # Changes are sent immediately
+        utils.set_service_status(db.Service.SCHEDULE, db.ServiceStatus.IDLE)
+        utils.update_agent_state()
+        self.assertEqual(sent, ['offline', 'idle'])
+        utils.update_agent_state(force=True)
+        self.assertEqual(sent, ['offline', 'idle', 'idle'])
+
+        # Unchanged states are sent again after the keep-alive interval
+        config.config()['agent']['state_keepalive'] = 0
+        utils.update_agent_state()
+        self.assertEqual(len(sent), 4)
+
+        statistics = {s.name: s.value
+                      for s in db.get_session().query(db.Statistic)}
+        self.assertEqual(statistics['agentstate_updates_sent'], 4)
+        self.assertEqual(statistics['agentstate_updates_suppressed'], 1)
+
+        # Failed updates are not recorded as sent
         utils.http_request = should_fail
+        config.config()['agent']['state_keepalive'] = 300
+        utils.set_service_status(db.Service.CAPTURE, db.ServiceStatus.BUSY)
+        self.assertFalse(utils.update_agent_state())
+        state = db.get_session().query(db.UpstreamState)\
+            .filter(db.UpstreamState.agent_state.isnot(None))\
+            .first()
+        self.assertEqual(state.agent_state, 'idle')
+
+    def test_recording_state(self):
+        sent = []
+        utils.http_request = lambda x, y=False, timeout=0: sent.append(y)
         utils.recording_state('123', 'recording')
+        self.assertTrue(utils.flush_state_updates())
+        self.assertEqual(sent, [[('state', 'recording')]])
         config.config()['agent']['backup_mode'] = True
         utils.recording_state('123', 'recording')
+        self.assertTrue(utils.flush_state_updates())
+        self.assertEqual(len(sent), 1)
+
+    def test_send_recording_state(self):
+        utils.http_request = lambda x, y=False, timeout=0: b''
+        self.assertTrue(utils.send_recording_state('123', 'recording'))
+        utils.http_request = should_fail
+        self.assertFalse(utils.send_recording_state('123', 'recording'))
+
+    def test_queue_state_update(self):
+        sent = []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def http_request(url, post_data=None, timeout=0):
+            blocked.set()
+            release.wait()
+            sent.append((url, post_data[0][1]))
+
+        utils.http_request = http_request
+        utils.recording_state('1', 'capturing')
+        blocked.wait()
+        # Pending updates for the same recording are coalesced
+        utils.recording_state('1', 'capture_finished')
+        utils.recording_state('2', 'capturing')
+        utils.recording_state('1', 'uploading')
+        release.set()
+        self.assertTrue(utils.flush_state_updates())
+        self.assertEqual(sent, [('/recordings/1', 'capturing'),
+                                ('/recordings/2', 'capturing'),
+                                ('/recordings/1', 'uploading')])
+
+    def test_queue_state_update_retry(self):
+        sent = []
+
+        def http_request(url, post_data=None, timeout=0):
+            sent.append(post_data)
+            if len(sent) == 1:
+                should_fail()
+
+        utils.http_request = http_request
+        utils.recording_state('123', 'capturing')
+        self.assertFalse(utils.flush_state_updates(0.1))
+        self.assertTrue(utils.flush_state_updates())
+        self.assertEqual(len(sent), 2)
+
+    def test_queue_state_update_client_error(self):
+        sent = []
+
+        def http_request(url, post_data=None, timeout=0):
+            sent.append(url)
+            if url == '/recordings/unknown':
+                error = pycurl.error(pycurl.E_HTTP_RETURNED_ERROR, '404')
+                error.status = 404
+                raise error
+
+        # Client errors are not retried and do not block later updates
+        utils.http_request = http_request
+        utils.recording_state('unknown', 'capturing')
+        utils.recording_state('123', 'capturing')
+        self.assertTrue(utils.flush_state_updates(0.5))
+        self.assertEqual(sent, ['/recordings/unknown', '/recordings/123'])
+
+    def test_queue_state_update_attempts(self):
+        sent = []
+
+        def http_request(url, post_data=None, timeout=0):
+            sent.append(url)
+            if url == '/recordings/1':
+                should_fail()
+
+        # Updates are dropped after the maximum number of attempts
+        utils.STATE_UPDATE_ATTEMPTS = 2
+        utils.http_request = http_request
+        utils.recording_state('1', 'capturing')
+        utils.recording_state('2', 'capturing')
+        self.assertTrue(utils.flush_state_updates())
+        self.assertEqual(sent, ['/recordings/1'] * 2 + ['/recordings/2'])
 
     def test_set_service_status_immediate(self):
         utils.http_request = lambda x, y=False, timeout=0: b''
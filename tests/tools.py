@@ -3,9 +3,15 @@
 Some helper tools for pyCA testing.
 '''
 
+import email.parser
+import email.policy
+import json
 import logging
 import pycurl
+import threading
+import time
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from importlib import reload  # noqa
 
 
@@ -62,5 +68,156 @@ class CurlMock():
     def getinfo(self, *args):
         return 200
 
+    def reset(self):
+        pass
+
     def close(self):
         pass
+
+
+MEDIAPACKAGE = '<mediapackage ' \
+               'xmlns="http://mediapackage.opencastproject.org" id="mp">' \
+               '<media></media></mediapackage>'
+
+
+class OpencastMock():
+    '''Minimal stand-in for the Opencast ingest and upload services running
+    on a local HTTP server.
+    '''
+
+    def __init__(self):
+        self.jobs = {}
+        self.tracks = []
+        self.requests = []
+        # Chunk numbers for which the upload fails once
+        self.fail_chunks = set()
+        # Seconds each request to add a track takes
+        self.delay = 0
+        # Status code the single request ingest endpoint fails with, e.g.
+        # 404 if it is not available
+        self.single_request_error = None
+        # Bytes per second each connection may send, 0 for no limit
+        self.rate = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                mock.handle(self, {})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = mock.receive(self.rfile, length)
+                message = email.parser.BytesParser(
+                    policy=email.policy.HTTP).parsebytes(
+                        b'Content-Type: ' +
+                        self.headers['Content-Type'].encode() +
+                        b'\r\n\r\n' + body)
+                self.parts = [(part.get_param('name',
+                                              header='content-disposition'),
+                               part.get_payload(decode=True))
+                              for part in message.iter_parts()]
+                mock.handle(self, dict(self.parts))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def receive(self, rfile, length):
+        '''Read a request body, limiting the rate like a slow connection.
+        '''
+        if not self.rate:
+            return rfile.read(length)
+        body = bytearray()
+        start = time.monotonic()
+        while len(body) < length:
+            body += rfile.read(min(length - len(body), 65536))
+            time.sleep(max(start + len(body) / self.rate - time.monotonic(),
+                           0))
+        return bytes(body)
+
+    def handle(self, request, fields):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+        try:
+            self._handle(request, fields)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _handle(self, request, fields):
+        path = request.path
+        self.requests.append((path, fields))
+        status, body = 200, MEDIAPACKAGE.encode()
+        if path == '/upload/newjob':
+            job_id = str(len(self.jobs) + 1)
+            self.jobs[job_id] = {
+                'id': job_id,
+                'state': 'INPROGRESS',
+                'filename': fields['filename'].decode(),
+                'chunksize': int(fields['chunksize']),
+                'filesize': int(fields['filesize']),
+                'current-chunk': {'number': -1},
+                'data': b''}
+            body = job_id.encode()
+        elif path.startswith('/upload/job/'):
+            job_id = path.split('/')[3].split('.')[0]
+            job = self.jobs.get(job_id)
+            if not job:
+                status, body = 404, b''
+            elif request.command == 'POST':
+                chunk = int(fields['chunknumber'])
+                if chunk in self.fail_chunks:
+                    self.fail_chunks.remove(chunk)
+                    status, body = 503, b''
+                elif chunk != job['current-chunk']['number'] + 1:
+                    status, body = 400, b''
+                else:
+                    job['data'] += fields['filedata']
+                    job['current-chunk']['number'] = chunk
+                    if len(job['data']) == job['filesize']:
+                        job['state'] = 'COMPLETE'
+                        job['payload'] = {'url': self.url + path + '/data'}
+            if status == 200:
+                serializable = {k: v for k, v in job.items() if k != 'data'}
+                body = json.dumps({'uploadjob': serializable}).encode()
+        elif path == '/ingest/addTrack':
+            time.sleep(self.delay)
+            if 'url' in fields:
+                job_id = fields['url'].decode().split('/')[-2]
+                data = self.jobs[job_id]['data']
+            else:
+                data = fields['BODY1']
+            with self.lock:
+                self.tracks.append(data)
+                track_id = len(self.tracks)
+            mediapackage = fields['mediaPackage'].decode() or MEDIAPACKAGE
+            track = '<track id="track-%i" type="%s"/></media>' % (
+                track_id, fields['flavor'].decode())
+            body = mediapackage.replace('</media>', track, 1).encode()
+        elif path.startswith('/ingest/addMediaPackage'):
+            if self.single_request_error:
+                status, body = self.single_request_error, b''
+            for name, value in request.parts if status == 200 else []:
+                if name == 'mediaUri':
+                    value = self.jobs[value.decode().split('/')[-2]]['data']
+                if name in ('BODY', 'mediaUri'):
+                    self.tracks.append(value)
+        request.send_response(status)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
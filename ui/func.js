@@ -35,6 +35,7 @@ var create_event = function (event, status, id) {
         'start': new Date(event.attributes.start * 1000).toLocaleString(),
         'end': new Date(event.attributes.end * 1000).toLocaleString(),
         'status': status,
+        'upload_progress': event.attributes.upload_progress || [],
         'id': id
     };
 }
@@ -118,6 +119,24 @@ var update_data = function () {
                     'value': `${used.toFixed(0)}% (${format_bytes(disk_usage.free)} free)`,
                 });
             }
+            // Get space left until uploaded recordings are removed
+            var retention = response.meta.retention;
+            if (retention) {
+                machine.metrics.push({
+                    'name': 'Disk Headroom',
+                    'value': `${format_bytes(Math.max(retention.headroom_in_bytes, 0))} `
+                        + `(${format_bytes(retention.freed_in_bytes)} freed)`,
+                });
+            }
+            // Get disk space check of the latest recording
+            var preflight = response.meta.disk_preflight;
+            if (preflight && !preflight.sufficient) {
+                machine.metrics.push({
+                    'name': 'Insufficient Disk Space',
+                    'value': `${format_bytes(preflight.estimated_size_in_bytes)} needed, `
+                        + `${format_bytes(Math.max(preflight.available_in_bytes, 0))} available`,
+                });
+            }
             // Get memory usage
             var memory_usage = response.meta.memory_usage_in_bytes;
             if (memory_usage) {